@@ -1,4 +1,4 @@
-import logging, os, platform, posixpath, subprocess, shlex, string, sys
+import functools, logging, os, platform, posixpath, re, subprocess, shlex, shutil, string, sys, tempfile
 
 from docutils import nodes
 from docutils.parsers.rst import directives, states
@@ -7,14 +7,28 @@ from docutils.parsers.rst.roles import set_classes
 from sphinx.util.compat import Directive
 from sphinx.util.osutil import ensuredir
 
+from .cache import cache_key, get_cache, parse_size, setup as setup_cache
+from .html import append_diagram, embed_option, setup as setup_html
+from .latex import append_latex_diagram, setup as setup_latex
 from .phix import (PhixError,
+                   note_render_job,
                    program_files_32,
                    relfn2path,
-                   temp_path)
+                   scratch_directory)
+from .scheduler import (fetch_rendering,
+                        note_render_failure,
+                        plan_jobs,
+                        postprocess_jobs,
+                        register_planner)
+from .thumbnail import thumbnail_option
 
 log = logging.getLogger('phix.argouml')
 logging.basicConfig()
 
+# A jar file named in a launch script, perhaps with a directory which the
+# script computes, such as ${ARGO_HOME}/argouml.jar.
+JAR_EXPR = re.compile(r'[^\s\'"=:;]*\.jar\b')
+
 class argouml(nodes.General, nodes.Element):
     '''A docutils node representing an ArgoUML diagram'''
 
@@ -62,7 +76,9 @@ class ArgoUmlDirective(Directive):
                    'scale': directives.percentage,
                    'align': align,
                    'border': directives.positive_int,
-                   'class': directives.class_option}
+                   'class': directives.class_option,
+                   'embed': embed_option,
+                   'thumbnail': thumbnail_option}
 
     def run(self):
         '''Process the argouml directive.
@@ -77,7 +93,10 @@ class ArgoUmlDirective(Directive):
         # name of the ArgoUML zargo file.
         reference = directives.uri(self.arguments[0])
         env = self.state.document.settings.env
-        _, filename = relfn2path(env, reference)
+        rel_filename, filename = relfn2path(env, reference)
+
+        # Rebuild this document, and only this document, when the source changes.
+        env.note_dependency(rel_filename)
         log.info('filename = {0}'.format(filename))
 
         # Get the name of the diagram from the required :diagram: option
@@ -118,6 +137,13 @@ class ArgoUmlDirective(Directive):
         log.info("argouml_node['new_window_flag'] = {0}".format(
                 argouml_node['new_window_flag']))
 
+        # Defer rendering so that every diagram from this zargo file can be
+        # exported by a single ArgoUML launch once reading is complete.
+        note_render_job(env, 'argouml', {'uri': argouml_node['uri'],
+                                         'diagram': diagram,
+                                         'postprocess': self.options.get('postprocess'),
+                                         'thumbnail': self.options.get('thumbnail')})
+
         return messages + [argouml_node]
 
 def get_image_filename(self, uri, diagram):
@@ -150,46 +176,37 @@ def get_image_filename(self, uri, diagram):
         refer_path = fname
         render_path = os.path.join(self.builder.outdir, fname)
 
-    if os.path.isfile(render_path):
-        return refer_path, render_path
-
     ensuredir(os.path.dirname(render_path))
 
     return refer_path, render_path
 
-def create_graphics(self, zargo_uri, diagram_name, render_path, postprocess_command=None):
+def create_graphics_batch(zargo_uri, diagrams):
     '''
-    Use ArgoUML in batch mode to render a named diagram from a zargo file into
-    graphics of the specified format.
+    Use a single launch of ArgoUML in batch mode to render several named
+    diagrams from a zargo file, so that the JVM is started and the project is
+    loaded only once.
 
     Args:
         zargo_uri:  The path to the ArgoUML zargo file.
 
-        diagram_name: A string containing the diagram name.
-
-        render_path: The path to which the graphics output is to be rendered.
-
-        postprocess_command: An optional command into which the ArgoUML SVG
-           output will be piped before it is placed in the output document.
-           The command should accept SVG on stdin and produce SVG on stdout.
+        diagrams: A sequence of (diagram_name, output_path) pairs.
 
     Raises:
-        PhixError: If the graphics could not be rendered.
+        PhixError: If ArgoUML could not be run. Diagrams which could not be
+            found in the project are not reported; their output files are
+            simply not created.
     '''
-
-    log.info("create_graphics()")
+    log.info("create_graphics_batch()")
     log.info("zargo_uri = {0}".format(zargo_uri))
-    log.info("diagram_name = {0}".format(diagram_name))
-    log.info("render_path = {0}".format(render_path))
-
-    output_path = render_path if postprocess_command is None else temp_path('.svg')
-    log.info("output_path = {0}".format(output_path))
 
-    # Launch ArgoUML and instruct it to export the requested diagram as SVG
+    # Launch ArgoUML, open the project once, and then instruct it to export
+    # each requested diagram in turn as SVG
     args = ['-batch',
-            '-command', 'org.argouml.uml.ui.ActionOpenProject=%s' % str(zargo_uri),
-            '-command', 'org.argouml.ui.cmd.ActionGotoDiagram=%s' % str(diagram_name),
-            '-command', 'org.argouml.uml.ui.ActionSaveGraphics=%s' % str(output_path)]
+            '-command', 'org.argouml.uml.ui.ActionOpenProject=%s' % str(zargo_uri)]
+    for diagram_name, output_path in diagrams:
+        log.info("{0} -> {1}".format(diagram_name, output_path))
+        args.extend(['-command', 'org.argouml.ui.cmd.ActionGotoDiagram=%s' % str(diagram_name),
+                     '-command', 'org.argouml.uml.ui.ActionSaveGraphics=%s' % str(output_path)])
     command = argouml_command() + args
     log.info("command = {0}".format(' '.join(command)))
     returncode = subprocess.call(command)
@@ -197,16 +214,116 @@ def create_graphics(self, zargo_uri, diagram_name, render_path, postprocess_comm
     if returncode != 0:
         raise PhixError("Could not launch ArgoUML with command %s" % ' '.join(command))
 
-    # See if the output file doesn't exist. This is a good indicator
-    # that the wrong diagram was selected in the directive.
-    if not os.path.exists(output_path):
-        raise PhixError(
-            'The output SVG file {0} does not exist. This often means that you specified the wrong diagram in your argouml directive.'.format(
-                output_path))
+def uses_render_server(config):
+    '''Determine whether ArgoUML render requests are sent to the render server:
+    only if phix_argouml_daemon is enabled and ARGOUML_WORKER_LAUNCH names a
+    worker for the server to keep warm.'''
+    # Imported here because the render server itself imports this module.
+    from .argouml_server import worker_command
+    return bool(config.phix_argouml_daemon) and worker_command() is not None
+
+def export_diagrams(config, zargo_uri, diagrams):
+    '''Export several diagrams from a zargo file, using the render server if
+    uses_render_server() allows, and otherwise a single batch launch of
+    ArgoUML.
+
+    Args:
+        config: The Sphinx configuration.
+
+        zargo_uri:  The path to the ArgoUML zargo file.
+
+        diagrams: A sequence of (diagram_name, output_path) pairs.
+
+    Raises:
+        PhixError: If the diagrams could not be exported.
+    '''
+    if uses_render_server(config):
+        from . import argouml_server
+        try:
+            argouml_server.render(zargo_uri,
+                                  diagrams,
+                                  idle_timeout=config.phix_argouml_daemon_timeout,
+                                  max_projects=config.phix_argouml_daemon_projects)
+            return
+        except PhixError:
+            log.info('Could not use the ArgoUML render server',
+                     exc_info=sys.exc_info())
+    create_graphics_batch(zargo_uri, diagrams)
+
+def plan_render(app, jobs):
+    '''Plan the rendering of ArgoUML diagrams.
+
+    Each task exports every uncached diagram from one zargo file with a single
+    launch of ArgoUML. Diagrams which are cached, but not with the postprocess
+    they need, are postprocessed without launching ArgoUML.
+
+    Args:
+        app: The Sphinx application.
+
+        jobs: The argouml render jobs recorded by the documents.
+
+    Returns:
+        A list of render tasks.
+    '''
+    unrendered, tasks = plan_jobs(app.builder, jobs, render_key)
+
+    # Group the diagrams which are not already cached by zargo file
+    batches = {}
+    for key, key_jobs in unrendered.items():
+        batches.setdefault(key_jobs[0]['uri'], {})[key] = key_jobs
+
+    if batches and app.config.phix_argouml_daemon and not uses_render_server(app.config):
+        app.builder.warn('phix_argouml_daemon is set, but ARGOUML_WORKER_LAUNCH names no ArgoUML '
+                         'worker for the render server to keep warm, so ArgoUML is launched for '
+                         'each zargo file instead')
+
+    return tasks + [functools.partial(render_batch, app, zargo_uri, batch)
+                    for zargo_uri, batch in batches.items()]
+
+def render_batch(app, zargo_uri, jobs):
+    '''Export diagrams from a zargo file into the render cache.
 
-    # If a postprocess command has been specified
-    if postprocess_command is not None:
-        render_html.execute_postprocess_command(postprocess_command)
+    Args:
+        app: The Sphinx application.
+
+        zargo_uri: The path to the ArgoUML zargo file.
+
+        jobs: A dictionary mapping the cache key of each diagram to the list of
+            render jobs which need it.
+    '''
+    log.info('Rendering {0} diagrams from {1}'.format(len(jobs), zargo_uri))
+    cache = get_cache(app.builder)
+    output_dir = tempfile.mkdtemp(dir=scratch_directory(app.builder))
+    try:
+        outputs = [(key, key_jobs, os.path.join(output_dir, '{0}.svg'.format(index)))
+                   for index, (key, key_jobs) in enumerate(jobs.items())]
+        try:
+            export_diagrams(app.config,
+                            zargo_uri,
+                            [(key_jobs[0]['diagram'], output_path)
+                             for _, key_jobs, output_path in outputs])
+        except PhixError:
+            for key in jobs:
+                note_render_failure(app.builder, key, str(sys.exc_info()[1]))
+            return
+
+        for key, key_jobs, output_path in outputs:
+            # See if the output file doesn't exist. This is a good indicator
+            # that the wrong diagram was selected in the directive.
+            if not os.path.exists(output_path):
+                note_render_failure(
+                    app.builder, key,
+                    'The diagram {0} was not exported. This often means that you specified the wrong diagram in your argouml directive.'.format(
+                        key_jobs[0]['diagram']))
+                continue
+            try:
+                cache.store(key, output_path)
+            except PhixError:
+                note_render_failure(app.builder, key, str(sys.exc_info()[1]))
+                continue
+            postprocess_jobs(app.builder, key, key_jobs)
+    finally:
+        shutil.rmtree(output_dir, ignore_errors=True)
 
 def argouml_command():
     '''Get a command for launching ArgoUML.
@@ -232,29 +349,132 @@ def argouml_command():
 
     return ['argouml']
 
-def render_html(self, node):
+def argouml_version():
+    '''Identify the installed version of ArgoUML.
+
+    ArgoUML cannot report its version without starting a JVM, which is the very
+    cost we are trying to avoid, so the version is identified by the launch
+    command together with the size and modification time of the files which
+    the launch command refers to; see launched_files().
+
+    Returns:
+        A string identifying the ArgoUML installation.
     '''
-    Render the supplied node as HTML.
+    command = argouml_command()
+    identity = [' '.join(command)]
+    for path in launched_files(command):
+        stat = os.stat(path)
+        identity.append('{0}:{1}:{2}'.format(path, stat.st_size, stat.st_mtime))
+    return ' '.join(identity)
+
+def launched_files(command):
+    '''Find the files which a launch command refers to: its executable, found
+    on PATH if it is not a path, any argument which is a file, such as
+    argouml.jar, and any jar file named in a launch script, such as the
+    argouml script found on PATH.
 
-    Note: This method *always* raises docutils.nodes.SkipNode to ensure that the
-        child nodes are not visited.
+    Returns:
+        A list of paths to existing files.
+    '''
+    paths = []
+    for index, fragment in enumerate(command):
+        if os.path.isfile(fragment):
+            path = fragment
+        elif index == 0:
+            path = find_executable(fragment)
+        else:
+            path = None
+        if path is None or path in paths:
+            continue
+        paths.append(path)
+        if not path.endswith('.jar'):
+            paths.extend(jar for jar in script_jars(path) if jar not in paths)
+    return paths
+
+def find_executable(name):
+    '''Find an executable on PATH.
+
+    Returns:
+        The path to the executable, or None if it could not be found.
+    '''
+    which = getattr(shutil, 'which', None)
+    if which is None:
+        # Python 2 has no shutil.which.
+        from distutils.spawn import find_executable as which
+    return which(name)
+
+def script_jars(script_path):
+    '''Find the jar files named in a launch script. A jar which is not found
+    where the script names it is looked for in the directory of the script,
+    following any symbolic link to it, as launch scripts usually compute that
+    directory.
+
+    Returns:
+        A list of paths to existing jar files, which is empty if the file is
+        not a script.
+    '''
+    try:
+        with open(script_path, 'rb') as script_file:
+            content = script_file.read(65536)
+    except (IOError, OSError):
+        return []
+    if b'\0' in content:
+        # A binary executable, such as java, rather than a script.
+        return []
+    directory = os.path.dirname(os.path.realpath(script_path))
+    jars = []
+    for name in JAR_EXPR.findall(content.decode('utf-8', 'replace')):
+        for path in (name, os.path.join(directory, os.path.basename(name))):
+            if os.path.isfile(path):
+                if path not in jars:
+                    jars.append(path)
+                break
+    return jars
+
+def argouml_memory():
+    '''Estimate the memory needed by each ArgoUML launch.
+
+    Returns:
+        The maximum heap size given by an -Xmx option of the launch command, or
+        512M - the heap size used by the ArgoUML launchers - if there is none.
+    '''
+    for fragment in argouml_command():
+        if fragment.startswith('-Xmx'):
+            try:
+                return parse_size(fragment[len('-Xmx'):])
+            except PhixError:
+                pass
+    return parse_size('512M')
+
+def render_key(node):
+    '''Compute the render cache key for the rendering of an argouml node by
+    ArgoUML, before any postprocess.'''
+    return cache_key(node['uri'],
+                     'argouml',
+                     node['diagram'],
+                     argouml_version())
+
+def fetch_diagram(self, node):
+    '''
+    Fetch the rendering of the supplied node into the output directory.
 
     Args:
         node: An argouml docutils node.
 
+    Returns:
+        A 2-tuple of the path by which the output refers to the rendering and
+        the path to which it was fetched, from get_image_filename().
+
     Raises:
-        SkipNode: Do not visit the current node's children, and do not call the
-        current node's ``depart_...`` method.
+        SkipNode: If the rendering could not be fetched, which has been
+        reported.
     '''
-    has_thumbnail = False
-
     try:
         refer_path, render_path = get_image_filename(self, node['uri'], node['diagram'])
         log.info("refer_path = {0}".format(refer_path))
         log.info("render_path = {0}".format(render_path))
         log.info("node['uri'] = {0}".format(node['uri']))
-        #if not os.path.isfile(render_path):
-        create_graphics(self, node['uri'], node['diagram'], render_path, node.get('postprocess'))
+        fetch_rendering(self.builder, render_key(node), node.get('postprocess'), render_path)
     except PhixError:
         exc = sys.exc_info()
         log.info('Could not render {0}'.format(node['uri']),
@@ -263,20 +483,42 @@ def render_html(self, node):
                 node['uri'],
                 exc[1]))
         raise nodes.SkipNode
+    return refer_path, render_path
 
-    self.body.append(self.starttag(node, 'p', CLASS='argouml'))
+def render_html(self, node):
+    '''
+    Render the supplied node as HTML.
 
-    objtag_format = '<object data="%s" width="%s" height="%s" border="%s" type="image/svg+xml" class="img">\n'
-    self.body.append(objtag_format % (refer_path, node['width'], node['height'], node['border']))
-    self.body.append('</object>')
+    Note: This method *always* raises docutils.nodes.SkipNode to ensure that the
+        child nodes are not visited.
 
-    if node['new_window_flag']:
-        self.body.append('<p align="right">\n')
-        new_window_tag_format = '<a href="%s" target="_blank">Open in new window</a>'
-        self.body.append(new_window_tag_format % refer_path)
-        self.body.append('</p>\n')
+    Args:
+        node: An argouml docutils node.
+
+    Raises:
+        SkipNode: Do not visit the current node's children, and do not call the
+        current node's ``depart_...`` method.
+    '''
+    refer_path, render_path = fetch_diagram(self, node)
+    append_diagram(self, node, 'argouml', refer_path, render_path)
+    raise nodes.SkipNode
+
+def render_latex(self, node):
+    '''
+    Render the supplied node as LaTeX, including the diagram as PDF.
 
-    self.body.append('</p>\n')
+    Note: This method *always* raises docutils.nodes.SkipNode to ensure that the
+        child nodes are not visited.
+
+    Args:
+        node: An argouml docutils node.
+
+    Raises:
+        SkipNode: Do not visit the current node's children, and do not call the
+        current node's ``depart_...`` method.
+    '''
+    refer_path, render_path = fetch_diagram(self, node)
+    append_latex_diagram(self, node, render_path)
     raise nodes.SkipNode
 
 def html_visit_argouml(self, node):
@@ -286,11 +528,18 @@ def html_visit_argouml(self, node):
 
 def latex_visit_argouml(self, node):
     '''Visit an argouml node during latex rendering.'''
-    render_latex(self, node, node['code'], node['options'])
+    render_latex(self, node)
 
 def setup(app):
     '''Register the services of this phix plug-in with Sphinx.'''
+    setup_cache(app)
+    setup_html(app)
+    setup_latex(app)
+    register_planner(app, 'argouml', plan_render, memory=argouml_memory)
     app.add_node(argouml,
-        html=(html_visit_argouml, None))
-        #latex=(latex_visit_argouml, None))
+        html=(html_visit_argouml, None),
+        latex=(latex_visit_argouml, None))
     app.add_directive('argouml', ArgoUmlDirective)
+    app.add_config_value('phix_argouml_daemon', False, '')
+    app.add_config_value('phix_argouml_daemon_timeout', 900, '')
+    app.add_config_value('phix_argouml_daemon_projects', 2, '')
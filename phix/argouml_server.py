@@ -0,0 +1,612 @@
+'''A long-lived ArgoUML render server.
+
+Every launch of ArgoUML pays for JVM startup and class loading, which takes
+several seconds even when all of the diagrams from a zargo file are exported
+together. The render server is started once by phix, or reused if one is
+already running, and accepts render requests from builds over a local socket.
+It shuts itself down after a period without requests.
+
+ArgoUML has no means of accepting commands once it is running, so the server
+can only keep a JVM warm if a worker command is available. Phix does not
+provide one. The worker command, given by the ARGOUML_WORKER_LAUNCH
+environment variable, must launch a JVM with ArgoUML loaded which reads
+ArgoUML commands such as::
+
+    org.argouml.uml.ui.ActionOpenProject=/path/to/model.zargo
+
+from stdin, one per line, and replies to each with a line beginning with OK or
+ERROR. The server keeps a worker for each of the most recently used projects,
+so a project is only reopened when it changes. Without a worker command the
+server would save nothing over a batch launch of ArgoUML, so it refuses to
+start, and builds do not use it.
+
+The command the server runs is fixed when it starts, from the
+ARGOUML_WORKER_LAUNCH variable of its own environment; a request can only
+name the project and diagrams to export. Each request also carries the worker
+command and the ArgoUML version of the build, by which the build keys its
+render cache. A server started with others refuses the request and exits once
+it is idle, and the build starts a new server with its own. The server
+records its address, and a token which each request must present, in a file
+readable only by the user, in $XDG_RUNTIME_DIR or otherwise ~/.cache/phix.
+
+The server is run with::
+
+    python -m phix.argouml_server
+'''
+
+import argparse
+import binascii
+import collections
+import errno
+import json
+import logging
+import os
+import shlex
+import socket
+import subprocess
+import sys
+import threading
+import time
+
+if sys.version_info.major == 2:
+    import SocketServer as socketserver
+else:
+    import socketserver
+
+from .argouml import argouml_version
+from .cache import remove_quietly
+from .phix import PhixError
+
+log = logging.getLogger('phix.argouml_server')
+logging.basicConfig()
+
+OPEN_PROJECT = 'org.argouml.uml.ui.ActionOpenProject'
+GOTO_DIAGRAM = 'org.argouml.ui.cmd.ActionGotoDiagram'
+SAVE_GRAPHICS = 'org.argouml.uml.ui.ActionSaveGraphics'
+
+# How long a client waits for a newly launched server to start listening.
+STARTUP_TIMEOUT = 10.0
+
+
+def runtime_directory():
+    '''The directory in which the address of the server is recorded.
+
+    Returns:
+        The directory named by the XDG_RUNTIME_DIR environment variable if it
+        is set, otherwise ~/.cache/phix, which is created readable only by the
+        user.
+
+    Raises:
+        PhixError: If the directory could not be created.
+    '''
+    directory = os.environ.get('XDG_RUNTIME_DIR') or os.path.join(
+        os.path.expanduser('~'), '.cache', 'phix')
+    if not os.path.isdir(directory):
+        try:
+            os.makedirs(directory, 0o700)
+        except OSError as e:
+            if not os.path.isdir(directory):
+                raise PhixError('Could not create {0}: {1}'.format(directory, e))
+    return directory
+
+def address_path():
+    '''The path of the file in which a running server records its address.'''
+    return os.path.join(runtime_directory(), 'phix-argouml-server.json')
+
+def create_exclusively(path):
+    '''Create a file readable only by the user, failing if it already exists.
+
+    Returns:
+        A file object open for writing, or None if the file already exists.
+
+    Raises:
+        PhixError: If the file could not be created for another reason.
+    '''
+    try:
+        descriptor = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+    except OSError as e:
+        if e.errno == errno.EEXIST:
+            return None
+        raise PhixError('Could not create {0}: {1}'.format(path, e))
+    return os.fdopen(descriptor, 'w')
+
+def is_recent(path):
+    '''Determine whether a file was written within STARTUP_TIMEOUT seconds, so
+    that it may belong to a server which is still starting.'''
+    try:
+        return time.time() - os.path.getmtime(path) < STARTUP_TIMEOUT
+    except OSError:
+        return False
+
+def worker_command():
+    '''Get a command for launching an ArgoUML worker.
+
+    Returns:
+        A list of command line arguments based on the ARGOUML_WORKER_LAUNCH
+        environment variable, or None if it is not set.
+    '''
+    if 'ARGOUML_WORKER_LAUNCH' in os.environ:
+        return shlex.split(os.environ['ARGOUML_WORKER_LAUNCH'])
+    return None
+
+
+class Worker(object):
+    '''A warm ArgoUML JVM with at most one project open.'''
+
+    def __init__(self, command):
+        '''
+        Args:
+            command: A list of command line arguments which launch a worker.
+
+        Raises:
+            PhixError: If the worker could not be launched.
+        '''
+        log.info("Launching worker {0}".format(' '.join(command)))
+        try:
+            self.process = subprocess.Popen(command,
+                                            stdin=subprocess.PIPE,
+                                            stdout=subprocess.PIPE,
+                                            universal_newlines=True)
+        except OSError as e:
+            raise PhixError('Could not launch ArgoUML worker with command {0}: {1}'.format(
+                ' '.join(command), e))
+        self.project = None
+        # Held while the worker renders, and while it is closed.
+        self.lock = threading.Lock()
+        self.closed = False
+
+    def perform(self, action, argument):
+        '''Perform one ArgoUML command.
+
+        Raises:
+            PhixError: If the command failed or the worker has exited.
+        '''
+        try:
+            self.process.stdin.write('{0}={1}\n'.format(action, argument))
+            self.process.stdin.flush()
+            reply = self.process.stdout.readline()
+        except (IOError, OSError) as e:
+            raise PhixError('Lost contact with ArgoUML worker: {0}'.format(e))
+        if not reply:
+            raise PhixError('The ArgoUML worker exited')
+        if not reply.startswith('OK'):
+            raise PhixError('ArgoUML could not perform {0}={1}: {2}'.format(
+                action, argument, reply.strip()))
+
+    def render(self, zargo_uri, diagrams):
+        '''Export diagrams from a project, opening it only if it has changed
+        since this worker last opened it.
+
+        Args:
+            zargo_uri: The path to the ArgoUML zargo file.
+
+            diagrams: A sequence of (diagram_name, output_path) pairs. As with a
+                batch launch of ArgoUML, diagrams which could not be exported
+                are not reported; their output files are simply not created.
+        '''
+        project = (zargo_uri, os.stat(zargo_uri).st_mtime)
+        if self.project != project:
+            self.project = None
+            self.perform(OPEN_PROJECT, zargo_uri)
+            self.project = project
+        for diagram_name, output_path in diagrams:
+            try:
+                self.perform(GOTO_DIAGRAM, diagram_name)
+                self.perform(SAVE_GRAPHICS, output_path)
+            except PhixError:
+                if self.process.poll() is not None:
+                    raise
+                log.info('Could not render {0}'.format(diagram_name),
+                         exc_info=sys.exc_info())
+
+    def close(self):
+        '''Ask the worker to exit, and make sure that it does. The caller
+        should hold its lock.'''
+        self.closed = True
+        try:
+            self.process.stdin.close()
+        except (IOError, OSError):
+            pass
+        for _ in range(50):
+            if self.process.poll() is not None:
+                return
+            time.sleep(0.1)
+        self.process.kill()
+
+
+class RenderServer(socketserver.ThreadingMixIn, socketserver.TCPServer):
+    '''Serves render requests, one JSON object per line, on a local socket.'''
+
+    daemon_threads = True
+
+    def __init__(self, idle_timeout, max_projects, worker_command, version=None):
+        '''
+        Args:
+            idle_timeout: The number of seconds without requests after which the
+                server exits.
+
+            max_projects: The number of projects to keep open in warm workers.
+
+            worker_command: The command which launches a worker.
+
+            version: The ArgoUML version which the worker runs, as given by
+                argouml_version(), which is used if version is None.
+        '''
+        socketserver.TCPServer.__init__(self, ('127.0.0.1', 0), RequestHandler)
+        self.timeout = min(1.0, idle_timeout)
+        self.idle_timeout = idle_timeout
+        self.max_projects = max_projects
+        self.worker_command = worker_command
+        self.version = argouml_version() if version is None else version
+        self.retiring = False
+        self.token = binascii.hexlify(os.urandom(16)).decode('ascii')
+        self.workers = collections.OrderedDict()
+        self.workers_lock = threading.Lock()
+        self.activity_lock = threading.Lock()
+        self.active_requests = 0
+        self.last_activity = time.time()
+        self.stopping = False
+
+    def begin_request(self):
+        with self.activity_lock:
+            self.active_requests += 1
+            self.last_activity = time.time()
+
+    def end_request(self):
+        with self.activity_lock:
+            self.active_requests -= 1
+            self.last_activity = time.time()
+
+    def is_idle(self):
+        '''Determine whether the server has been idle for idle_timeout
+        seconds.'''
+        with self.activity_lock:
+            return (self.active_requests == 0 and
+                    time.time() - self.last_activity > self.idle_timeout)
+
+    def is_retired(self):
+        '''Determine whether the server is retiring and has finished serving
+        its requests.'''
+        with self.activity_lock:
+            return self.retiring and self.active_requests == 0
+
+    def serves(self, request):
+        '''Determine whether a render request is from a build with the same
+        worker command and ArgoUML version as the server.'''
+        return (request.get('worker') == self.worker_command and
+                request.get('version') == self.version)
+
+    def worker(self, zargo_uri):
+        '''Get the warm worker for a project, launching one if necessary and
+        closing the least recently used workers if there are too many, once
+        any renders they are serving have finished.'''
+        stale_workers = []
+        with self.workers_lock:
+            worker = self.workers.pop(zargo_uri, None)
+            if worker is None or worker.process.poll() is not None:
+                worker = Worker(self.worker_command)
+            self.workers[zargo_uri] = worker
+            while len(self.workers) > self.max_projects:
+                stale_workers.append(self.workers.popitem(last=False)[1])
+        for stale_worker in stale_workers:
+            with stale_worker.lock:
+                stale_worker.close()
+        return worker
+
+    def render(self, request):
+        '''Serve a render request, with the worker command given to the server
+        rather than any in the request.'''
+        while True:
+            worker = self.worker(request['zargo'])
+            with worker.lock:
+                # The worker may have been evicted by another request since it
+                # was got, in which case another is got.
+                if not worker.closed:
+                    worker.render(request['zargo'], request['diagrams'])
+                    return
+
+    def record_address(self, address_path):
+        '''Record the address of the server, unless another server is running.
+
+        The file is created exclusively, so that of two servers started at once
+        only one serves. A file left by a server which did not exit cleanly is
+        replaced.
+
+        Raises:
+            PhixError: If another server is running or starting, or the address
+                could not be recorded.
+        '''
+        host, port = self.server_address
+        while True:
+            address_file = create_exclusively(address_path)
+            if address_file is not None:
+                break
+            if connect(address_path) is not None or is_recent(address_path):
+                raise PhixError('Another render server is recorded in {0}'.format(address_path))
+            remove_quietly(address_path)
+        with address_file:
+            json.dump({'host': host,
+                       'port': port,
+                       'token': self.token,
+                       'pid': os.getpid()},
+                      address_file)
+
+    def serve(self, address_path):
+        '''Record the address of the server and serve requests until the server
+        has been idle for idle_timeout seconds or is asked to stop.
+
+        Raises:
+            PhixError: If another server is running or starting.
+        '''
+        try:
+            self.record_address(address_path)
+        except PhixError:
+            self.server_close()
+            raise
+        log.info('Serving on {0}:{1}'.format(*self.server_address))
+
+        try:
+            while not self.stopping:
+                self.handle_request()
+                if self.is_idle():
+                    log.info('Idle for {0} seconds; exiting'.format(self.idle_timeout))
+                    break
+                if self.is_retired():
+                    log.info('Retired; exiting')
+                    break
+        finally:
+            self.server_close()
+            with self.workers_lock:
+                workers = list(self.workers.values())
+                self.workers.clear()
+            for worker in workers:
+                with worker.lock:
+                    worker.close()
+            # Only remove the address file if it still refers to this server.
+            try:
+                with open(address_path, 'r') as address_file:
+                    if json.load(address_file).get('token') == self.token:
+                        os.remove(address_path)
+            except (IOError, OSError, ValueError):
+                pass
+
+
+class RequestHandler(socketserver.StreamRequestHandler):
+    '''Handles the requests on one connection to the render server.'''
+
+    def handle(self):
+        for line in self.rfile:
+            self.server.begin_request()
+            try:
+                response = self.respond(json.loads(line.decode('utf-8')))
+            except Exception as e:
+                response = {'ok': False, 'error': str(e)}
+            finally:
+                self.server.end_request()
+            self.wfile.write((json.dumps(response) + '\n').encode('utf-8'))
+            self.wfile.flush()
+
+    def respond(self, request):
+        if request.get('token') != self.server.token:
+            return {'ok': False, 'error': 'Invalid token'}
+        command = request.get('command')
+        if command == 'ping':
+            return {'ok': True}
+        if command == 'stop':
+            self.server.stopping = True
+            return {'ok': True}
+        if command == 'render':
+            if self.server.retiring or not self.server.serves(request):
+                # The renderings of another ArgoUML would be cached under the
+                # version of the build, so the server makes way for one
+                # started by the build.
+                self.server.retiring = True
+                return {'ok': False,
+                        'retired': True,
+                        'error': 'The render server runs another ArgoUML worker or version'}
+            self.server.render(request)
+            return {'ok': True}
+        return {'ok': False, 'error': 'Unknown command {0!r}'.format(command)}
+
+
+def connect(path=None):
+    '''Connect to the running render server.
+
+    Args:
+        path: The path of the address file, or None for address_path().
+
+    Returns:
+        A (socket, token) pair, or None if no server is running.
+    '''
+    try:
+        with open(path or address_path(), 'r') as address_file:
+            address = json.load(address_file)
+        connection = socket.create_connection((address['host'], address['port']), timeout=5.0)
+    except (IOError, OSError, ValueError, KeyError, PhixError):
+        return None
+    connection.settimeout(None)
+    return connection, address['token']
+
+_launch_lock = threading.Lock()
+
+def acquire_launch_lock(lock_path):
+    '''Try to become the only build which launches a render server.
+
+    A lock older than STARTUP_TIMEOUT, left by a build which stopped while
+    launching a server, is broken.
+
+    Returns:
+        True if the lock was acquired, or False if another build holds it.
+    '''
+    for _ in range(2):
+        lock_file = create_exclusively(lock_path)
+        if lock_file is not None:
+            lock_file.close()
+            return True
+        if is_recent(lock_path):
+            return False
+        remove_quietly(lock_path)
+    return False
+
+def connect_or_launch(idle_timeout, max_projects):
+    '''Connect to the render server, launching it if none is running.
+
+    Only one thread of a build, and one of any builds running at once,
+    launches a server; the others wait for it to start.
+
+    Returns:
+        A (socket, token) pair.
+
+    Raises:
+        PhixError: If the server could not be started.
+    '''
+    connected = connect()
+    if connected is not None:
+        return connected
+    with _launch_lock:
+        connected = connect()
+        if connected is not None:
+            return connected
+        lock_path = address_path() + '.lock'
+        launching = acquire_launch_lock(lock_path)
+        try:
+            if launching:
+                launch(idle_timeout, max_projects)
+            deadline = time.time() + STARTUP_TIMEOUT
+            while connected is None and time.time() < deadline:
+                time.sleep(0.1)
+                connected = connect()
+        finally:
+            if launching:
+                remove_quietly(lock_path)
+    if connected is None:
+        raise PhixError('Could not start the ArgoUML render server')
+    return connected
+
+def launch(idle_timeout, max_projects):
+    '''Launch a render server in the background.'''
+    command = [sys.executable, '-m', 'phix.argouml_server',
+               '--idle-timeout', str(idle_timeout),
+               '--max-projects', str(max_projects)]
+    log.info('Launching render server with command {0}'.format(' '.join(command)))
+    kwargs = {}
+    if hasattr(os, 'setsid'):
+        # Detach the server so that it outlives the build.
+        kwargs['preexec_fn'] = os.setsid
+    with open(os.devnull, 'r+b') as devnull:
+        subprocess.Popen(command,
+                         stdin=devnull,
+                         stdout=devnull,
+                         stderr=devnull,
+                         close_fds=True,
+                         **kwargs)
+
+def request(message, idle_timeout=900, max_projects=2):
+    '''Send a request to the render server, launching it if necessary.
+
+    Args:
+        message: A dictionary describing the request.
+
+        idle_timeout: The idle timeout of any server which is launched.
+
+        max_projects: The number of warm projects of any server which is
+            launched.
+
+    Returns:
+        The response dictionary.
+
+    Raises:
+        PhixError: If the server could not be reached.
+    '''
+    connection, token = connect_or_launch(idle_timeout, max_projects)
+    message = dict(message, token=token)
+    try:
+        connection.sendall((json.dumps(message) + '\n').encode('utf-8'))
+        response = connection.makefile('rb').readline()
+    except (IOError, OSError) as e:
+        raise PhixError('Lost contact with the ArgoUML render server: {0}'.format(e))
+    finally:
+        connection.close()
+    if not response:
+        raise PhixError('The ArgoUML render server closed the connection')
+    return json.loads(response.decode('utf-8'))
+
+def wait_for_exit():
+    '''Wait for up to STARTUP_TIMEOUT seconds for a retiring render server to
+    exit, so that another can be started.'''
+    deadline = time.time() + STARTUP_TIMEOUT
+    while time.time() < deadline:
+        connected = connect()
+        if connected is None:
+            return
+        connected[0].close()
+        time.sleep(0.1)
+
+def render(zargo_uri, diagrams, idle_timeout=900, max_projects=2):
+    '''Export diagrams from a zargo file using the render server.
+
+    Args:
+        zargo_uri: The path to the ArgoUML zargo file.
+
+        diagrams: A sequence of (diagram_name, output_path) pairs.
+
+        idle_timeout: The idle timeout of any server which is launched.
+
+        max_projects: The number of warm projects of any server which is
+            launched.
+
+    Raises:
+        PhixError: If the server could not render the diagrams.
+    '''
+    message = {'command': 'render',
+               'zargo': os.path.abspath(zargo_uri),
+               'diagrams': [(diagram_name, os.path.abspath(output_path))
+                            for diagram_name, output_path in diagrams],
+               'worker': worker_command(),
+               'version': argouml_version()}
+    for _ in range(2):
+        response = request(message, idle_timeout, max_projects)
+        if not response.get('retired'):
+            break
+        # The server was started by a build with another ArgoUML, so start a
+        # new one once it has exited.
+        log.info('Restarting the ArgoUML render server: {0}'.format(response.get('error')))
+        wait_for_exit()
+    if not response.get('ok'):
+        raise PhixError('The ArgoUML render server could not render {0}: {1}'.format(
+            zargo_uri, response.get('error')))
+
+def main(argv=None):
+    '''Run the ArgoUML render server, or stop a running one.'''
+    parser = argparse.ArgumentParser(prog='python -m phix.argouml_server',
+                                     description='Serve ArgoUML render requests from phix.')
+    parser.add_argument('--idle-timeout', type=float, default=900,
+                        help='Exit after this many seconds without requests.')
+    parser.add_argument('--max-projects', type=int, default=2,
+                        help='The number of projects to keep open in warm workers.')
+    parser.add_argument('--stop', action='store_true',
+                        help='Stop the running server.')
+    args = parser.parse_args(argv)
+
+    if args.stop:
+        connected = connect()
+        if connected is not None:
+            connected[0].close()
+            request({'command': 'stop'})
+        return 0
+
+    if worker_command() is None:
+        parser.error('ARGOUML_WORKER_LAUNCH must name an ArgoUML worker; '
+                     'without one there is no JVM to keep warm')
+
+    server = RenderServer(args.idle_timeout,
+                          args.max_projects,
+                          worker_command())
+    try:
+        server.serve(address_path())
+    except PhixError as e:
+        log.info(str(e))
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,668 @@
+'''A content-addressed cache of rendered diagrams.
+
+Rendered graphics are stored under a key derived from everything which can
+affect the rendering - the bytes of the source file, the name of the diagram,
+the render-affecting directive options and the version of the rendering tool.
+A diagram whose key is already present in the cache need never be rendered
+again.
+
+The cache directory may be shared between builds, branches and checkouts on
+the same machine, in the manner of ccache. It is chosen by the PHIX_CACHE_DIR
+environment variable or the phix_cache_dir configuration value, and is kept
+below a size limit by evicting the least recently used entries. Run::
+
+    python -m phix.cache --stats
+
+to report on the contents of a cache.
+'''
+
+import argparse
+import hashlib
+import json
+import logging
+import os
+import re
+import shutil
+import sys
+import tempfile
+import threading
+
+from sphinx.util.osutil import ensuredir
+
+from .phix import PhixError
+
+log = logging.getLogger('phix.cache')
+logging.basicConfig()
+
+# The name of a subdirectory of the cache, which holds the entries whose keys
+# begin with it.
+ENTRY_DIRECTORY_EXPR = re.compile(r'^[0-9a-f]{2}$')
+
+# The name of a file of an entry, which is its key followed by a suffix.
+ENTRY_FILE_EXPR = re.compile(r'^[0-9a-f]+\.')
+
+
+def cache_key(source_path, *parts):
+    '''Compute a cache key for a rendering of a source file.
+
+    Args:
+        source_path: The path to the diagram source file. The bytes of the file,
+            rather than its name or modification time, contribute to the key.
+
+        parts: Any further values which affect the rendering, such as the
+            diagram name, directive options and the tool version. None values
+            are permitted.
+
+    Returns:
+        A string containing a hexadecimal digest.
+
+    Raises:
+        PhixError: If the source file could not be read.
+    '''
+    digest = hashlib.sha1()
+    try:
+        with open(source_path, 'rb') as source_file:
+            for chunk in iter(lambda: source_file.read(65536), b''):
+                digest.update(chunk)
+    except (IOError, OSError) as e:
+        raise PhixError('Could not read {0}: {1}'.format(source_path, e))
+
+    return content_key(digest, *parts)
+
+
+def content_key(digest, *parts):
+    '''Complete a cache key from the digest of the bytes of a source, as
+    cache_key() would compute it, for a source which is digested as it is
+    produced rather than read from a file.
+
+    Args:
+        digest: A hashlib.sha1 object which has been updated with the bytes of
+            the source. It is updated further.
+
+        parts: Any further values which affect the rendering, as for
+            cache_key().
+
+    Returns:
+        A string containing a hexadecimal digest.
+    '''
+    for part in parts:
+        digest.update(b'\0')
+        digest.update(repr(part).encode('utf-8'))
+
+    return digest.hexdigest()
+
+
+def alias_key(*parts):
+    '''Compute a cache key which does not depend upon the contents of a file.
+
+    An alias key names a cache entry by where it came from - for example the
+    path of a source file - rather than by its contents, so that the entry
+    can be found again after the source has changed.
+
+    Args:
+        parts: The values which identify the entry.
+
+    Returns:
+        A string containing a hexadecimal digest.
+    '''
+    digest = hashlib.sha1(b'alias')
+    for part in parts:
+        digest.update(b'\0')
+        digest.update(repr(part).encode('utf-8'))
+    return digest.hexdigest()
+
+
+class RenderCache(object):
+    '''A directory of rendered diagrams indexed by cache key.
+
+    Entries are stored as ``<directory>/<xx>/<key><suffix>`` where ``xx`` is
+    the first two characters of the key, so that no single directory becomes
+    too large. The modification time of an entry records when it was last
+    used, which is the basis of least recently used eviction. An entry may be
+    accompanied by metadata, such as when it was rendered, which is stored
+    alongside it as ``<key>.json``. The files which share a key, such as a
+    rendering and its metadata, or the compressed copies of a rendering, are
+    evicted together.
+    '''
+
+    stats_filename = 'stats.json'
+
+    def __init__(self, directory, max_size=None):
+        '''
+        Args:
+            directory: The directory in which the cache entries are stored. It
+                will be created if it does not exist.
+
+            max_size: The size in bytes to which the cache is reduced by
+                evict(), or None for no limit.
+        '''
+        self.directory = directory
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        # Renderings are stored and fetched by several threads at once.
+        self._lock = threading.Lock()
+
+    def path(self, key, suffix='.svg'):
+        '''The path at which the entry for key is, or would be, stored.'''
+        return os.path.join(self.directory, key[:2], key + suffix)
+
+    def __contains__(self, key):
+        return os.path.isfile(self.path(key))
+
+    def fetch(self, key, destination, suffix='.svg'):
+        '''Copy a cached rendering to destination.
+
+        Args:
+            key: The cache key of the rendering.
+
+            destination: The path to which the cached rendering is copied.
+
+            suffix: The suffix of the cache entry.
+
+        Returns:
+            True if the rendering was in the cache and has been copied to
+            destination, otherwise False.
+        '''
+        entry_path = self.path(key, suffix)
+        if not os.path.isfile(entry_path):
+            log.info('Cache miss for {0}'.format(key))
+            with self._lock:
+                self.misses += 1
+            return False
+
+        log.info('Cache hit for {0}'.format(key))
+        with self._lock:
+            self.hits += 1
+        ensuredir(os.path.dirname(destination))
+        shutil.copyfile(entry_path, destination)
+        touch(entry_path)
+        touch(self.path(key, '.json'))
+        return True
+
+    def metadata(self, key):
+        '''Read the metadata stored with a cache entry.
+
+        Returns:
+            A dictionary, or None if no metadata was stored with the entry.
+        '''
+        try:
+            with open(self.path(key, '.json'), 'r') as metadata_file:
+                return json.load(metadata_file)
+        except (IOError, OSError, ValueError):
+            return None
+
+    def store(self, key, source, suffix='.svg', metadata=None):
+        '''Store a rendering in the cache.
+
+        The entry is written to a uniquely named temporary file and then
+        renamed into place, so that a partially written entry can never be
+        fetched, and several threads or builds may store the same entry at
+        once.
+
+        Args:
+            key: The cache key of the rendering.
+
+            source: The path to the rendered file.
+
+            suffix: The suffix of the cache entry.
+
+            metadata: An optional dictionary, which must be serializable as
+                JSON, to store with the entry. Any metadata stored with a
+                previous rendering under the same key is removed if this is
+                None.
+
+        Raises:
+            PhixError: If the rendering could not be stored.
+        '''
+        partial_path = self.begin_store(key, suffix)
+        try:
+            shutil.copyfile(source, partial_path)
+        except (IOError, OSError) as e:
+            remove_quietly(partial_path)
+            raise PhixError('Could not store {0} in the cache: {1}'.format(source, e))
+        self.finish_store(key, partial_path, suffix, metadata)
+        log.info('Stored {0} as {1}'.format(source, self.path(key, suffix)))
+
+    def begin_store(self, key, suffix='.svg'):
+        '''Begin to store a rendering in the cache as it is produced, rather
+        than from a file.
+
+        Args:
+            key: The cache key of the rendering.
+
+            suffix: The suffix of the cache entry.
+
+        Returns:
+            The path to a temporary file beside the entry, into which the
+            rendering is to be written before it is passed to finish_store(),
+            or removed if it is abandoned.
+
+        Raises:
+            PhixError: If the temporary file could not be created.
+        '''
+        entry_path = self.path(key, suffix)
+        try:
+            ensuredir(os.path.dirname(entry_path))
+            return partial_file(entry_path)
+        except (IOError, OSError) as e:
+            raise PhixError('Could not store {0} in the cache: {1}'.format(key, e))
+
+    def finish_store(self, key, partial_path, suffix='.svg', metadata=None):
+        '''Install a rendering written to the temporary file from
+        begin_store() as the entry for key.
+
+        Args:
+            key: The cache key of the rendering.
+
+            partial_path: The path returned by begin_store(). The file is
+                removed if it could not be installed.
+
+            suffix: The suffix of the cache entry.
+
+            metadata: Optional metadata, as for store().
+
+        Raises:
+            PhixError: If the rendering could not be stored.
+        '''
+        metadata_partial_path = None
+        try:
+            metadata_path = self.path(key, '.json')
+            if metadata is not None:
+                metadata_partial_path = partial_file(metadata_path)
+                with open(metadata_partial_path, 'w') as metadata_file:
+                    json.dump(metadata, metadata_file)
+                install(metadata_partial_path, metadata_path)
+            elif suffix == '.svg':
+                remove_quietly(metadata_path)
+            install(partial_path, self.path(key, suffix))
+        except (IOError, OSError) as e:
+            if metadata_partial_path is not None:
+                remove_quietly(metadata_partial_path)
+            remove_quietly(partial_path)
+            raise PhixError('Could not store {0} in the cache: {1}'.format(key, e))
+
+    def entries(self):
+        '''Find the entries in the cache.
+
+        The files which share a key, such as a rendering and its metadata, make
+        up one entry, which was last used when any of them was.
+
+        Returns:
+            A list of (paths, size, last_used) tuples, one for each entry,
+            where paths lists its files and size is their total size.
+        '''
+        entries = {}
+        if not os.path.isdir(self.directory):
+            return []
+        for subdirectory in os.listdir(self.directory):
+            subdirectory_path = os.path.join(self.directory, subdirectory)
+            if not os.path.isdir(subdirectory_path):
+                continue
+            for filename in os.listdir(subdirectory_path):
+                if filename.endswith('.partial'):
+                    continue
+                entry_path = os.path.join(subdirectory_path, filename)
+                try:
+                    stat = os.stat(entry_path)
+                except OSError:
+                    # Removed by a concurrent build.
+                    continue
+                key = filename.split('.', 1)[0]
+                paths, size, last_used = entries.get(key, ([], 0, 0))
+                entries[key] = (paths + [entry_path], size + stat.st_size, max(last_used, stat.st_mtime))
+        return list(entries.values())
+
+    def foreign_files(self):
+        '''Find the files and directories in the cache directory which the
+        cache does not own: anything but the entry subdirectories, the files of
+        the entries within them, and the statistics.
+
+        Returns:
+            A list of paths.
+        '''
+        foreign = []
+        if not os.path.isdir(self.directory):
+            return foreign
+        for name in os.listdir(self.directory):
+            path = os.path.join(self.directory, name)
+            if name == self.stats_filename or (name.startswith(self.stats_filename + '.') and
+                                               name.endswith('.partial')):
+                continue
+            if ENTRY_DIRECTORY_EXPR.match(name) and os.path.isdir(path):
+                foreign.extend(os.path.join(path, filename) for filename in os.listdir(path)
+                               if not (filename.startswith(name) and ENTRY_FILE_EXPR.match(filename)))
+            else:
+                foreign.append(path)
+        return foreign
+
+    def clear(self):
+        '''Remove every entry and the statistics from the cache, leaving the
+        cache directory itself.
+
+        Raises:
+            PhixError: If the cache directory holds anything which the cache
+                does not own, in which case it may well not be a cache at all,
+                and nothing is removed.
+        '''
+        foreign = self.foreign_files()
+        if foreign:
+            raise PhixError('{0} does not look like a phix render cache, since it holds {1}'.format(
+                self.directory, foreign[0]))
+        if not os.path.isdir(self.directory):
+            return
+        for name in os.listdir(self.directory):
+            path = os.path.join(self.directory, name)
+            if os.path.isdir(path):
+                for filename in os.listdir(path):
+                    remove_quietly(os.path.join(path, filename))
+                try:
+                    os.rmdir(path)
+                except OSError:
+                    # An entry was stored by a concurrent build.
+                    pass
+            else:
+                remove_quietly(path)
+
+    def evict(self):
+        '''Remove least recently used entries until the cache is no larger
+        than max_size.
+
+        Returns:
+            The number of entries removed.
+        '''
+        if self.max_size is None:
+            return 0
+
+        entries = self.entries()
+        size = sum(entry_size for _, entry_size, _ in entries)
+        removed = 0
+        for entry_paths, _, _ in sorted(entries, key=lambda entry: entry[2]):
+            if size <= self.max_size:
+                break
+            for entry_path in entry_paths:
+                try:
+                    entry_size = os.path.getsize(entry_path)
+                    os.remove(entry_path)
+                except OSError:
+                    continue
+                log.info('Evicted {0}'.format(entry_path))
+                size -= entry_size
+            removed += 1
+        return removed
+
+    def load_stats(self):
+        '''Read the hit and miss counts accumulated by previous builds.
+
+        Returns:
+            A dictionary with 'hits' and 'misses' keys.
+        '''
+        try:
+            with open(os.path.join(self.directory, self.stats_filename), 'r') as stats_file:
+                stats = json.load(stats_file)
+        except (IOError, OSError, ValueError):
+            stats = {}
+        return {'hits': stats.get('hits', 0),
+                'misses': stats.get('misses', 0)}
+
+    def save_stats(self):
+        '''Add the hits and misses of this build to the accumulated counts.
+
+        Concurrent builds sharing the cache may occasionally lose each other's
+        counts; the statistics are informative rather than exact.
+        '''
+        with self._lock:
+            hits, misses = self.hits, self.misses
+            self.hits = self.misses = 0
+        if not (hits or misses):
+            return
+        stats = self.load_stats()
+        stats['hits'] += hits
+        stats['misses'] += misses
+
+        ensuredir(self.directory)
+        stats_path = os.path.join(self.directory, self.stats_filename)
+        partial_path = partial_file(stats_path)
+        with open(partial_path, 'w') as stats_file:
+            json.dump(stats, stats_file)
+        install(partial_path, stats_path)
+
+    def stats(self):
+        '''Summarise the contents and effectiveness of the cache.
+
+        Returns:
+            A dictionary with 'directory', 'size', 'max_size', 'entries',
+            'hits', 'misses' and 'hit_ratio' keys.
+        '''
+        entries = self.entries()
+        stats = self.load_stats()
+        lookups = stats['hits'] + stats['misses']
+        stats.update(directory=self.directory,
+                     size=sum(entry_size for _, entry_size, _ in entries),
+                     max_size=self.max_size,
+                     entries=len(entries),
+                     hit_ratio=float(stats['hits']) / lookups if lookups else None)
+        return stats
+
+
+def touch(path):
+    '''Mark a cache entry as recently used.'''
+    try:
+        os.utime(path, None)
+    except OSError:
+        pass
+
+
+def replace(source, destination):
+    '''Rename source to destination, replacing any existing destination.'''
+    try:
+        os.rename(source, destination)
+    except OSError:
+        # On Windows, rename will not replace an existing file.
+        if os.path.exists(destination):
+            os.remove(destination)
+        os.rename(source, destination)
+
+
+def partial_file(path):
+    '''Create an empty temporary file, with a name unique to the caller, in the
+    directory of path, to be written and then installed at path.
+
+    Returns:
+        The path to the temporary file, whose name ends with .partial.
+    '''
+    descriptor, partial_path = tempfile.mkstemp(prefix=os.path.basename(path) + '.',
+                                                suffix='.partial',
+                                                dir=os.path.dirname(path) or '.')
+    os.close(descriptor)
+    return partial_path
+
+
+def install(partial_path, path):
+    '''Rename a temporary file from partial_file() to path.
+
+    If the rename fails but path exists, another thread or build has installed
+    the same file at once, which is taken as success.
+
+    Raises:
+        OSError: If the file could not be installed.
+    '''
+    try:
+        replace(partial_path, path)
+    except OSError:
+        if not os.path.isfile(path):
+            raise
+        remove_quietly(partial_path)
+
+
+def remove_quietly(path):
+    '''Remove a file, if it exists.'''
+    try:
+        os.remove(path)
+    except OSError:
+        pass
+
+
+_size_units = {'': 1,
+               'K': 1024,
+               'M': 1024 ** 2,
+               'G': 1024 ** 3,
+               'T': 1024 ** 4}
+
+def parse_size(size):
+    '''Convert a size such as 500M or 2G into a number of bytes.
+
+    Args:
+        size: An integer number of bytes, a string with an optional K, M, G or T
+            suffix, or None.
+
+    Returns:
+        The number of bytes, or None if size is None or empty.
+
+    Raises:
+        PhixError: If size could not be understood.
+    '''
+    if size is None or isinstance(size, int):
+        return size
+    text = str(size).strip().upper()
+    if not text:
+        return None
+    unit = text[-1] if text[-1] in _size_units else ''
+    try:
+        return int(float(text[:len(text) - len(unit)]) * _size_units[unit])
+    except ValueError:
+        raise PhixError('Could not understand cache size {0!r}'.format(size))
+
+def cache_directory(config=None, doctreedir=None):
+    '''Determine the cache directory.
+
+    Args:
+        config: The Sphinx configuration, or None.
+
+        doctreedir: The doctree directory of the build, or None.
+
+    Returns:
+        The directory named by the PHIX_CACHE_DIR environment variable if it is
+        set, otherwise that named by the phix_cache_dir configuration value,
+        otherwise a directory within doctreedir.
+
+    Raises:
+        PhixError: If no directory could be determined.
+    '''
+    if os.environ.get('PHIX_CACHE_DIR'):
+        return os.path.expanduser(os.environ['PHIX_CACHE_DIR'])
+    if config is not None and config.phix_cache_dir:
+        return os.path.expanduser(config.phix_cache_dir)
+    if doctreedir is not None:
+        return os.path.join(doctreedir, 'phix')
+    raise PhixError('No phix cache directory specified. Use --dir or set PHIX_CACHE_DIR in your environment.')
+
+def cache_max_size(config=None):
+    '''Determine the size limit of the cache in bytes.
+
+    The PHIX_CACHE_SIZE environment variable takes precedence over the
+    phix_cache_size configuration value.
+    '''
+    if os.environ.get('PHIX_CACHE_SIZE'):
+        return parse_size(os.environ['PHIX_CACHE_SIZE'])
+    if config is not None:
+        return parse_size(config.phix_cache_size)
+    return None
+
+def get_cache(builder):
+    '''Get the render cache used by a builder.
+
+    Args:
+        builder: A Sphinx builder.
+
+    Returns:
+        A RenderCache instance which is shared by all of the phix extensions
+        for the duration of the build.
+    '''
+    cache = getattr(builder, 'phix_cache', None)
+    if cache is None:
+        cache = RenderCache(cache_directory(builder.config, builder.doctreedir),
+                            cache_max_size(builder.config))
+        builder.phix_cache = cache
+    return cache
+
+def build_finished(app, exception):
+    '''Record statistics and trim the cache at the end of a build.'''
+    cache = getattr(app.builder, 'phix_cache', None)
+    if cache is None:
+        return
+    cache.save_stats()
+    removed = cache.evict()
+    if removed:
+        log.info('Evicted {0} entries from {1}'.format(removed, cache.directory))
+
+def setup(app):
+    '''Register the configuration values and event handlers of the cache.
+
+    This is called from the setup() of each phix extension, so it does nothing
+    if the cache has already been set up.
+    '''
+    if 'phix_cache_dir' in app.config:
+        return
+    app.add_config_value('phix_cache_dir', None, '')
+    app.add_config_value('phix_cache_size', '1G', '')
+    app.connect('build-finished', build_finished)
+
+def format_size(size):
+    '''Format a number of bytes for people to read.'''
+    for unit in ('', 'K', 'M', 'G'):
+        if size < 1024:
+            break
+        size /= 1024.0
+    else:
+        unit = 'T'
+    return '{0:.1f}{1}'.format(size, unit) if unit else '{0}'.format(size)
+
+def main(argv=None):
+    '''Report on, trim or clear a phix render cache.'''
+    parser = argparse.ArgumentParser(prog='phix-cache',
+                                     description='Manage a phix render cache.')
+    parser.add_argument('--dir',
+                        help='The cache directory. Defaults to $PHIX_CACHE_DIR.')
+    parser.add_argument('--max-size',
+                        help='The size limit, such as 500M or 2G. Defaults to $PHIX_CACHE_SIZE.')
+    group = parser.add_mutually_exclusive_group()
+    group.add_argument('--stats', action='store_true',
+                       help='Report size, entry count and hit ratio (the default).')
+    group.add_argument('--evict', action='store_true',
+                       help='Evict least recently used entries down to the size limit.')
+    group.add_argument('--clear', action='store_true',
+                       help='Remove every entry and the statistics. Refuses if the directory '
+                            'holds anything else.')
+    args = parser.parse_args(argv)
+
+    try:
+        directory = os.path.expanduser(args.dir) if args.dir else cache_directory()
+        max_size = parse_size(args.max_size) if args.max_size else cache_max_size()
+    except PhixError as e:
+        parser.error(str(e))
+    cache = RenderCache(directory, max_size)
+
+    if args.clear:
+        try:
+            cache.clear()
+        except PhixError as e:
+            parser.error(str(e))
+        print('Cleared {0}'.format(directory))
+    elif args.evict:
+        print('Evicted {0} entries'.format(cache.evict()))
+    else:
+        stats = cache.stats()
+        print('cache directory  {0}'.format(stats['directory']))
+        print('entries          {0}'.format(stats['entries']))
+        print('size             {0}'.format(format_size(stats['size'])))
+        print('max size         {0}'.format(
+            format_size(stats['max_size']) if stats['max_size'] is not None else 'unlimited'))
+        print('hits             {0}'.format(stats['hits']))
+        print('misses           {0}'.format(stats['misses']))
+        print('hit ratio        {0}'.format(
+            '{0:.1%}'.format(stats['hit_ratio']) if stats['hit_ratio'] is not None else 'n/a'))
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,180 @@
+'''Writes precompressed forms of rendered diagrams alongside them.
+
+A web server such as nginx, with gzip_static and brotli_static, can send a
+diagram.svg.gz or diagram.svg.br written next to diagram.svg instead of
+compressing the diagram for each request. The phix_precompress configuration
+value lists the forms which phix writes for each diagram in HTML output:
+
+    gz    diagram.svg.gz, compressed with gzip
+    svgz  diagram.svgz, the same bytes under the name SVG tools expect
+    br    diagram.svg.br, compressed with brotli, which needs the brotli module
+
+Each form is compressed at the highest level, which is slow, so the compressed
+forms are kept in the render cache under the digest of the SVG. They are
+compressed by the render tasks, in parallel, as each diagram is rendered, and
+copied into place as the documents are written.
+'''
+
+import collections
+import gzip
+import io
+import logging
+import os
+import shutil
+import tempfile
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+from .cache import cache_key, get_cache, touch
+from .phix import PhixError, scratch_directory
+
+log = logging.getLogger('phix.compress')
+logging.basicConfig()
+
+# The suffix of the file written for each precompressed form, which is also the
+# suffix of its cache entry.
+FORMATS = collections.OrderedDict([('gz', '.svg.gz'),
+                                   ('svgz', '.svgz'),
+                                   ('br', '.svg.br')])
+
+# The algorithm with which each form is compressed.
+ALGORITHMS = {'gz': 'gzip',
+              'svgz': 'gzip',
+              'br': 'brotli'}
+
+
+def precompress_formats(builder):
+    '''Determine the precompressed forms to be written for each diagram.
+
+    Returns:
+        A tuple of names from FORMATS, from the phix_precompress configuration
+        value. It is empty unless the builder writes HTML.
+
+    Raises:
+        PhixError: If phix_precompress names an unknown form, or brotli is
+            requested but the brotli module is not installed.
+    '''
+    formats = getattr(builder.config, 'phix_precompress', None)
+    if not formats or getattr(builder, 'format', None) != 'html':
+        return ()
+    if hasattr(formats, 'split'):
+        formats = formats.split()
+    for format in formats:
+        if format not in FORMATS:
+            raise PhixError('phix_precompress may only contain {0}, not {1!r}'.format(
+                ', '.join(FORMATS), format))
+    if 'br' in formats and brotli is None:
+        raise PhixError('the brotli module is needed to write .svg.br files')
+    return tuple(formats)
+
+def compress(data, algorithm):
+    '''Compress data at the highest level of an algorithm.
+
+    Args:
+        data: The bytes to be compressed.
+
+        algorithm: Either 'gzip' or 'brotli'.
+
+    Returns:
+        The compressed bytes. Gzip output records no modification time, so that
+        compressing the same data always gives the same bytes.
+    '''
+    if algorithm == 'brotli':
+        return brotli.compress(data, mode=brotli.MODE_TEXT, quality=11)
+    buffer = io.BytesIO()
+    with gzip.GzipFile(filename='', mode='wb', compresslevel=9, fileobj=buffer, mtime=0) as gzip_file:
+        gzip_file.write(data)
+    return buffer.getvalue()
+
+def compressed_key(svg_path):
+    '''The cache key of the precompressed forms of an SVG file, which depends
+    only upon its contents.'''
+    return cache_key(svg_path, 'precompressed')
+
+def is_compressed(builder, svg_path, formats):
+    '''Determine whether all of the precompressed forms of an SVG file are in the
+    render cache.'''
+    cache = get_cache(builder)
+    key = compressed_key(svg_path)
+    return all(os.path.isfile(cache.path(key, FORMATS[format])) for format in formats)
+
+def compress_to_cache(builder, svg_path, formats):
+    '''Compress an SVG file into the render cache in each of several forms,
+    except those which are already cached.
+
+    Args:
+        builder: The Sphinx builder.
+
+        svg_path: The path to the SVG file.
+
+        formats: The names of the forms, from FORMATS.
+
+    Returns:
+        The cache key of the compressed forms.
+
+    Raises:
+        PhixError: If the SVG file could not be read or compressed, or a
+            compressed form could not be stored.
+    '''
+    cache = get_cache(builder)
+    key = compressed_key(svg_path)
+    missing = [format for format in formats if not os.path.isfile(cache.path(key, FORMATS[format]))]
+    if not missing:
+        return key
+
+    try:
+        with open(svg_path, 'rb') as svg_file:
+            data = svg_file.read()
+    except (IOError, OSError) as e:
+        raise PhixError('Could not read {0}: {1}'.format(svg_path, e))
+
+    output_dir = tempfile.mkdtemp(dir=scratch_directory(builder))
+    try:
+        compressed = {}
+        for format in missing:
+            algorithm = ALGORITHMS[format]
+            if algorithm not in compressed:
+                compressed[algorithm] = compress(data, algorithm)
+            output_path = os.path.join(output_dir, 'output' + FORMATS[format])
+            with open(output_path, 'wb') as output_file:
+                output_file.write(compressed[algorithm])
+            cache.store(key, output_path, suffix=FORMATS[format])
+        log.info('Compressed {0} from {1} bytes to {2}'.format(
+            svg_path,
+            len(data),
+            ', '.join('{0} bytes with {1}'.format(len(output), algorithm)
+                      for algorithm, output in sorted(compressed.items()))))
+    except (IOError, OSError) as e:
+        raise PhixError('Could not compress {0}: {1}'.format(svg_path, e))
+    finally:
+        shutil.rmtree(output_dir, ignore_errors=True)
+    return key
+
+def write_precompressed(builder, render_path):
+    '''Write the precompressed forms given by phix_precompress alongside a
+    rendered diagram, compressing it unless they are already cached.
+
+    Args:
+        builder: The Sphinx builder.
+
+        render_path: The path of the rendered SVG file, such as
+            _images/diagram.svg, alongside which the forms are written.
+
+    Raises:
+        PhixError: If the forms could not be written.
+    '''
+    formats = precompress_formats(builder)
+    if not formats:
+        return
+    cache = get_cache(builder)
+    key = compress_to_cache(builder, render_path, formats)
+    for format in formats:
+        entry_path = cache.path(key, FORMATS[format])
+        try:
+            shutil.copyfile(entry_path, os.path.splitext(render_path)[0] + FORMATS[format])
+        except (IOError, OSError) as e:
+            raise PhixError('Could not write {0}: {1}'.format(FORMATS[format], e))
+        touch(entry_path)
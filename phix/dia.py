@@ -1,4 +1,4 @@
-import logging, os, platform, posixpath, subprocess, shlex, string, sys
+import functools, logging, os, platform, posixpath, subprocess, shlex, shutil, sys, tempfile
 
 from docutils import nodes
 from docutils.parsers.rst import directives, states
@@ -7,10 +7,22 @@ from docutils.parsers.rst.roles import set_classes
 from sphinx.util.compat import Directive
 from sphinx.util.osutil import ensuredir
 
+from .cache import cache_key, get_cache, setup as setup_cache
+from .html import append_diagram, embed_option, setup as setup_html
+from .latex import append_latex_diagram, setup as setup_latex
 from .phix import (PhixError,
+                   note_render_job,
                    program_files_32,
                    relfn2path,
-                   temp_path)
+                   scratch_directory,
+                   tool_version)
+from .scheduler import (fetch_rendering,
+                        note_render_failure,
+                        plan_jobs,
+                        postprocess_jobs,
+                        register_planner,
+                        render_to_cache)
+from .thumbnail import thumbnail_option
 
 log = logging.getLogger('phix.dia')
 logging.basicConfig()
@@ -60,7 +72,9 @@ class DiaDirective(Directive):
                    'scale': directives.percentage,
                    'align': align,
                    'border': directives.positive_int,
-                   'class': directives.class_option}
+                   'class': directives.class_option,
+                   'embed': embed_option,
+                   'thumbnail': thumbnail_option}
 
     def run(self):
         '''Process the dia directive.
@@ -76,7 +90,10 @@ class DiaDirective(Directive):
         # name of the Dia file.
         reference = directives.uri(self.arguments[0])
         env = self.state.document.settings.env
-        _, filename = relfn2path(env, reference)
+        rel_filename, filename = relfn2path(env, reference)
+
+        # Rebuild this document, and only this document, when the source changes.
+        env.note_dependency(rel_filename)
 
         log.info('filename = {0}'.format(filename))
 
@@ -116,6 +133,12 @@ class DiaDirective(Directive):
         log.info("dia_node['new_window_flag'] = {0}".format(
                 dia_node['new_window_flag']))
 
+        # Defer rendering so that many diagrams can be exported by each
+        # launch of Dia once reading is complete.
+        note_render_job(env, 'dia', {'uri': dia_node['uri'],
+                                     'postprocess': self.options.get('postprocess'),
+                                     'thumbnail': self.options.get('thumbnail')})
+
         return messages + [dia_node]
 
 def get_image_filename(self, uri):
@@ -146,14 +169,11 @@ def get_image_filename(self, uri):
         refer_path = fname
         render_path = os.path.join(self.builder.outdir, fname)
 
-    if os.path.isfile(render_path):
-        return refer_path, render_path
-
     ensuredir(os.path.dirname(render_path))
 
     return refer_path, render_path
 
-def create_graphics(self, dia_uri, render_path, postprocess_command=None):
+def create_graphics(dia_uri, render_path):
     '''
     Use Dia in batch mode to render a diagram from a dia file into graphics of
     the specified format.
@@ -163,10 +183,6 @@ def create_graphics(self, dia_uri, render_path, postprocess_command=None):
 
         render_path: The path to which the graphics output is to be rendered.
 
-        postprocess_command: An optional command into which the Dia SVG
-           output will be piped before it is placed in the output document.
-           The command should accept SVG on stdin and produce SVG on stdout.
-
     Raises:
         PhixError: If the graphics could not be rendered.
     '''
@@ -175,12 +191,39 @@ def create_graphics(self, dia_uri, render_path, postprocess_command=None):
     log.info("dia_uri = {0}".format(dia_uri))
     log.info("render_path = {0}".format(render_path))
 
-    output_path = render_path if postprocess_command is None else temp_path('.svg')
-    log.info("output_path = {0}".format(output_path))
-
     # Launch Dia and instruct it to export the diagram as SVG
     args = [str(dia_uri),
-            '-e', str(output_path)]
+            '-e', str(render_path)]
+    command = dia_command() + args
+    log.info("command = {0}".format(command))
+    returncode = subprocess.call(command)
+    log.info("returncode = {0}".format(returncode))
+    if returncode != 0:
+        raise PhixError("Could not launch Dia with command {0}".format(' '.join(command)))
+
+def create_graphics_batch(dia_uris, output_dir):
+    '''
+    Use a single launch of Dia to render several dia files as SVG.
+
+    Args:
+        dia_uris: A sequence of paths to Dia files, no two of which may have
+            the same basename.
+
+        output_dir: The directory into which the SVG files are rendered. The
+            SVG rendered from each Dia file has the basename of the Dia file
+            and the extension .svg.
+
+    Raises:
+        PhixError: If Dia could not be run.
+    '''
+    log.info("create_graphics_batch()")
+    log.info("dia_uris = {0}".format(dia_uris))
+    log.info("output_dir = {0}".format(output_dir))
+
+    # Launch Dia and instruct it to export each diagram as SVG into the
+    # output directory
+    args = ['-t', 'svg',
+            '-O', str(output_dir)] + [str(dia_uri) for dia_uri in dia_uris]
     command = dia_command() + args
     log.info("command = {0}".format(command))
     returncode = subprocess.call(command)
@@ -188,31 +231,100 @@ def create_graphics(self, dia_uri, render_path, postprocess_command=None):
     if returncode != 0:
         raise PhixError("Could not launch Dia with command {0}".format(' '.join(command)))
 
-    # If a postprocess command has been specified
-    if postprocess_command is not None:
-        log.info("postprocess_command = {0}".format(postprocess_command))
-
-        # We use our own variable interpolation with the $VAR syntax rather than
-        # relying on the underlying shell, so that we can support the same
-        # variable syntax on both Windows and Linux.
-        postprocess_command_template = string.Template(str(postprocess_command))
-        interpolated_postprocess_command = postprocess_command_template.substitute(os.environ)
-        log.info("interpolated_postprocess_command = {0}".format(
-                interpolated_postprocess_command))
-
-        postprocess_command_fragments = shlex.split(interpolated_postprocess_command, posix=False)
-        log.info("postprocess_command_fragments = {0}".format(
-                postprocess_command_fragments))
-
-        with open(output_path, 'rb') as intermediate_file:
-            with open(render_path, 'wb') as render_file:
-                returncode = subprocess.call(postprocess_command_fragments, stdin=intermediate_file, stdout=render_file)
-                log.info("returncode = {0}".format(returncode))
-                if returncode != 0:
-                    raise PhixError("Could not launch postprocess with command {0}".format(' '.join(postprocess_command)))
-        if os.path.exists(output_path):
-            log.info("Removing {0}".format(output_path))
-            os.remove(output_path)
+def batch_output_path(dia_uri, output_dir):
+    '''The path of the SVG which create_graphics_batch() renders from a Dia file.'''
+    basename, _ = os.path.splitext(os.path.basename(dia_uri))
+    return os.path.join(output_dir, basename + '.svg')
+
+def make_batches(dia_uris, batch_size):
+    '''Divide Dia files into batches for create_graphics_batch().
+
+    Args:
+        dia_uris: A sequence of paths to distinct Dia files.
+
+        batch_size: The largest number of files in any batch.
+
+    Returns:
+        A list of lists of paths. No batch contains two files with the same
+        basename, since their outputs would collide.
+    '''
+    batches = []
+    for dia_uri in dia_uris:
+        basename = os.path.basename(batch_output_path(dia_uri, ''))
+        for batch in batches:
+            if (len(batch) < batch_size and
+                basename not in (os.path.basename(batch_output_path(other, '')) for other in batch)):
+                batch.append(dia_uri)
+                break
+        else:
+            batches.append([dia_uri])
+    return batches
+
+def plan_render(app, jobs):
+    '''Plan the rendering of Dia diagrams.
+
+    Each task renders a batch of at most phix_dia_batch_size uncached diagrams
+    with a single launch of Dia. Diagrams which are cached, but not with the
+    postprocess they need, are postprocessed without launching Dia.
+
+    Args:
+        app: The Sphinx application.
+
+        jobs: The dia render jobs recorded by the documents.
+
+    Returns:
+        A list of render tasks.
+    '''
+    # Jobs which differ only in their postprocess command share a rendering.
+    unrendered, tasks = plan_jobs(app.builder, jobs, render_key)
+    jobs_by_uri = {}
+    for key, key_jobs in unrendered.items():
+        jobs_by_uri.setdefault(key_jobs[0]['uri'], {})[key] = key_jobs
+
+    batch_size = max(1, int(app.config.phix_dia_batch_size))
+    return tasks + [functools.partial(render_batch,
+                                      app,
+                                      dict((dia_uri, jobs_by_uri[dia_uri]) for dia_uri in batch))
+                    for batch in make_batches(sorted(jobs_by_uri), batch_size)]
+
+def render_batch(app, jobs_by_uri):
+    '''Render a batch of Dia files into the render cache.
+
+    Any file which the batch fails to render is rendered on its own, so that
+    the reason for its failure can be reported.
+
+    Args:
+        app: The Sphinx application.
+
+        jobs_by_uri: A dictionary mapping each Dia file to a dictionary, keyed
+            by cache key, of the lists of render jobs which need its rendering.
+    '''
+    log.info('Rendering {0} diagrams with Dia'.format(len(jobs_by_uri)))
+    cache = get_cache(app.builder)
+    output_dir = tempfile.mkdtemp(dir=scratch_directory(app.builder))
+    try:
+        try:
+            create_graphics_batch(list(jobs_by_uri), output_dir)
+        except PhixError:
+            log.info('Could not render diagrams with Dia',
+                     exc_info=sys.exc_info())
+
+        for dia_uri, jobs in jobs_by_uri.items():
+            output_path = batch_output_path(dia_uri, output_dir)
+            for key, key_jobs in jobs.items():
+                if not os.path.exists(output_path):
+                    if not render_to_cache(app.builder, key,
+                                           functools.partial(create_graphics, dia_uri)):
+                        continue
+                else:
+                    try:
+                        cache.store(key, output_path)
+                    except PhixError:
+                        note_render_failure(app.builder, key, str(sys.exc_info()[1]))
+                        continue
+                postprocess_jobs(app.builder, key, key_jobs)
+    finally:
+        shutil.rmtree(output_dir, ignore_errors=True)
 
 def dia_command():
     '''Get a command for launching Dia.
@@ -235,29 +347,34 @@ def dia_command():
 
     return ['dia']
 
-def render_html(self, node):
-    '''
-    Render the supplied node as HTML.
+def render_key(node):
+    '''Compute the render cache key for the rendering of a dia node by Dia,
+    before any postprocess.'''
+    return cache_key(node['uri'],
+                     'dia',
+                     tool_version(dia_command()))
 
-    Note: This method *always* raises docutils.nodes.SkipNode to ensure that the
-        child nodes are not visited.
+def fetch_diagram(self, node):
+    '''
+    Fetch the rendering of the supplied node into the output directory.
 
     Args:
         node: An dia docutils node.
 
+    Returns:
+        A 2-tuple of the path by which the output refers to the rendering and
+        the path to which it was fetched, from get_image_filename().
+
     Raises:
-        SkipNode: Do not visit the current node's children, and do not call the
-        current node's ``depart_...`` method.
+        SkipNode: If the rendering could not be fetched, which has been
+        reported.
     '''
-    has_thumbnail = False
-
     try:
         refer_path, render_path = get_image_filename(self, node['uri'])
         log.info("refer_path = {0}".format(refer_path))
         log.info("render_path = {0}".format(render_path))
         log.info("node['uri'] = {0}".format(node['uri']))
-        #if not os.path.isfile(render_path):
-        create_graphics(self, node['uri'], render_path, node.get('postprocess'))
+        fetch_rendering(self.builder, render_key(node), node.get('postprocess'), render_path)
     except PhixError:
         exc = sys.exc_info()
         log.info('Could not render {0}'.format(node['uri']),
@@ -266,20 +383,42 @@ def render_html(self, node):
                 node['uri'],
                 exc[1]))
         raise nodes.SkipNode
+    return refer_path, render_path
+
+def render_html(self, node):
+    '''
+    Render the supplied node as HTML.
+
+    Note: This method *always* raises docutils.nodes.SkipNode to ensure that the
+        child nodes are not visited.
 
-    self.body.append(self.starttag(node, 'p', CLASS='dia'))
+    Args:
+        node: An dia docutils node.
 
-    objtag_format = '<object data="%s" width="%s" height="%s" border="%s" type="image/svg+xml" class="img">\n'
-    self.body.append(objtag_format % (refer_path, node['width'], node['height'], node['border']))
-    self.body.append('</object>')
+    Raises:
+        SkipNode: Do not visit the current node's children, and do not call the
+        current node's ``depart_...`` method.
+    '''
+    refer_path, render_path = fetch_diagram(self, node)
+    append_diagram(self, node, 'dia', refer_path, render_path)
+    raise nodes.SkipNode
 
-    if node['new_window_flag']:
-        self.body.append('<p align="right">\n')
-        new_window_tag_format = '<a href="{0}" target="_blank">Open in new window</a>'
-        self.body.append(new_window_tag_format.format(refer_path))
-        self.body.append('</p>\n')
+def render_latex(self, node):
+    '''
+    Render the supplied node as LaTeX, including the diagram as PDF.
 
-    self.body.append('</p>\n')
+    Note: This method *always* raises docutils.nodes.SkipNode to ensure that the
+        child nodes are not visited.
+
+    Args:
+        node: An dia docutils node.
+
+    Raises:
+        SkipNode: Do not visit the current node's children, and do not call the
+        current node's ``depart_...`` method.
+    '''
+    refer_path, render_path = fetch_diagram(self, node)
+    append_latex_diagram(self, node, render_path)
     raise nodes.SkipNode
 
 def html_visit_dia(self, node):
@@ -288,10 +427,16 @@ def html_visit_dia(self, node):
 
 def latex_visit_dia(self, node):
     '''Visit an dia node during latex rendering.'''
-    render_latex(self, node, node['code'], node['options'])
+    render_latex(self, node)
 
 def setup(app):
     '''Register the services of this plug-in with Sphinx.'''
+    setup_cache(app)
+    setup_html(app)
+    setup_latex(app)
+    register_planner(app, 'dia', plan_render)
     app.add_node(dia,
-        html=(html_visit_dia, None))
+        html=(html_visit_dia, None),
+        latex=(latex_visit_dia, None))
     app.add_directive('dia', DiaDirective)
+    app.add_config_value('phix_dia_batch_size', 50, '')
@@ -0,0 +1,803 @@
+'''Writes the markup which embeds rendered diagrams in HTML output.
+
+A diagram is embedded either as an ``<object>`` which refers to the SVG file
+in ``_images``, which is the default, or inline, with the SVG markup written
+directly into the page so that it costs no further request, or as a sprite,
+drawn with ``<use>`` from a symbol which each page, or the whole site, defines
+once however many times it is drawn. The phix_html_embed configuration value
+chooses between them for the whole build, and the ``:embed:`` option of each
+directive for one diagram.
+
+An ``<object>`` is given the aspect ratio of the diagram, read from the
+rendered SVG, so that the page does not reflow as diagrams load. With
+phix_html_lazy, it is replaced by an ``<img>`` with the intrinsic size of the
+diagram, which the browser loads only as it nears the viewport. A diagram
+with a thumbnail is shown as its thumbnail until it is clicked; see the
+thumbnail module. With phix_raster_formats, a diagram is embedded as a
+<picture> with raster fallbacks for clients which cannot draw SVG; see the
+raster module.
+'''
+
+import collections
+import hashlib
+import json
+import logging
+import os
+import posixpath
+import re
+import sys
+
+from xml.dom import minidom
+from xml.sax.saxutils import escape
+
+from docutils.parsers.rst import directives
+
+from sphinx.util.osutil import ensuredir
+
+from .cache import install, partial_file
+from .compress import write_precompressed
+from .phix import PhixError
+from .raster import MIME_TYPES, write_rasters
+from .svg import intrinsic_size, length_in_pixels, parse_svg, view_box
+from .thumbnail import thumbnail_width, write_thumbnail
+
+log = logging.getLogger('phix.html')
+logging.basicConfig()
+
+EMBED_VALUES = ('object', 'inline', 'sprite')
+SPRITE_SCOPES = ('page', 'site')
+
+# The name of the sprite file, in _images, with a site scope.
+SITE_SPRITE_FILENAME = 'phix-sprite.svg'
+
+# The name of the file, beside the entries of the site sprite, which records
+# the entries each page draws.
+SITE_SPRITE_INDEX = 'pages.json'
+
+SVG_NAMESPACE = 'http://www.w3.org/2000/svg'
+XLINK_NAMESPACE = 'http://www.w3.org/1999/xlink'
+
+REFERENCE_EXPR = re.compile(r'url\(\s*([\'"]?)#([^\'")\s]+)\1\s*\)')
+SELECTOR_NAME_EXPR = re.compile(r'([.#])(-?[_a-zA-Z][_a-zA-Z0-9-]*)')
+
+# The at-rules whose blocks hold further rules, rather than declarations.
+GROUP_RULES = ('@media', '@supports', '@document')
+
+# A selector which matches no element.
+NO_ELEMENT = ':not(*)'
+
+
+def embed_option(argument):
+    '''Convert and validate the :embed: option of a directive.'''
+    return directives.choice(argument, EMBED_VALUES)
+
+def embedding(builder, node):
+    '''Determine how a diagram is to be embedded.
+
+    Returns:
+        'object', 'inline' or 'sprite', from the :embed: option of the node, or otherwise
+        the phix_html_embed configuration value.
+    '''
+    embed = node.get('embed') or builder.config.phix_html_embed
+    if embed not in EMBED_VALUES:
+        raise PhixError('phix_html_embed must be one of {0}, not {1!r}'.format(
+            ', '.join(EMBED_VALUES), embed))
+    return embed
+
+def all_elements(root):
+    '''The root element of a document, followed by all of its descendants.'''
+    return [root] + list(root.getElementsByTagName('*'))
+
+def is_reference_attribute(name):
+    return name in ('href', 'xlink:href') or name.endswith(':href')
+
+def rename(elements, id_names, class_names=None):
+    '''Rename the ids and classes of elements, and all references to them.
+
+    Args:
+        elements: The elements in which ids, classes and references are to be
+            renamed.
+
+        id_names: A dictionary mapping ids to their new names. Ids which are
+            absent are not renamed.
+
+        class_names: A dictionary mapping classes to their new names. It
+            must name every class of the document, for the selectors of its
+            style sheets are renamed along with the classes; see
+            rename_selectors(). If it is None, classes and selectors are left
+            alone.
+
+    Raises:
+        PhixError: If a style sheet has a rule which would apply outside the
+            document.
+    '''
+    def rename_reference(match):
+        if match.group(2) not in id_names:
+            return match.group(0)
+        return 'url(#{0})'.format(id_names[match.group(2)])
+
+    for element in elements:
+        for name, value in list(element.attributes.items()):
+            if name == 'id':
+                value = id_names.get(value, value)
+            elif name == 'class' and class_names is not None:
+                value = ' '.join(class_names.get(class_name, class_name) for class_name in value.split())
+            elif is_reference_attribute(name):
+                if value.startswith('#') and value[1:] in id_names:
+                    value = '#' + id_names[value[1:]]
+            else:
+                value = REFERENCE_EXPR.sub(rename_reference, value)
+            element.setAttribute(name, value)
+        if element.localName == 'style':
+            for child in element.childNodes:
+                if child.nodeType in (child.TEXT_NODE, child.CDATA_SECTION_NODE):
+                    if class_names is None:
+                        child.data = REFERENCE_EXPR.sub(rename_reference, child.data)
+                    else:
+                        child.data = rename_style_sheet(child.data, id_names, class_names, rename_reference)
+
+def rename_selectors(text, id_names, class_names):
+    '''Rename the ids and classes in a list of selectors.
+
+    A selector which names an id or class that is not renamed can match
+    nothing in the diagram, so it is dropped, lest it match elements of the
+    page around the diagram.
+
+    Raises:
+        PhixError: If a selector names no id or class, such as rect or *,
+            which would apply to the whole page.
+    '''
+    selectors = []
+    for selector in text.split(','):
+        names = SELECTOR_NAME_EXPR.findall(selector)
+        if not names:
+            raise PhixError('The style sheet rule {0} would apply outside the diagram'.format(
+                selector.strip()))
+        if all(name in (id_names if kind == '#' else class_names) for kind, name in names):
+            selectors.append(SELECTOR_NAME_EXPR.sub(
+                lambda match: match.group(1) + (id_names if match.group(1) == '#' else class_names)[match.group(2)],
+                selector))
+    return ','.join(selectors) if selectors else NO_ELEMENT
+
+def rename_style_sheet(css, id_names, class_names, rename_reference):
+    '''Rename the ids and classes in the selectors of a style sheet, and the
+    references in its declarations; see rename_selectors().'''
+    output = []
+    # Whether each open block holds rules, rather than declarations.
+    blocks = []
+    prelude = ''
+    for part in re.split(r'([{}])', css):
+        if part == '{':
+            statements, separator, rule = prelude.rpartition(';')
+            output.append(statements + separator)
+            if rule.strip().startswith('@'):
+                output.append(rule)
+                blocks.append(rule.strip().lower().startswith(GROUP_RULES))
+            else:
+                output.append(rename_selectors(rule, id_names, class_names))
+                blocks.append(False)
+            output.append(part)
+            prelude = ''
+        elif part == '}':
+            output.append(REFERENCE_EXPR.sub(rename_reference, prelude))
+            output.append(part)
+            prelude = ''
+            if blocks:
+                blocks.pop()
+        elif blocks and not blocks[-1]:
+            output.append(REFERENCE_EXPR.sub(rename_reference, part))
+        else:
+            prelude += part
+    output.append(prelude)
+    return ''.join(output)
+
+def references(elements):
+    '''Find the ids to which elements refer.'''
+    ids = set()
+    for element in elements:
+        for name, value in element.attributes.items():
+            if is_reference_attribute(name):
+                if value.startswith('#'):
+                    ids.add(value[1:])
+            else:
+                ids.update(match.group(2) for match in REFERENCE_EXPR.finditer(value))
+    return ids
+
+def size_attributes(element, width=None, height=None, border=None):
+    '''Give an svg element the size at which a diagram is to be shown.
+
+    A height of 100% is ignored, so that the diagram keeps its aspect ratio.
+    '''
+    if width:
+        element.setAttribute('width', str(width))
+        if (not height or str(height) == '100%') and element.hasAttribute('height'):
+            element.removeAttribute('height')
+    if height and str(height) != '100%':
+        element.setAttribute('height', str(height))
+    if border:
+        style = element.getAttribute('style').rstrip('; ')
+        element.setAttribute('style', '{0}border: {1}px solid'.format(
+            style + '; ' if style else '', border))
+
+def object_markup(node, refer_path, size=None):
+    '''The markup which embeds a diagram as an <object>.
+
+    Args:
+        node: The phix docutils node.
+
+        refer_path: The URI by which the page refers to the rendered SVG.
+
+        size: The intrinsic size of the diagram from intrinsic_size(), or None.
+            Unless the node is given a height, the <object> is given the aspect
+            ratio of the diagram, so that its height is known before it loads.
+    '''
+    if size is None or str(node['height']) != '100%':
+        objtag_format = '<object data="%s" width="%s" height="%s" border="%s" type="image/svg+xml" class="img">\n'
+        return objtag_format % (refer_path, node['width'], node['height'], node['border']) + '</object>'
+    return ('<object data="{0}" width="{1}" border="{2}" type="image/svg+xml" class="img" '
+            'style="aspect-ratio: {3:g} / {4:g}; height: auto">\n</object>').format(
+                refer_path, node['width'], node['border'], size[0], size[1])
+
+def lazy_markup(node, refer_path, size):
+    '''The markup which embeds a diagram as an <img> which is loaded lazily.
+
+    The width and height attributes give the intrinsic size of the diagram,
+    from which the browser reserves space of the right shape before loading
+    it. The size given to the node is applied with CSS.
+
+    Args:
+        node: The phix docutils node.
+
+        refer_path: The URI by which the page refers to the rendered SVG.
+
+        size: The intrinsic size of the diagram from intrinsic_size().
+    '''
+    return ('<img src="{0}" alt="{1}"{2} loading="lazy" decoding="async" '
+            'class="img" style="{3}" />').format(
+                refer_path,
+                escape(node.get('alt', ''), {'"': '&quot;'}),
+                size_attribute_markup(size),
+                image_style(node))
+
+def size_attribute_markup(size):
+    '''The width and height attributes of an <img>, from the intrinsic size of
+    a diagram, or None.'''
+    if size is None:
+        return ''
+    return ' width="{0}" height="{1}"'.format(max(1, int(round(size[0]))), max(1, int(round(size[1]))))
+
+def image_style(node):
+    '''The style which gives an <img> the size and border given to a node.'''
+    style = ['width: {0}'.format(node['width'])]
+    style.append('height: auto' if str(node['height']) == '100%' else 'height: {0}'.format(node['height']))
+    if node['border']:
+        style.append('border: {0}px solid'.format(node['border']))
+    return '; '.join(style)
+
+def sizes_attribute(width):
+    '''The sizes attribute of an <img> or <source> with a srcset, which tells
+    the browser how wide the diagram will be drawn before the page is laid
+    out.
+
+    Args:
+        width: The width given to the node, such as 50% or 400px.
+
+    Returns:
+        The value of the attribute, or None to let it default to the width of
+        the viewport. A percentage is taken as a share of the viewport, which
+        is the best estimate available before layout.
+    '''
+    width = str(width).strip()
+    if width.endswith('%'):
+        try:
+            return '{0:g}vw'.format(float(width[:-1]))
+        except ValueError:
+            return None
+    if length_in_pixels(width) is not None:
+        return '{0:g}px'.format(length_in_pixels(width))
+    return None
+
+def picture_markup(node, refer_path, size, rasters, lazy=False):
+    '''The markup which embeds a diagram as a <picture>, from which a browser
+    which can draw SVG takes the SVG, and any other client the raster closest
+    to the size it needs.
+
+    Args:
+        node: The phix docutils node.
+
+        refer_path: The URI by which the page refers to the rendered SVG.
+
+        size: The intrinsic size of the diagram from intrinsic_size(), or None.
+
+        rasters: The rasters of the diagram from write_rasters(), which are in
+            the same directory as the SVG.
+
+        lazy: Whether the browser may defer loading the diagram until it nears
+            the viewport.
+    '''
+    directory = posixpath.dirname(refer_path)
+    sizes = sizes_attribute(node['width'])
+    sizes_markup = ' sizes="{0}"'.format(sizes) if sizes else ''
+
+    def srcset(filenames):
+        return ', '.join('{0} {1}w'.format(posixpath.join(directory, filename), width)
+                         for filename, width in filenames)
+
+    # PNG is understood by every client, so the <img> falls back to it.
+    fallback_format, fallback_filenames = ([raster for raster in rasters if raster[0] == 'png'] or rasters)[0]
+    markup = ['<picture class="phix-picture">',
+              '<source srcset="{0}" type="image/svg+xml" />'.format(refer_path)]
+    for format, filenames in rasters:
+        if format != fallback_format:
+            markup.append('<source srcset="{0}"{1} type="{2}" />'.format(
+                srcset(filenames), sizes_markup, MIME_TYPES[format]))
+    markup.append('<img src="{0}" srcset="{1}"{2} alt="{3}"{4}{5} decoding="async" class="img" style="{6}" />'.format(
+        posixpath.join(directory, fallback_filenames[-1][0]),
+        srcset(fallback_filenames),
+        sizes_markup,
+        escape(node.get('alt', ''), {'"': '&quot;'}),
+        size_attribute_markup(size),
+        ' loading="lazy"' if lazy else '',
+        image_style(node)))
+    markup.append('</picture>')
+    return ''.join(markup)
+
+def thumbnail_markup(node, refer_path, thumbnail_refer_path, size, markup):
+    '''The markup which shows the thumbnail of a diagram in place of the
+    diagram, until the thumbnail is clicked.
+
+    The markup of the diagram is kept in a <template>, the contents of which
+    the browser neither loads nor draws, and replaces the thumbnail when it is
+    clicked. Without scripts, the thumbnail links to the diagram. The markup
+    should refer to the diagram, as an <object> does, rather than hold it, or
+    the page is no lighter for the thumbnail.
+
+    Args:
+        node: The phix docutils node.
+
+        refer_path: The URI by which the page refers to the rendered SVG.
+
+        thumbnail_refer_path: The URI by which the page refers to the
+            thumbnail.
+
+        size: The size of the thumbnail from intrinsic_size(), or None.
+
+        markup: The markup which embeds the diagram.
+    '''
+    return ('<template class="phix-diagram">{0}</template>'
+            '<a href="{1}" class="phix-thumbnail" title="Show the diagram" onclick="{2}">'
+            '<img src="{3}" alt="{4}"{5} class="img" /></a>\n').format(
+                markup,
+                refer_path,
+                "var t = this.previousSibling; "
+                "this.parentNode.replaceChild(document.importNode(t.content, true), this); "
+                "t.parentNode.removeChild(t); return false;",
+                thumbnail_refer_path,
+                escape(node.get('alt', ''), {'"': '&quot;'}),
+                ' width="{0}" height="{1}"'.format(int(round(size[0])), int(round(size[1]))) if size else '')
+
+def inline_svg(svg, prefix, width=None, height=None, border=None):
+    '''Prepare an SVG document to be written inline into HTML.
+
+    The ids and classes in the document are prefixed, along with all of the
+    references to them, so that they cannot collide with those of other
+    diagrams in the same page.
+
+    Args:
+        svg: The SVG document as bytes.
+
+        prefix: The prefix for ids and classes, which should be unique within
+            the page.
+
+        width: An optional width for the diagram, such as 100% or 300px.
+
+        height: An optional height for the diagram. A height of 100% is
+            ignored, so that the diagram keeps its aspect ratio.
+
+        border: An optional border width in pixels.
+
+    Returns:
+        The markup of the svg element, as a string.
+
+    Raises:
+        PhixError: If the SVG could not be parsed.
+    '''
+    document = parse_svg(svg, 'embed it')
+    try:
+        root = document.documentElement
+        elements = all_elements(root)
+        rename(elements,
+               dict((element.getAttribute('id'), prefix + element.getAttribute('id'))
+                    for element in elements if element.getAttribute('id')),
+               dict((class_name, prefix + class_name)
+                    for element in elements for class_name in element.getAttribute('class').split()))
+
+        # Scale the drawing, rather than crop it, to the size it is given.
+        box = view_box(root)
+        if box is not None:
+            root.setAttribute('viewBox', box)
+        size_attributes(root, width, height, border)
+        return root.toxml()
+    finally:
+        document.unlink()
+
+class SpriteDiagram(object):
+    '''A diagram prepared to be drawn from a sprite with <use>.
+
+    Attributes:
+        symbol_id: The id of the symbol which draws the diagram.
+
+        view_box: The viewBox of the diagram, or None.
+
+        entries: A list of (name, markup) pairs, each of which is to be placed
+            in the sprite once. One is the symbol which draws the diagram and
+            the others are the definitions, such as markers and gradients,
+            which it uses. A definition is named by its content, so that one
+            which is shared by several diagrams is placed in the sprite once.
+    '''
+
+    def __init__(self, svg):
+        '''
+        Args:
+            svg: The SVG document of the diagram as bytes.
+
+        Raises:
+            PhixError: If the SVG could not be parsed.
+        '''
+        prefix = 'phix-{0}-'.format(hashlib.sha1(svg).hexdigest()[:12])
+        self.symbol_id = prefix + 'diagram'
+        document = parse_svg(svg, 'add it to a sprite')
+        try:
+            root = document.documentElement
+            self.view_box = view_box(root)
+            namespaces = ''.join(' {0}="{1}"'.format(name, value)
+                                 for name, value in sorted(root.attributes.items())
+                                 if name.startswith('xmlns:'))
+            elements = all_elements(root)
+
+            definitions = dict((child.getAttribute('id'), child)
+                               for defs in elements if defs.localName == 'defs'
+                               for child in defs.childNodes
+                               if child.nodeType == child.ELEMENT_NODE and child.getAttribute('id'))
+            id_names = self.share_definitions(definitions)
+            for element in elements:
+                element_id = element.getAttribute('id')
+                if element_id and element_id not in id_names:
+                    id_names[element_id] = prefix + element_id
+            rename(elements,
+                   id_names,
+                   dict((class_name, prefix + class_name)
+                        for element in elements for class_name in element.getAttribute('class').split()))
+
+            self.entries = []
+            for definition in definitions.values():
+                self.entries.append((definition.getAttribute('id'),
+                                     '<defs{0}>{1}</defs>'.format(namespaces, definition.toxml())))
+                definition.parentNode.removeChild(definition)
+            for defs in [element for element in elements if element.localName == 'defs']:
+                if not any(child.nodeType == child.ELEMENT_NODE for child in defs.childNodes):
+                    defs.parentNode.removeChild(defs)
+
+            symbol = '<symbol id="{0}"{1}>{2}</symbol>'.format(
+                self.symbol_id,
+                ' viewBox="{0}"'.format(self.view_box) if self.view_box else '',
+                ''.join(child.toxml() for child in root.childNodes))
+            self.entries.append((self.symbol_id, '<defs{0}>{1}</defs>'.format(namespaces, symbol)))
+        finally:
+            document.unlink()
+
+    @staticmethod
+    def share_definitions(definitions):
+        '''Name definitions by their content.
+
+        A definition may refer to others, so it is named once they have been,
+        and its references renamed. Definitions which refer to one another in
+        a cycle are not shared.
+
+        Args:
+            definitions: A dictionary mapping ids to definition elements.
+
+        Returns:
+            A dictionary mapping the ids of the shared definitions, and of the
+            elements within them, to their new names.
+        '''
+        id_names = {}
+        pending = dict(definitions)
+        while pending:
+            ready = [definition_id for definition_id, definition in pending.items()
+                     if not (references(all_elements(definition)) & set(pending) - set([definition_id]))]
+            if not ready:
+                break
+            for definition_id in ready:
+                definition = pending.pop(definition_id)
+                elements = all_elements(definition)
+                rename(elements, id_names)
+                definition.removeAttribute('id')
+                name = 'phix-def-' + hashlib.sha1(definition.toxml().encode('utf-8')).hexdigest()[:12]
+                definition.setAttribute('id', definition_id)
+                id_names[definition_id] = name
+                for element in elements[1:]:
+                    if element.getAttribute('id'):
+                        id_names[element.getAttribute('id')] = '{0}-{1}'.format(name, element.getAttribute('id'))
+        return id_names
+
+    def use(self, href, width=None, height=None, border=None):
+        '''The markup which draws the diagram from a sprite.
+
+        Args:
+            href: The URI of the symbol, such as #phix-...-diagram.
+
+            The remaining arguments are as for inline_svg().
+        '''
+        document = minidom.getDOMImplementation().createDocument(SVG_NAMESPACE, 'svg', None)
+        try:
+            root = document.documentElement
+            root.setAttribute('xmlns', SVG_NAMESPACE)
+            root.setAttribute('xmlns:xlink', XLINK_NAMESPACE)
+            root.setAttribute('class', 'phix-sprite')
+            if self.view_box:
+                root.setAttribute('viewBox', self.view_box)
+            size_attributes(root, width, height, border)
+            use = document.createElementNS(SVG_NAMESPACE, 'use')
+            use.setAttribute('href', href)
+            use.setAttribute('xlink:href', href)
+            root.appendChild(use)
+            return root.toxml()
+        finally:
+            document.unlink()
+
+def sprite_markup(entries, hidden=True):
+    '''The markup of a sprite.
+
+    Args:
+        entries: The markup of the entries of the sprite.
+
+        hidden: Whether the sprite is to take no space in a page. It is not
+            hidden with display:none, which would stop some browsers from
+            drawing the gradients it defines.
+    '''
+    return '<svg xmlns="{0}" xmlns:xlink="{1}"{2}>{3}</svg>'.format(
+        SVG_NAMESPACE,
+        XLINK_NAMESPACE,
+        ' class="phix-sprite-defs" aria-hidden="true" style="position: absolute; width: 0; height: 0; overflow: hidden"' if hidden else '',
+        ''.join(entries))
+
+def sprite_scope(builder):
+    scope = builder.config.phix_html_sprite_scope
+    if scope not in SPRITE_SCOPES:
+        raise PhixError('phix_html_sprite_scope must be one of {0}, not {1!r}'.format(
+            ', '.join(SPRITE_SCOPES), scope))
+    return scope
+
+def site_sprite_directory(builder):
+    '''The directory in which the entries of the site sprite are kept between
+    builds, one file to each entry.'''
+    return os.path.join(builder.doctreedir, 'phix-sprite')
+
+def site_sprite_pages(builder):
+    '''The entries of the site sprite drawn by each page written in this build,
+    as a dictionary mapping page names to sets of entry names.'''
+    pages = getattr(builder, 'phix_site_sprite_pages', None)
+    if pages is None:
+        pages = builder.phix_site_sprite_pages = {}
+    return pages
+
+def sprite_use(self, node, refer_path, render_path):
+    '''Add a diagram to a sprite, and get the markup which draws it from the
+    sprite.
+
+    With a page scope, the entries are collected by page and appended to the
+    page once it has been written. With a site scope, they are collected in
+    files from which the site sprite is written when the build finishes.
+    '''
+    with open(render_path, 'rb') as svg_file:
+        diagram = SpriteDiagram(svg_file.read())
+
+    if sprite_scope(self.builder) == 'page':
+        sprites = getattr(self.builder, 'phix_page_sprites', None)
+        if sprites is None:
+            sprites = self.builder.phix_page_sprites = {}
+        entries = sprites.setdefault(self.builder.current_docname, collections.OrderedDict())
+        for name, markup in diagram.entries:
+            entries.setdefault(name, markup)
+        href = '#' + diagram.symbol_id
+    else:
+        directory = site_sprite_directory(self.builder)
+        ensuredir(directory)
+        names = site_sprite_pages(self.builder).setdefault(self.builder.current_docname, set())
+        for name, markup in diagram.entries:
+            names.add(name)
+            entry_path = os.path.join(directory, name + '.svg')
+            if not os.path.exists(entry_path):
+                partial_path = partial_file(entry_path)
+                with open(partial_path, 'wb') as entry_file:
+                    entry_file.write(markup.encode('utf-8'))
+                install(partial_path, entry_path)
+        href = '{0}#{1}'.format(posixpath.join(posixpath.dirname(refer_path), SITE_SPRITE_FILENAME),
+                                diagram.symbol_id)
+
+    return diagram.use(href, node['width'], node['height'], node['border'])
+
+def append_page_sprite(app, pagename, templatename, context, doctree):
+    '''Append the sprite of a page, if it has one, to the body of the page.
+
+    The page is also noted as written, so that the entries of the site sprite
+    which it no longer draws can be dropped.
+    '''
+    site_sprite_pages(app.builder).setdefault(pagename, set())
+    entries = getattr(app.builder, 'phix_page_sprites', {}).pop(pagename, None)
+    if entries and 'body' in context:
+        context['body'] += sprite_markup(entries.values())
+
+def write_site_sprite(app, exception):
+    '''Write the site sprite once the build has finished.
+
+    The entries drawn by each page are kept in an index beside the entries,
+    updated with the pages written in this build and cleared of documents
+    which no longer exist. The sprite is written from the entries which some
+    page still draws, and the others are deleted.
+    '''
+    if exception is not None or not hasattr(app.builder, 'imgpath'):
+        return
+    directory = site_sprite_directory(app.builder)
+    if not os.path.isdir(directory):
+        return
+    index_path = os.path.join(directory, SITE_SPRITE_INDEX)
+    try:
+        with open(index_path, 'r') as index_file:
+            index = json.load(index_file)
+    except (IOError, OSError, ValueError):
+        index = {}
+    written = site_sprite_pages(app.builder)
+    index = dict((pagename, names) for pagename, names in index.items()
+                 if pagename in app.env.found_docs and pagename not in written)
+    index.update((pagename, sorted(names)) for pagename, names in written.items() if names)
+    partial_path = partial_file(index_path)
+    with open(partial_path, 'w') as index_file:
+        json.dump(index, index_file, sort_keys=True)
+    install(partial_path, index_path)
+
+    drawn = set(name for names in index.values() for name in names)
+    entries = []
+    for filename in sorted(os.listdir(directory)):
+        if not filename.endswith('.svg'):
+            continue
+        entry_path = os.path.join(directory, filename)
+        if filename[:-len('.svg')] in drawn:
+            with open(entry_path, 'rb') as entry_file:
+                entries.append(entry_file.read().decode('utf-8'))
+        else:
+            os.remove(entry_path)
+    sprite_path = os.path.join(app.builder.outdir, '_images', SITE_SPRITE_FILENAME)
+    ensuredir(os.path.dirname(sprite_path))
+    partial_path = partial_file(sprite_path)
+    with open(partial_path, 'wb') as sprite_file:
+        sprite_file.write(sprite_markup(entries, hidden=False).encode('utf-8'))
+    install(partial_path, sprite_path)
+
+def append_diagram(self, node, css_class, refer_path, render_path):
+    '''Append the markup which embeds a rendered diagram to the body of an HTML
+    translator.
+
+    Args:
+        self: The HTML translator.
+
+        node: The phix docutils node.
+
+        css_class: The class of the paragraph which contains the diagram.
+
+        refer_path: The URI by which the page refers to the rendered SVG.
+
+        render_path: The path to which the SVG has been rendered.
+    '''
+    try:
+        write_precompressed(self.builder, render_path)
+    except PhixError:
+        exc = sys.exc_info()
+        log.info('Could not precompress {0}'.format(render_path), exc_info=exc)
+        self.builder.warn('Could not precompress {0} because of {1}'.format(
+                node['uri'],
+                exc[1]))
+
+    self.body.append(self.starttag(node, 'p', CLASS=css_class))
+
+    # A diagram with a thumbnail is loaded from its own file when the thumbnail
+    # is clicked, however it would otherwise be embedded, so that the page
+    # does not carry the diagram in its <template>.
+    thumbnail = None
+    try:
+        width = thumbnail_width(self.builder, node)
+        if width is not None:
+            thumbnail = write_thumbnail(self.builder, render_path, width)
+    except PhixError:
+        exc = sys.exc_info()
+        log.info('Could not make a thumbnail of {0}'.format(render_path), exc_info=exc)
+        self.builder.warn('Could not make a thumbnail of {0} because of {1}'.format(
+                node['uri'],
+                exc[1]))
+
+    markup = None
+    embed = 'object'
+    try:
+        embed = 'object' if thumbnail is not None else embedding(self.builder, node)
+        if embed == 'inline':
+            count = getattr(self, 'phix_inline_count', 0) + 1
+            self.phix_inline_count = count
+            with open(render_path, 'rb') as svg_file:
+                markup = inline_svg(svg_file.read(),
+                                    'phix{0}-'.format(count),
+                                    node['width'],
+                                    node['height'],
+                                    node['border'])
+        elif embed == 'sprite':
+            markup = sprite_use(self, node, refer_path, render_path)
+    except (IOError, OSError, PhixError):
+        exc = sys.exc_info()
+        log.info('Could not embed {0} as {1}'.format(render_path, embed), exc_info=exc)
+        self.builder.warn('Could not embed {0} as {1} because of {2}'.format(
+                node['uri'],
+                embed,
+                exc[1]))
+
+    if markup is None:
+        size = None
+        try:
+            with open(render_path, 'rb') as svg_file:
+                size = intrinsic_size(svg_file.read())
+        except (IOError, OSError, PhixError):
+            log.info('Could not determine the size of {0}'.format(render_path), exc_info=sys.exc_info())
+        rasters = []
+        try:
+            rasters = write_rasters(self.builder, render_path)
+        except PhixError:
+            exc = sys.exc_info()
+            log.info('Could not rasterize {0}'.format(render_path), exc_info=exc)
+            self.builder.warn('Could not rasterize {0} because of {1}'.format(
+                    node['uri'],
+                    exc[1]))
+        if rasters:
+            markup = picture_markup(node, refer_path, size, rasters, self.builder.config.phix_html_lazy)
+        elif size is not None and self.builder.config.phix_html_lazy:
+            markup = lazy_markup(node, refer_path, size)
+        else:
+            markup = object_markup(node, refer_path, size)
+    else:
+        markup += '\n'
+
+    if thumbnail is not None:
+        thumbnail_path, size = thumbnail
+        markup = thumbnail_markup(node,
+                                  refer_path,
+                                  posixpath.join(posixpath.dirname(refer_path),
+                                                 os.path.basename(thumbnail_path)),
+                                  size,
+                                  markup)
+    self.body.append(markup)
+
+    if node['new_window_flag']:
+        self.body.append('<p align="right">\n')
+        new_window_tag_format = '<a href="{0}" target="_blank">Open in new window</a>'
+        self.body.append(new_window_tag_format.format(refer_path))
+        self.body.append('</p>\n')
+
+    self.body.append('</p>\n')
+
+def setup(app):
+    '''Register the configuration values of HTML output.
+
+    This is called from the setup() of each phix extension, so it does nothing
+    if they have already been registered.
+    '''
+    if 'phix_html_embed' in app.config:
+        return
+    app.add_config_value('phix_html_embed', 'object', 'html')
+    app.add_config_value('phix_html_sprite_scope', 'page', 'html')
+    app.add_config_value('phix_html_lazy', False, 'html')
+    app.add_config_value('phix_precompress', [], '')
+    app.add_config_value('phix_thumbnail', False, 'html')
+    app.add_config_value('phix_thumbnail_width', 240, 'html')
+    app.add_config_value('phix_raster_formats', [], 'html')
+    app.add_config_value('phix_raster_widths', [480, 960, 1920], 'html')
+    app.add_config_value('phix_rasterizer', None, '')
+    app.connect('html-page-context', append_page_sprite)
+    app.connect('build-finished', write_site_sprite)
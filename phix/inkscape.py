@@ -1,4 +1,9 @@
-import logging, os, platform, posixpath, subprocess, shlex, string, sys
+import functools, logging, os, platform, posixpath, re, subprocess, shlex, shutil, sys, tempfile, threading, time
+
+if sys.version_info.major == 2:
+    import Queue as queue
+else:
+    import queue
 
 from docutils import nodes
 from docutils.parsers.rst import directives, states
@@ -7,14 +12,34 @@ from docutils.parsers.rst.roles import set_classes
 from sphinx.util.compat import Directive
 from sphinx.util.osutil import ensuredir
 
+from .cache import cache_key, get_cache, setup as setup_cache
+from .html import append_diagram, embed_option, setup as setup_html
+from .latex import append_latex_diagram, setup as setup_latex
 from .phix import (PhixError,
+                   note_render_job,
                    program_files_32,
                    relfn2path,
-                   temp_path)
+                   scratch_directory,
+                   tool_version)
+from .scheduler import (fetch_rendering,
+                        note_render_failure,
+                        plan_jobs,
+                        postprocess_jobs,
+                        register_planner,
+                        render_to_cache,
+                        stream_to_cache)
+from .thumbnail import thumbnail_option
 
 log = logging.getLogger('phix.inkscape')
 logging.basicConfig()
 
+# The number of times each render task starts a new Inkscape shell after one
+# has exited, before it launches Inkscape once for each remaining drawing.
+SHELL_RESTARTS = 3
+
+# The size of the chunks in which a drawing exported to stdout is read.
+CHUNK_SIZE = 65536
+
 class inkscape(nodes.General, nodes.Element):
     '''A docutils node representing a Inkscape diagram'''
 
@@ -60,7 +85,9 @@ class InkscapeDirective(Directive):
                    'scale': directives.percentage,
                    'align': align,
                    'border': directives.positive_int,
-                   'class': directives.class_option}
+                   'class': directives.class_option,
+                   'embed': embed_option,
+                   'thumbnail': thumbnail_option}
 
     def run(self):
         '''Process the inkscape directive.
@@ -76,7 +103,10 @@ class InkscapeDirective(Directive):
         # name of the Inkscape file.
         reference = directives.uri(self.arguments[0])
         env = self.state.document.settings.env
-        _, filename = relfn2path(env, reference)
+        rel_filename, filename = relfn2path(env, reference)
+
+        # Rebuild this document, and only this document, when the source changes.
+        env.note_dependency(rel_filename)
 
         log.info('filename = {0}'.format(filename))
 
@@ -116,6 +146,12 @@ class InkscapeDirective(Directive):
         log.info("inkscape_node['new_window_flag'] = {0}".format(
                 inkscape_node['new_window_flag']))
 
+        # Defer rendering so that all of the drawings can be exported by
+        # long-running Inkscape shells once reading is complete.
+        note_render_job(env, 'inkscape', {'uri': inkscape_node['uri'],
+                                          'postprocess': self.options.get('postprocess'),
+                                          'thumbnail': self.options.get('thumbnail')})
+
         return messages + [inkscape_node]
 
 def get_image_filename(self, uri):
@@ -146,14 +182,11 @@ def get_image_filename(self, uri):
         refer_path = fname
         render_path = os.path.join(self.builder.outdir, fname)
 
-    if os.path.isfile(render_path):
-        return refer_path, render_path
-
     ensuredir(os.path.dirname(render_path))
 
     return refer_path, render_path
 
-def create_graphics(self, inkscape_uri, render_path, postprocess_command=None):
+def create_graphics(inkscape_uri, render_path):
     '''
     Use Inkscape in batch mode to render a diagram from a Inkscape file into
     graphics of the specified format.
@@ -163,10 +196,6 @@ def create_graphics(self, inkscape_uri, render_path, postprocess_command=None):
 
         render_path: The path to which the graphics output is to be rendered.
 
-        postprocess_command: An optional command into which the Inkscape SVG
-           output will be piped before it is placed in the output document.
-           The command should accept SVG on stdin and produce SVG on stdout.
-
     Raises:
         PhixError: If the graphics could not be rendered.
     '''
@@ -175,13 +204,10 @@ def create_graphics(self, inkscape_uri, render_path, postprocess_command=None):
     log.info("inkscape_uri = {0}".format(inkscape_uri))
     log.info("render_path = {0}".format(render_path))
 
-    output_path = render_path if postprocess_command is None else temp_path('.svg')
-    log.info("output_path = {0}".format(output_path))
-
     # Launch Inkscape and instruct it to export the diagram as SVG
     args = [str(inkscape_uri),
             '--vacuum-defs',
-            '--export-plain-svg={0}'.format(str(output_path))]
+            '--export-plain-svg={0}'.format(str(render_path))]
 
     command = inkscape_command() + args
     log.info("command = {0}".format(command))
@@ -190,31 +216,43 @@ def create_graphics(self, inkscape_uri, render_path, postprocess_command=None):
     if returncode != 0:
         raise PhixError("Could not launch Inkscape with command {0}".format(' '.join(command)))
 
-    # If a postprocess command has been specified
-    if postprocess_command is not None:
-        log.info("postprocess_command = {0}".format(postprocess_command))
-
-        # We use our own variable interpolation with the $VAR syntax rather than
-        # relying on the underlying shell, so that we can support the same
-        # variable syntax on both Windows and Linux.
-        postprocess_command_template = string.Template(str(postprocess_command))
-        interpolated_postprocess_command = postprocess_command_template.substitute(os.environ)
-        log.info("interpolated_postprocess_command = {0}".format(
-                interpolated_postprocess_command))
-
-        postprocess_command_fragments = shlex.split(interpolated_postprocess_command, posix=False)
-        log.info("postprocess_command_fragments = {0}".format(
-                postprocess_command_fragments))
-
-        with open(output_path, 'rb') as intermediate_file:
-            with open(render_path, 'wb') as render_file:
-                returncode = subprocess.call(postprocess_command_fragments, stdin=intermediate_file, stdout=render_file)
-                log.info("returncode = {0}".format(returncode))
-                if returncode != 0:
-                    raise PhixError("Could not launch postprocess with command {0}".format(' '.join(postprocess_command)))
-        if os.path.exists(output_path):
-            log.info("Removing {0}".format(output_path))
-            os.remove(output_path)
+def write_graphics(inkscape_uri, output_file):
+    '''
+    Use Inkscape 1.x in batch mode to export a drawing to its stdout, writing
+    the SVG to a file-like object as it is produced.
+
+    Args:
+        inkscape_uri:  The path to the Inkscape file.
+
+        output_file: A file-like object to which the SVG is written.
+
+    Raises:
+        PhixError: If the graphics could not be rendered.
+    '''
+    log.info("write_graphics()")
+    log.info("inkscape_uri = {0}".format(inkscape_uri))
+
+    args = [str(inkscape_uri),
+            '--vacuum-defs',
+            '--export-plain-svg',
+            '--export-type=svg',
+            '--export-filename=-']
+
+    command = inkscape_command() + args
+    log.info("command = {0}".format(command))
+    try:
+        process = subprocess.Popen(command, stdout=subprocess.PIPE)
+    except OSError as e:
+        raise PhixError("Could not launch Inkscape with command {0}: {1}".format(' '.join(command), e))
+    try:
+        for chunk in iter(lambda: process.stdout.read(CHUNK_SIZE), b''):
+            output_file.write(chunk)
+    finally:
+        process.stdout.close()
+        returncode = process.wait()
+    log.info("returncode = {0}".format(returncode))
+    if returncode != 0:
+        raise PhixError("Could not launch Inkscape with command {0}".format(' '.join(command)))
 
 def inkscape_command():
     '''Get a command for launching Inkscape.
@@ -237,29 +275,305 @@ def inkscape_command():
 
     return ['inkscape']
 
-def render_html(self, node):
+def inkscape_major_version():
+    '''Get the major version number of Inkscape.
+
+    Returns:
+        An integer, or 0 if the version could not be determined.
     '''
-    Render the supplied node as HTML.
+    match = re.search(r'Inkscape (\d+)\.', tool_version(inkscape_command()))
+    return int(match.group(1)) if match else 0
 
-    Note: This method *always* raises docutils.nodes.SkipNode to ensure that the
-        child nodes are not visited.
+class InkscapeShell(object):
+    '''An Inkscape process running in shell mode, to which many exports can be
+    streamed so that the cost of starting Inkscape is paid only once.
+
+    Inkscape prints a '>' prompt when it is ready for the next command. An
+    export is complete when the prompt following it has been printed and the
+    output file exists.
+    '''
+
+    def __init__(self, timeout=120):
+        '''
+        Args:
+            timeout: The number of seconds to wait for Inkscape to start, or to
+                complete any one export.
+
+        Raises:
+            PhixError: If Inkscape could not be started in shell mode.
+        '''
+        self.timeout = timeout
+        self.actions = inkscape_major_version() >= 1
+        command = inkscape_command() + ['--shell']
+        log.info("command = {0}".format(command))
+        try:
+            with open(os.devnull, 'wb') as devnull:
+                self.process = subprocess.Popen(command,
+                                                stdin=subprocess.PIPE,
+                                                stdout=subprocess.PIPE,
+                                                stderr=devnull)
+        except OSError as e:
+            raise PhixError("Could not launch Inkscape with command {0}: {1}".format(' '.join(command), e))
+
+        # The prompt is not followed by a newline, so the output is read in
+        # chunks by a thread, which also allows reads to time out.
+        self.chunks = queue.Queue()
+        reader = threading.Thread(target=self._read)
+        reader.daemon = True
+        reader.start()
+        self._wait_for_prompt()
+
+    def _read(self):
+        fd = self.process.stdout.fileno()
+        while True:
+            chunk = os.read(fd, 4096)
+            self.chunks.put(chunk)
+            if not chunk:
+                return
+
+    def _wait_for_prompt(self):
+        output = b''
+        while not output.rstrip().endswith(b'>'):
+            try:
+                chunk = self.chunks.get(timeout=self.timeout)
+            except queue.Empty:
+                self.close()
+                raise PhixError('Inkscape shell did not respond within {0} seconds'.format(self.timeout))
+            if not chunk:
+                # Reap the process, so that poll() shows that it has exited.
+                self.process.wait()
+                raise PhixError('Inkscape shell exited unexpectedly')
+            output += chunk
+        log.info('Inkscape shell: {0}'.format(output.decode('utf-8', 'replace')))
+
+    def export(self, inkscape_uri, output_path):
+        '''Export a drawing as plain SVG.
+
+        Args:
+            inkscape_uri: The path to the Inkscape file.
+
+            output_path: The path to which the plain SVG is exported.
+
+        Raises:
+            PhixError: If the drawing could not be exported.
+        '''
+        if self.actions:
+            # Inkscape 1.x shell mode accepts actions
+            line = ('file-open:{0}; vacuum-defs; export-plain-svg; '
+                    'export-filename:{1}; export-do; file-close\n').format(inkscape_uri, output_path)
+        else:
+            # Inkscape 0.x shell mode accepts command line arguments
+            line = '"{0}" --vacuum-defs "--export-plain-svg={1}"\n'.format(inkscape_uri, output_path)
+        self._run(line, inkscape_uri, output_path)
+
+    def export_png(self, svg_path, output_path, width):
+        '''Export a drawing as PNG.
+
+        Args:
+            svg_path: The path to the drawing, which may be any SVG file.
+
+            output_path: The path to which the PNG is exported.
+
+            width: The width of the PNG in pixels. Its height keeps the aspect
+                ratio of the drawing.
+
+        Raises:
+            PhixError: If the drawing could not be exported.
+        '''
+        if self.actions:
+            line = ('file-open:{0}; export-type:png; export-width:{2}; '
+                    'export-filename:{1}; export-do; file-close\n').format(svg_path, output_path, width)
+        else:
+            line = '"{0}" --export-width={2} "--export-png={1}"\n'.format(svg_path, output_path, width)
+        self._run(line, svg_path, output_path)
+
+    def export_pdf(self, svg_path, output_path):
+        '''Export a drawing as PDF.
+
+        Args:
+            svg_path: The path to the drawing, which may be any SVG file.
+
+            output_path: The path to which the PDF is exported.
+
+        Raises:
+            PhixError: If the drawing could not be exported.
+        '''
+        if self.actions:
+            line = ('file-open:{0}; export-type:pdf; '
+                    'export-filename:{1}; export-do; file-close\n').format(svg_path, output_path)
+        else:
+            line = '"{0}" "--export-pdf={1}"\n'.format(svg_path, output_path)
+        self._run(line, svg_path, output_path)
+
+    def _run(self, line, inkscape_uri, output_path):
+        log.info("Inkscape shell command = {0}".format(line.strip()))
+        try:
+            self.process.stdin.write(line.encode(sys.getfilesystemencoding() or 'utf-8'))
+            self.process.stdin.flush()
+        except (IOError, OSError) as e:
+            raise PhixError('Could not send command to Inkscape shell: {0}'.format(e))
+        self._wait_for_prompt()
+
+        if not os.path.isfile(output_path) or os.path.getsize(output_path) == 0:
+            raise PhixError('Inkscape shell did not export {0}'.format(inkscape_uri))
+
+    def close(self):
+        '''Ask Inkscape to quit, and make sure that it does.'''
+        if self.process.poll() is None:
+            try:
+                self.process.stdin.write(b'quit\n')
+                self.process.stdin.close()
+            except (IOError, OSError):
+                pass
+        for _ in range(50):
+            if self.process.poll() is not None:
+                return
+            time.sleep(0.1)
+        self.process.kill()
+
+def plan_render(app, jobs):
+    '''Plan the rendering of Inkscape drawings.
+
+    If phix_inkscape_shell is greater than zero, each task runs one Inkscape
+    shell which exports uncached drawings from a shared queue until it is
+    empty. Otherwise each task launches Inkscape once to export one drawing.
+    Drawings which are cached, but not with the postprocess they need, are
+    postprocessed without launching Inkscape.
+
+    Args:
+        app: The Sphinx application.
+
+        jobs: The inkscape render jobs recorded by the documents.
+
+    Returns:
+        A list of render tasks.
+    '''
+    uncached, tasks = plan_jobs(app.builder, jobs, render_key)
+
+    shells = int(app.config.phix_inkscape_shell)
+    if shells <= 0:
+        return tasks + [functools.partial(render_drawing, app, key, key_jobs)
+                        for key, key_jobs in uncached.items()]
+
+    pending = queue.Queue()
+    for item in uncached.items():
+        pending.put(item)
+    return tasks + [functools.partial(render_queue, app, pending)
+                    for _ in range(min(shells, len(uncached)))]
+
+def render_queue(app, pending):
+    '''Export drawings from a queue of render jobs through one Inkscape shell
+    into the render cache, until the queue is empty.
+
+    Any drawing which the shell fails to export is exported by launching
+    Inkscape on its own. If the shell exits, a new one is started for the
+    remaining drawings, up to SHELL_RESTARTS times; if it cannot be started,
+    they too are exported by launching Inkscape for each.
+
+    Args:
+        app: The Sphinx application.
+
+        pending: A queue of (key, jobs) pairs, where jobs is the list of
+            render jobs which need the drawing.
+    '''
+    cache = get_cache(app.builder)
+    shell = start_shell()
+    restarts = 0
+
+    output_dir = tempfile.mkdtemp(dir=scratch_directory(app.builder))
+    try:
+        while True:
+            try:
+                key, jobs = pending.get_nowait()
+            except queue.Empty:
+                return
+
+            exited = False
+            if shell is not None:
+                output_path = os.path.join(output_dir, '{0}.svg'.format(key))
+                try:
+                    shell.export(jobs[0]['uri'], output_path)
+                except PhixError:
+                    log.info('Could not export {0} with Inkscape shell'.format(jobs[0]['uri']),
+                             exc_info=sys.exc_info())
+                    if shell.process.poll() is not None:
+                        shell = None
+                        exited = True
+                else:
+                    try:
+                        cache.store(key, output_path)
+                    except PhixError:
+                        note_render_failure(app.builder, key, str(sys.exc_info()[1]))
+                    else:
+                        postprocess_jobs(app.builder, key, jobs)
+                    continue
+
+            # The drawing may itself have made the shell exit, so it is
+            # exported on its own before a new shell is started.
+            render_drawing(app, key, jobs)
+            if exited and restarts < SHELL_RESTARTS:
+                restarts += 1
+                shell = start_shell()
+    finally:
+        if shell is not None:
+            shell.close()
+        shutil.rmtree(output_dir, ignore_errors=True)
+
+def start_shell():
+    '''Start an Inkscape shell.
+
+    Returns:
+        The InkscapeShell, or None if it could not be started, which has been
+        logged.
+    '''
+    try:
+        return InkscapeShell()
+    except PhixError:
+        log.info('Could not start Inkscape shell', exc_info=sys.exc_info())
+        return None
+
+def render_drawing(app, key, jobs):
+    '''Export a drawing into the render cache by launching Inkscape on its
+    own, and postprocess it for each of the render jobs which need it.
+
+    Inkscape 1.x exports the drawing to its stdout, which is streamed into the
+    cache and through the postprocess; earlier versions can only export to a
+    file.'''
+    if inkscape_major_version() >= 1:
+        stream_to_cache(app.builder, key, jobs, functools.partial(write_graphics, jobs[0]['uri']))
+    elif render_to_cache(app.builder,
+                       key,
+                       functools.partial(create_graphics, jobs[0]['uri'])):
+        postprocess_jobs(app.builder, key, jobs)
+
+def render_key(node):
+    '''Compute the render cache key for the rendering of an inkscape node by
+    Inkscape, before any postprocess.'''
+    return cache_key(node['uri'],
+                     'inkscape',
+                     tool_version(inkscape_command()))
+
+def fetch_diagram(self, node):
+    '''
+    Fetch the rendering of the supplied node into the output directory.
 
     Args:
         node: An inkscape docutils node.
 
+    Returns:
+        A 2-tuple of the path by which the output refers to the rendering and
+        the path to which it was fetched, from get_image_filename().
+
     Raises:
-        SkipNode: Do not visit the current node's children, and do not call the
-        current node's ``depart_...`` method.
+        SkipNode: If the rendering could not be fetched, which has been
+        reported.
     '''
-    has_thumbnail = False
-
     try:
         refer_path, render_path = get_image_filename(self, node['uri'])
         log.info("refer_path = {0}".format(refer_path))
         log.info("render_path = {0}".format(render_path))
         log.info("node['uri'] = {0}".format(node['uri']))
-        #if not os.path.isfile(render_path):
-        create_graphics(self, node['uri'], render_path, node.get('postprocess'))
+        fetch_rendering(self.builder, render_key(node), node.get('postprocess'), render_path)
     except PhixError:
         exc = sys.exc_info()
         log.info('Could not render {0}'.format(node['uri']),
@@ -268,20 +582,42 @@ def render_html(self, node):
                 node['uri'],
                 exc[1]))
         raise nodes.SkipNode
+    return refer_path, render_path
+
+def render_html(self, node):
+    '''
+    Render the supplied node as HTML.
+
+    Note: This method *always* raises docutils.nodes.SkipNode to ensure that the
+        child nodes are not visited.
+
+    Args:
+        node: An inkscape docutils node.
+
+    Raises:
+        SkipNode: Do not visit the current node's children, and do not call the
+        current node's ``depart_...`` method.
+    '''
+    refer_path, render_path = fetch_diagram(self, node)
+    append_diagram(self, node, 'inkscape', refer_path, render_path)
+    raise nodes.SkipNode
 
-    self.body.append(self.starttag(node, 'p', CLASS='inkscape'))
+def render_latex(self, node):
+    '''
+    Render the supplied node as LaTeX, including the diagram as PDF.
 
-    objtag_format = '<object data="%s" width="%s" height="%s" border="%s" type="image/svg+xml" class="img">\n'
-    self.body.append(objtag_format % (refer_path, node['width'], node['height'], node['border']))
-    self.body.append('</object>')
+    Note: This method *always* raises docutils.nodes.SkipNode to ensure that the
+        child nodes are not visited.
 
-    if node['new_window_flag']:
-        self.body.append('<p align="right">\n')
-        new_window_tag_format = '<a href="{0}" target="_blank">Open in new window</a>'
-        self.body.append(new_window_tag_format.format(refer_path))
-        self.body.append('</p>\n')
+    Args:
+        node: An inkscape docutils node.
 
-    self.body.append('</p>\n')
+    Raises:
+        SkipNode: Do not visit the current node's children, and do not call the
+        current node's ``depart_...`` method.
+    '''
+    refer_path, render_path = fetch_diagram(self, node)
+    append_latex_diagram(self, node, render_path)
     raise nodes.SkipNode
 
 def html_visit_inkscape(self, node):
@@ -290,10 +626,16 @@ def html_visit_inkscape(self, node):
 
 def latex_visit_inkscape(self, node):
     '''Visit an inkscape node during latex rendering.'''
-    render_latex(self, node, node['code'], node['options'])
+    render_latex(self, node)
 
 def setup(app):
     '''Register the services of this plug-in with Sphinx.'''
+    setup_cache(app)
+    setup_html(app)
+    setup_latex(app)
+    register_planner(app, 'inkscape', plan_render)
     app.add_node(inkscape,
-        html=(html_visit_inkscape, None))
+        html=(html_visit_inkscape, None),
+        latex=(latex_visit_inkscape, None))
     app.add_directive('inkscape', InkscapeDirective)
+    app.add_config_value('phix_inkscape_shell', 1, '')
@@ -0,0 +1,260 @@
+'''Writes the markup which includes rendered diagrams in LaTeX output.
+
+LaTeX cannot include SVG, so each diagram is converted to PDF, which is
+included with \\includegraphics. The conversions are made by a single Inkscape
+process in shell mode, or by cairosvg if it is installed, in one batch once
+the diagrams have been rendered, and the PDFs are kept in the render cache
+under the digest of the SVG. Since the tool rendering and its postprocess are
+cached in the same way for every builder, building HTML and PDF output from
+the same sources runs each tool once for each diagram; only the conversion is
+particular to LaTeX.
+'''
+
+import logging
+import os
+import re
+import shutil
+import sys
+import tempfile
+import threading
+
+from .cache import cache_key, get_cache, touch
+from .phix import PhixError, scratch_directory
+from . import raster
+
+log = logging.getLogger('phix.latex')
+logging.basicConfig()
+
+# The units of length which TeX understands.
+TEX_UNITS = ('pt', 'bp', 'pc', 'in', 'cm', 'mm', 'em', 'ex')
+
+LENGTH_EXPR = re.compile(r'^\s*([0-9.]+)\s*([a-z%]*)\s*$')
+
+
+def needs_pdf(builder):
+    '''Determine whether the builder includes diagrams as PDF.'''
+    return getattr(builder, 'format', None) == 'latex'
+
+def pdf_key(svg_path):
+    '''The cache key of the PDF of an SVG file, which depends only upon its
+    contents.'''
+    return cache_key(svg_path, 'pdf')
+
+def missing_pdf(builder, svg_path):
+    '''Determine whether the builder needs the PDF of an SVG file which is not
+    in the render cache.'''
+    return needs_pdf(builder) and not os.path.isfile(get_cache(builder).path(pdf_key(svg_path), '.pdf'))
+
+_queue_lock = threading.Lock()
+
+def queue_pdf(builder, svg_path):
+    '''Note that an SVG file in the render cache needs a PDF, which is made by
+    convert_queued() once all of the diagrams have been rendered.'''
+    if missing_pdf(builder, svg_path):
+        with _queue_lock:
+            queued = getattr(builder, 'phix_pdf_queue', None)
+            if queued is None:
+                queued = builder.phix_pdf_queue = []
+            if svg_path not in queued:
+                queued.append(svg_path)
+
+def convert_queued(builder):
+    '''Convert every queued SVG file to PDF in one batch.
+
+    Failures are only logged, since they are tried again, and reported, when
+    the diagrams are written.
+    '''
+    queued = getattr(builder, 'phix_pdf_queue', None) or []
+    builder.phix_pdf_queue = []
+    if not queued:
+        return
+    try:
+        failures = pdfs_to_cache(builder, queued)
+    except PhixError as e:
+        log.info('Could not convert {0} diagrams to PDF: {1}'.format(len(queued), e))
+        return
+    for svg_path, message in failures:
+        log.info('Could not convert {0} to PDF: {1}'.format(svg_path, message))
+    builder.info('phix: converted {0} diagrams to PDF'.format(len(queued) - len(failures)))
+
+def pdfs_to_cache(builder, svg_paths):
+    '''Convert several SVG files to PDF in the render cache, except those which
+    are already cached, in one batch which launches the converter at most once.
+
+    Args:
+        builder: The Sphinx builder.
+
+        svg_paths: The paths to the SVG files.
+
+    Returns:
+        A list of (svg_path, message) pairs, one for each SVG file which could
+        not be converted.
+
+    Raises:
+        PhixError: If the converter could not be started.
+    '''
+    cache = get_cache(builder)
+    svg_paths = [svg_path for svg_path in svg_paths
+                 if not os.path.isfile(cache.path(pdf_key(svg_path), '.pdf'))]
+    if not svg_paths:
+        return []
+
+    failures = []
+    output_dir = tempfile.mkdtemp(dir=scratch_directory(builder))
+    export = None
+    try:
+        export, close = pdf_exporter(builder)
+        for index, svg_path in enumerate(svg_paths):
+            pdf_path = os.path.join(output_dir, '{0}.pdf'.format(index))
+            try:
+                export(svg_path, pdf_path)
+                cache.store(pdf_key(svg_path), pdf_path, suffix='.pdf')
+            except PhixError as e:
+                failures.append((svg_path, str(e)))
+    finally:
+        if export is not None:
+            close()
+        shutil.rmtree(output_dir, ignore_errors=True)
+    return failures
+
+def pdf_exporter(builder):
+    '''Start the converter given by phix_pdf_converter.
+
+    Returns:
+        A 2-tuple of a function which exports an SVG file as PDF, accepting the
+        path of the SVG file and the path of the PDF, and a function which
+        stops the converter.
+
+    Raises:
+        PhixError: If the converter could not be started.
+    '''
+    if raster.converter(builder, 'phix_pdf_converter') == 'cairosvg':
+        def export(svg_path, pdf_path):
+            try:
+                raster.cairosvg.svg2pdf(url=svg_path, write_to=pdf_path)
+            except Exception as e:
+                raise PhixError('cairosvg could not convert {0}: {1}'.format(svg_path, e))
+        return export, lambda: None
+
+    # Imported here because the inkscape module imports this module.
+    from .inkscape import InkscapeShell
+    shell = InkscapeShell()
+    return shell.export_pdf, shell.close
+
+def write_pdf(builder, render_path):
+    '''Write the PDF of a rendered diagram alongside it, converting it unless
+    the PDF is already cached.
+
+    Args:
+        builder: The Sphinx builder.
+
+        render_path: The path of the rendered SVG file, such as diagram.svg
+            in the output directory.
+
+    Returns:
+        The path to which the PDF was written, such as diagram.pdf.
+
+    Raises:
+        PhixError: If the PDF could not be written.
+    '''
+    failures = pdfs_to_cache(builder, [render_path])
+    if failures:
+        raise PhixError(failures[0][1])
+    entry_path = get_cache(builder).path(pdf_key(render_path), '.pdf')
+    pdf_path = os.path.splitext(render_path)[0] + '.pdf'
+    try:
+        shutil.copyfile(entry_path, pdf_path)
+    except (IOError, OSError) as e:
+        raise PhixError('Could not write {0}: {1}'.format(pdf_path, e))
+    touch(entry_path)
+    return pdf_path
+
+def latex_length(length):
+    '''Convert the width or height given to a diagram to a LaTeX length.
+
+    Args:
+        length: A length such as 50%, which is taken as a share of the width
+            of a line, 300px, which is taken at 96 pixels to the inch, or 5cm.
+
+    Returns:
+        The LaTeX length, or None if it could not be converted.
+    '''
+    match = LENGTH_EXPR.match(str(length))
+    if match is None:
+        return None
+    try:
+        value = float(match.group(1))
+    except ValueError:
+        return None
+    unit = match.group(2)
+    if unit == '%':
+        return '\\linewidth' if value == 100 else '{0:g}\\linewidth'.format(value / 100)
+    if unit in ('', 'px'):
+        return '{0:g}bp'.format(value * 0.75)
+    if unit in TEX_UNITS:
+        return '{0:g}{1}'.format(value, unit)
+    return None
+
+def includegraphics_markup(node, pdf_filename):
+    '''The markup which includes the PDF of a diagram.
+
+    Args:
+        node: The phix docutils node.
+
+        pdf_filename: The name of the PDF, in the output directory.
+    '''
+    options = []
+    width = latex_length(node['width'])
+    if width is not None:
+        options.append('width=' + width)
+    if str(node['height']) != '100%':
+        height = latex_length(node['height'])
+        if height is not None:
+            options.append('height=' + height)
+            if width is not None:
+                options.append('keepaspectratio')
+
+    # The extra braces protect any dots in the name from graphicx.
+    base, extension = os.path.splitext(pdf_filename)
+    graphic = '\\includegraphics{0}{{{{{1}}}{2}}}'.format(
+        '[{0}]'.format(','.join(options)) if options else '', base, extension)
+
+    align = node.get('align')
+    if align == 'center':
+        return '\n\\begin{{center}}\n{0}\n\\end{{center}}\n'.format(graphic)
+    if align == 'right':
+        return '\n\\noindent\\hspace*{{\\fill}}{0}\n\n'.format(graphic)
+    return '\n\\noindent{0}\n\n'.format(graphic)
+
+def append_latex_diagram(self, node, render_path):
+    '''Append the markup which includes a rendered diagram to the body of a
+    LaTeX translator.
+
+    Args:
+        self: The LaTeX translator.
+
+        node: The phix docutils node.
+
+        render_path: The path to which the SVG has been rendered, in the
+            output directory.
+    '''
+    try:
+        pdf_path = write_pdf(self.builder, render_path)
+    except PhixError:
+        exc = sys.exc_info()
+        log.info('Could not convert {0} to PDF'.format(render_path), exc_info=exc)
+        self.builder.warn('Could not convert {0} to PDF because of {1}'.format(
+                node['uri'],
+                exc[1]))
+        return
+    self.body.append(includegraphics_markup(node, os.path.basename(pdf_path)))
+
+def setup(app):
+    '''Register the configuration values of LaTeX output.
+
+    This is called from the setup() of each phix extension, so it does nothing
+    if they have already been registered.
+    '''
+    if 'phix_pdf_converter' in app.config:
+        return
+    app.add_config_value('phix_pdf_converter', None, '')
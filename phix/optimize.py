@@ -0,0 +1,386 @@
+'''A built-in optimizer which shrinks the SVG produced by the phix tools.
+
+ArgoUML, Dia and Inkscape write SVG which is much larger than it needs to be:
+editor metadata, definitions which nothing uses, the same long style attribute
+repeated on every element and coordinates with six or more decimal places. The
+optimizer removes or reduces each of these. It is available as the
+``phix-optimize`` postprocessor, which accepts options such as::
+
+    :postprocess: phix-optimize precision=2 merge_styles=no
+
+and is applied after every postprocess when the phix_optimize_svg
+configuration value is set.
+'''
+
+import hashlib
+import logging
+import re
+
+from xml.dom import minidom
+from xml.parsers.expat import ExpatError
+
+from .phix import PhixError, builtin_postprocessors
+
+log = logging.getLogger('phix.optimize')
+logging.basicConfig()
+
+# The name under which the optimizer is available as a postprocessor.
+POSTPROCESSOR_NAME = 'phix-optimize'
+
+# Changed whenever the optimizer writes different output from the same input,
+# so that what an earlier version wrote is not taken from the render cache.
+OPTIMIZER_VERSION = 2
+
+DEFAULT_OPTIONS = {'precision': 3,
+                   'strip_metadata': True,
+                   'collapse_whitespace': True,
+                   'remove_unused_defs': True,
+                   'merge_styles': True}
+
+SVG_NAMESPACE = 'http://www.w3.org/2000/svg'
+
+# The namespaces of the private data which editors keep in their drawings.
+EDITOR_NAMESPACES = ('http://sodipodi.sourceforge.net/DTD/sodipodi-0.dtd',
+                     'http://www.inkscape.org/namespaces/inkscape',
+                     'http://ns.adobe.com/AdobeIllustrator/10.0/',
+                     'http://www.bohemiancoding.com/sketch/ns')
+
+# The attributes whose values are lists of numbers, and so can be rounded.
+NUMERIC_ATTRIBUTES = frozenset(['d', 'points', 'transform', 'viewBox',
+                                'x', 'y', 'x1', 'y1', 'x2', 'y2', 'dx', 'dy',
+                                'cx', 'cy', 'r', 'rx', 'ry', 'fx', 'fy',
+                                'width', 'height', 'stroke-width',
+                                'gradientTransform', 'patternTransform'])
+
+# Elements within which whitespace is significant.
+TEXT_ELEMENTS = frozenset(['text', 'tspan', 'textPath', 'style', 'script', 'title', 'desc'])
+
+NUMBER_EXPR = re.compile(r'-?(?:\d+\.\d*|\.\d+|\d+)(?:[eE][-+]?\d+)?')
+REFERENCE_EXPR = re.compile(r'url\(\s*[\'"]?#([^\'")\s]+)[\'"]?\s*\)')
+
+
+def parse_options(args):
+    '''Convert the arguments of the phix-optimize postprocessor into options.
+
+    Args:
+        args: Strings of the form name=value, where name is one of the keys of
+            DEFAULT_OPTIONS. Boolean options accept yes, no, true, false, on,
+            off, 1 and 0.
+
+    Returns:
+        A dictionary of options, including the defaults of any which were not
+        given.
+
+    Raises:
+        PhixError: If an argument could not be understood.
+    '''
+    options = dict(DEFAULT_OPTIONS)
+    for arg in args:
+        name, _, value = arg.partition('=')
+        name = name.strip().replace('-', '_')
+        if name not in DEFAULT_OPTIONS or not value:
+            raise PhixError('Could not understand {0} option {1!r}'.format(POSTPROCESSOR_NAME, arg))
+        if name == 'precision':
+            try:
+                options[name] = int(value)
+            except ValueError:
+                raise PhixError('{0} precision must be an integer, not {1!r}'.format(
+                    POSTPROCESSOR_NAME, value))
+        elif value.lower() in ('yes', 'true', 'on', '1'):
+            options[name] = True
+        elif value.lower() in ('no', 'false', 'off', '0'):
+            options[name] = False
+        else:
+            raise PhixError('Could not understand {0} option {1!r}'.format(POSTPROCESSOR_NAME, arg))
+    return options
+
+def format_options(options):
+    '''Convert options into the arguments of the phix-optimize postprocessor.
+
+    Args:
+        options: A dictionary of options, or True for the defaults.
+
+    Returns:
+        A string of name=value arguments, which is empty for the defaults.
+    '''
+    if options is True:
+        options = {}
+    args = []
+    for name in sorted(options):
+        if name not in DEFAULT_OPTIONS:
+            raise PhixError('Unknown phix_optimize_svg option {0!r}'.format(name))
+        value = options[name]
+        if isinstance(value, bool):
+            value = 'yes' if value else 'no'
+        args.append('{0}={1}'.format(name, value))
+    return ' '.join(args)
+
+def postprocessor(svg, *args):
+    '''The phix-optimize postprocessor.
+
+    Args:
+        svg: The SVG document as bytes.
+
+        args: Options, as accepted by parse_options().
+
+    Returns:
+        The optimized SVG document as bytes.
+    '''
+    return optimize(svg, **parse_options(args))
+
+def optimize(svg,
+             precision=3,
+             strip_metadata=True,
+             collapse_whitespace=True,
+             remove_unused_defs=True,
+             merge_styles=True):
+    '''Optimize an SVG document.
+
+    Args:
+        svg: The SVG document as bytes.
+
+        precision: The number of decimal places to which numbers in geometric
+            attributes are rounded, or None to leave them alone.
+
+        strip_metadata: Whether to remove comments, the DOCTYPE, metadata
+            elements and the elements and attributes of editors.
+
+        collapse_whitespace: Whether to remove whitespace between elements,
+            other than within text, and to collapse runs of whitespace in
+            numeric attributes.
+
+        remove_unused_defs: Whether to remove definitions which nothing
+            refers to.
+
+        merge_styles: Whether to replace style attributes which are repeated
+            on several elements with a class, defined once in a style
+            element, in documents which have no style element of their own.
+
+    Returns:
+        The optimized SVG document as bytes.
+
+    Raises:
+        PhixError: If the SVG could not be parsed.
+    '''
+    try:
+        document = minidom.parseString(svg)
+    except ExpatError as e:
+        raise PhixError('Could not parse SVG to optimize it: {0}'.format(e))
+
+    try:
+        root = document.documentElement
+        if strip_metadata:
+            strip_metadata_from(document)
+        if precision is not None or collapse_whitespace:
+            for element in elements(root):
+                round_attributes(element, precision, collapse_whitespace)
+        if collapse_whitespace:
+            collapse_whitespace_in(root)
+        if remove_unused_defs:
+            remove_unused_defs_from(root)
+        if merge_styles:
+            merge_styles_of(document)
+        optimized = ''.join(node.toxml() for node in document.childNodes)
+    finally:
+        document.unlink()
+
+    result = ('<?xml version="1.0" encoding="UTF-8"?>\n' + optimized).encode('utf-8')
+    log.info('Optimized SVG from {0} to {1} bytes'.format(len(svg), len(result)))
+    return result
+
+def elements(node):
+    '''Generate node and all of the elements below it, in document order.'''
+    if node.nodeType == node.ELEMENT_NODE:
+        yield node
+    for child in list(node.childNodes):
+        for element in elements(child):
+            yield element
+
+def local_name(node):
+    return node.localName or node.nodeName.rpartition(':')[2]
+
+def strip_metadata_from(document):
+    '''Remove comments, the DOCTYPE, metadata and editor data.'''
+    for node in list(document.childNodes):
+        if node.nodeType in (node.COMMENT_NODE, node.DOCUMENT_TYPE_NODE, node.PROCESSING_INSTRUCTION_NODE):
+            document.removeChild(node)
+
+    for element in list(elements(document.documentElement)):
+        if element.parentNode is None:
+            continue
+        if local_name(element) == 'metadata' or element.namespaceURI in EDITOR_NAMESPACES:
+            element.parentNode.removeChild(element)
+            continue
+        for child in list(element.childNodes):
+            if child.nodeType == child.COMMENT_NODE:
+                element.removeChild(child)
+        for name, value in list(element.attributes.items()):
+            attribute = element.getAttributeNode(name)
+            if (attribute.namespaceURI in EDITOR_NAMESPACES
+                or (name.startswith('xmlns:') and value in EDITOR_NAMESPACES)):
+                element.removeAttribute(name)
+
+def format_number(text, precision):
+    '''Format a number found by NUMBER_EXPR to a number of decimal places.'''
+    if precision is None:
+        return text
+    number = round(float(text), precision)
+    if number == int(number) and abs(number) < 1e15:
+        return str(int(number))
+    formatted = '{0:.{1}f}'.format(number, precision).rstrip('0').rstrip('.')
+    if formatted.startswith('0.'):
+        formatted = formatted[1:]
+    elif formatted.startswith('-0.'):
+        formatted = '-' + formatted[2:]
+    return formatted
+
+def round_numbers(value, precision):
+    '''Round each of the numbers in a list, such as path data.
+
+    Numbers in a list may be written without a separator where a sign or a
+    second decimal point ends one number, as in M1-0.5 or M1.5.5. Rounding can
+    take the sign or the decimal point away, so a space is put back wherever a
+    number would otherwise run into the one before it.
+    '''
+    output = []
+    end = 0
+    previous = None
+    for match in NUMBER_EXPR.finditer(value):
+        formatted = format_number(match.group(0), precision)
+        between = value[end:match.start()]
+        if (not between and previous is not None
+            and (formatted[0].isdigit() or (formatted[0] == '.' and '.' not in previous))):
+            between = ' '
+        output.append(between)
+        output.append(formatted)
+        end = match.end()
+        previous = formatted
+    output.append(value[end:])
+    return ''.join(output)
+
+def round_attributes(element, precision, collapse_whitespace):
+    '''Round the numbers in the geometric attributes of an element.'''
+    for name, value in list(element.attributes.items()):
+        if name.rpartition(':')[2] not in NUMERIC_ATTRIBUTES:
+            continue
+        value = round_numbers(value, precision)
+        if collapse_whitespace:
+            value = ' '.join(value.split())
+        element.setAttribute(name, value)
+
+def collapse_whitespace_in(element):
+    '''Remove whitespace between elements, other than within text.'''
+    if local_name(element) in TEXT_ELEMENTS or element.getAttribute('xml:space') == 'preserve':
+        return
+    for child in list(element.childNodes):
+        if child.nodeType == child.TEXT_NODE and not child.data.strip():
+            element.removeChild(child)
+        elif child.nodeType == child.ELEMENT_NODE:
+            collapse_whitespace_in(child)
+
+def references(element):
+    '''Find the ids to which an element, but not its children, refers.'''
+    ids = set()
+    for name, value in element.attributes.items():
+        if name in ('href', 'xlink:href') or name.endswith(':href'):
+            if value.startswith('#'):
+                ids.add(value[1:])
+        else:
+            ids.update(REFERENCE_EXPR.findall(value))
+    if local_name(element) == 'style':
+        ids.update(REFERENCE_EXPR.findall(text_of(element)))
+    return ids
+
+def text_of(element):
+    return ''.join(child.data for child in element.childNodes
+                   if child.nodeType in (child.TEXT_NODE, child.CDATA_SECTION_NODE))
+
+def remove_unused_defs_from(root):
+    '''Remove definitions which nothing refers to, and then any empty defs.
+
+    Definitions may refer to one another, so this is repeated until nothing
+    more is removed.
+    '''
+    while True:
+        definitions = [child
+                       for defs in elements(root) if local_name(defs) == 'defs'
+                       for child in defs.childNodes if child.nodeType == child.ELEMENT_NODE]
+        referenced = set()
+        for element in elements(root):
+            referenced.update(references(element))
+        unused = [definition for definition in definitions
+                  if local_name(definition) != 'style'
+                  and not (set(definition.getAttribute('id') for definition in elements(definition)
+                               if definition.getAttribute('id')) & referenced)]
+        if not unused:
+            break
+        for definition in unused:
+            definition.parentNode.removeChild(definition)
+
+    for defs in [element for element in elements(root) if local_name(element) == 'defs']:
+        if not any(child.nodeType == child.ELEMENT_NODE for child in defs.childNodes):
+            defs.parentNode.removeChild(defs)
+
+def normalize_style(style):
+    '''Normalize the declarations of a style attribute, keeping their order.'''
+    declarations = []
+    for declaration in style.split(';'):
+        name, _, value = declaration.partition(':')
+        if name.strip() and value.strip():
+            declarations.append('{0}:{1}'.format(name.strip(), ' '.join(value.split())))
+    return ';'.join(declarations)
+
+def style_properties(style):
+    '''The names of the properties set by a normalized style.'''
+    return [declaration.partition(':')[0] for declaration in style.split(';')]
+
+def merge_styles_of(document):
+    '''Replace style attributes which are repeated on several elements with a
+    class, defined once in a style element at the start of the document.
+
+    The class names are derived from the styles themselves, so that the same
+    style has the same class in every diagram, and diagrams embedded in the
+    same page cannot give one class different styles.
+
+    A rule in a style sheet is less specific than a style attribute, so a
+    rule which lost to a style attribute could win over the class which
+    replaced it. Styles are therefore not merged in a document which has a
+    style element of its own, nor on an element with a presentation attribute
+    for a property its style sets; they are only normalized.
+    '''
+    root = document.documentElement
+    mergeable = not any(local_name(element) == 'style' for element in elements(root))
+    styled = {}
+    for element in elements(root):
+        if element.hasAttribute('style'):
+            style = normalize_style(element.getAttribute('style'))
+            if not style:
+                element.removeAttribute('style')
+            elif mergeable and not any(element.hasAttribute(name) for name in style_properties(style)):
+                styled.setdefault(style, []).append(element)
+            else:
+                element.setAttribute('style', style)
+
+    rules = []
+    for style, styled_elements in sorted(styled.items()):
+        class_name = 'phix-' + hashlib.sha1(style.encode('utf-8')).hexdigest()[:8]
+        rule = '.{0}{{{1}}}'.format(class_name, style)
+        # Only merge where the rule is smaller than the attributes it replaces.
+        saved = len(styled_elements) * (len(style) - len(class_name)) - len(rule)
+        if len(styled_elements) < 2 or saved <= 0:
+            for element in styled_elements:
+                element.setAttribute('style', style)
+            continue
+        rules.append(rule)
+        for element in styled_elements:
+            element.removeAttribute('style')
+            classes = element.getAttribute('class').split()
+            element.setAttribute('class', ' '.join(classes + [class_name]))
+
+    if rules:
+        style_element = document.createElementNS(SVG_NAMESPACE, 'style')
+        style_element.setAttribute('type', 'text/css')
+        style_element.appendChild(document.createTextNode(''.join(rules)))
+        root.insertBefore(style_element, root.firstChild)
+
+builtin_postprocessors[POSTPROCESSOR_NAME] = postprocessor
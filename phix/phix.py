@@ -1,7 +1,10 @@
-import os, tempfile
+import atexit, logging, os, shlex, shutil, string, subprocess, sys, tempfile, threading
 
 from sphinx.errors import SphinxError
 
+log = logging.getLogger('phix.phix')
+logging.basicConfig()
+
 class PhixError(SphinxError):
     '''The base Phix exception type.
     '''
@@ -37,19 +40,486 @@ def relfn2path(env, filename, docname=None):
         enc_rel_fn = rel_fn.encode(sys.getfilesystemencoding())
         return rel_fn, os.path.join(env.srcdir, enc_rel_fn)
 
-def temp_path(suffix=''):
+def temp_path(suffix='', directory=None):
     '''Return a path to a temporary file. It is the responsibility of the
     calling code to ensure that the file is deleted.
 
     Args:
         suffix: Optional suffix for the temp file name.
+
+        directory: Optional directory in which to create the file, such as the
+            scratch directory of the build.
     '''
     # It's not obvious that this is the 'right way to do it' in Python, but see
     # <http://stackoverflow.com/questions/5545473/temporary-shelves/5545638#5545638>
-    fd, filename = tempfile.mkstemp(suffix)
+    fd, filename = tempfile.mkstemp(suffix, dir=directory)
     os.close(fd)
     return filename
 
+def scratch_directory(builder):
+    '''Get the scratch directory of a build.
+
+    Intermediate files are written below the scratch directory, which is
+    removed when the build finishes, or failing that when the process exits.
+    It is created in the directory given by the PHIX_SCRATCH_DIR environment
+    variable or the phix_scratch_dir configuration value - a tmpfs such as
+    /dev/shm is a good choice - or otherwise in the system temporary directory.
+
+    Args:
+        builder: The Sphinx builder.
+
+    Returns:
+        The path to the scratch directory.
+    '''
+    directory = getattr(builder, 'phix_scratch_dir', None)
+    if directory is None:
+        parent = os.environ.get('PHIX_SCRATCH_DIR',
+                                getattr(builder.config, 'phix_scratch_dir', None))
+        if parent and not os.path.isdir(parent):
+            os.makedirs(parent)
+        directory = tempfile.mkdtemp(prefix='phix-', dir=parent or None)
+        atexit.register(shutil.rmtree, directory, True)
+        builder.phix_scratch_dir = directory
+        log.info('Scratch directory is {0}'.format(directory))
+    return directory
+
+def remove_scratch_directory(app, exception):
+    '''Remove the scratch directory once the build has finished.'''
+    directory = getattr(app.builder, 'phix_scratch_dir', None)
+    if directory is not None:
+        shutil.rmtree(directory, ignore_errors=True)
+        app.builder.phix_scratch_dir = None
+
+def setup_scratch_directory(app):
+    '''Register the configuration value and event handler of the scratch
+    directory, unless they have already been registered.'''
+    if 'phix_scratch_dir' in app.config:
+        return
+    app.add_config_value('phix_scratch_dir', None, '')
+    app.connect('build-finished', remove_scratch_directory)
+
+_tool_versions = {}
+
+def tool_version(command, args=('--version',)):
+    '''Identify the version of an external tool.
+
+    The tool is run at most once per process for any given command; the result
+    is remembered.
+
+    Args:
+        command: A list of command line arguments used to launch the tool.
+
+        args: The arguments which cause the tool to report its version.
+
+    Returns:
+        A string identifying the command and the version it reports. If the tool
+        could not be run, only the command is identified.
+    '''
+    command = tuple(command)
+    if command not in _tool_versions:
+        try:
+            with open(os.devnull, 'wb') as devnull:
+                output = subprocess.check_output(command + tuple(args),
+                                                 stderr=devnull)
+            version = output.decode('utf-8', 'replace').strip()
+        except (OSError, subprocess.CalledProcessError):
+            version = ''
+        _tool_versions[command] = '{0} {1}'.format(' '.join(command), version)
+    return _tool_versions[command]
+
+def postprocess_command_fragments(postprocess_command):
+    '''Split a postprocess command into arguments.
+
+    Args:
+        postprocess_command: The command, in which environment variables are
+            expanded using a $VAR syntax.
+
+    Returns:
+        A list of command line arguments.
+
+    Raises:
+        PhixError: If the command refers to an undefined environment variable.
+    '''
+    log.info("postprocess_command = {0}".format(postprocess_command))
+
+    # We use our own variable interpolation with the $VAR syntax rather than
+    # relying on the underlying shell, so that we can support the same
+    # variable syntax on both Windows and Linux.
+    postprocess_command_template = string.Template(str(postprocess_command))
+    try:
+        interpolated_postprocess_command = postprocess_command_template.substitute(os.environ)
+    except (KeyError, ValueError) as e:
+        raise PhixError("Could not expand postprocess command {0}: {1}".format(postprocess_command, e))
+    log.info("interpolated_postprocess_command = {0}".format(
+            interpolated_postprocess_command))
+
+    fragments = shlex.split(interpolated_postprocess_command, posix=False)
+    log.info("postprocess_command_fragments = {0}".format(fragments))
+    return fragments
+
+class PostprocessStage(object):
+    '''One stage of a postprocess pipeline: either an external command, or a
+    Python callable registered in phix_postprocessors.'''
+
+    def __init__(self, fragments, postprocessor=None):
+        '''
+        Args:
+            fragments: The command line arguments of the stage. For a Python
+                stage the first is the name of the postprocessor and the rest
+                are passed to it.
+
+            postprocessor: The registered callable, or None for a command.
+        '''
+        self.fragments = fragments
+        self.postprocessor = postprocessor
+
+    @property
+    def is_command(self):
+        return self.postprocessor is None
+
+    def __str__(self):
+        return ' '.join(self.fragments)
+
+    @property
+    def signature(self):
+        '''The normalized form of the stage, which identifies what it does: the
+        expanded arguments of a command, or the qualified name of a Python
+        callable followed by its arguments.'''
+        if self.is_command:
+            return str(self)
+        name = getattr(self.postprocessor, '__qualname__',
+                       getattr(self.postprocessor, '__name__', repr(self.postprocessor)))
+        return ' '.join(['python:{0}.{1}'.format(getattr(self.postprocessor, '__module__', ''), name)]
+                        + self.fragments[1:])
+
+    def transform(self, svg):
+        '''Pass SVG through the stage in memory.
+
+        Args:
+            svg: The SVG document as bytes.
+
+        Returns:
+            The transformed SVG document as bytes.
+
+        Raises:
+            PhixError: If the stage failed.
+        '''
+        if self.is_command:
+            try:
+                process = subprocess.Popen(self.fragments, stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+            except OSError as e:
+                raise PhixError("Could not launch postprocess with command {0}: {1}".format(self, e))
+            output, _ = process.communicate(svg)
+            log.info("returncode = {0}".format(process.returncode))
+            if process.returncode != 0:
+                raise PhixError("Could not launch postprocess with command {0}".format(self))
+            return output
+
+        try:
+            output = self.postprocessor(svg, *self.fragments[1:])
+        except PhixError:
+            raise
+        except Exception as e:
+            raise PhixError("Postprocessor {0} failed: {1}".format(self, e))
+        if not isinstance(output, bytes):
+            try:
+                output = output.encode('utf-8')
+            except AttributeError:
+                raise PhixError("Postprocessor {0} did not return SVG bytes".format(self))
+        return output
+
+class PostprocessPipeline(object):
+    '''A compiled postprocess: one or more stages separated by | through which
+    SVG is passed, each of which is either an external command, reading SVG
+    on stdin and writing it to stdout, or the name of a Python callable
+    registered in the phix_postprocessors configuration value, followed by
+    any arguments to pass to it::
+
+        minify --precision 2 | svgo -i - -o -
+
+    Environment variables in the postprocess are expanded using a $VAR syntax
+    when it is compiled. A pipeline of commands alone is run as a chain of
+    processes connected by OS pipes; a pipeline with any Python stages passes
+    the SVG from stage to stage in memory.
+    '''
+
+    def __init__(self, postprocess, postprocessors=None):
+        '''
+        Args:
+            postprocess: The postprocess, as given to the :postprocess:
+                option of a directive.
+
+            postprocessors: An optional dictionary mapping names to Python
+                callables, each of which is called with the SVG as bytes,
+                followed by its arguments as strings, and returns the
+                transformed SVG as bytes.
+
+        Raises:
+            PhixError: If the postprocess could not be compiled.
+        '''
+        self.postprocess = postprocess
+        postprocessors = postprocessors or {}
+        self.stages = []
+        fragments = postprocess_command_fragments(postprocess)
+        while fragments:
+            if '|' in fragments:
+                stage, fragments = fragments[:fragments.index('|')], fragments[fragments.index('|') + 1:]
+            else:
+                stage, fragments = fragments, []
+            if not stage:
+                raise PhixError("Empty stage in postprocess {0}".format(postprocess))
+            postprocessor = postprocessors.get(stage[0])
+            if stage[0] in postprocessors and not callable(postprocessor):
+                raise PhixError("Postprocessor {0} is not callable".format(stage[0]))
+            self.stages.append(PostprocessStage(stage, postprocessor))
+        if not self.stages:
+            raise PhixError("Empty postprocess {0}".format(postprocess))
+        log.info("postprocess stages = {0}".format([str(stage) for stage in self.stages]))
+
+    def __str__(self):
+        return str(self.postprocess)
+
+    @property
+    def signature(self):
+        '''The normalized form of the pipeline, which is the same for any two
+        postprocesses which do the same thing, however they are spaced.'''
+        return ' | '.join(stage.signature for stage in self.stages)
+
+    @property
+    def is_piped(self):
+        '''True if every stage is a command, so that the pipeline can run as a
+        chain of processes.'''
+        return all(stage.is_command for stage in self.stages)
+
+    def transform(self, svg):
+        '''Pass SVG through every stage of the pipeline in memory.
+
+        Args:
+            svg: The SVG document as bytes.
+
+        Returns:
+            The transformed SVG document as bytes.
+        '''
+        for stage in self.stages:
+            svg = stage.transform(svg)
+        return svg
+
+    def start(self, stdin, render_file):
+        '''Start the commands of a pipeline of commands alone.
+
+        Args:
+            stdin: The standard input of the first command.
+
+            render_file: The file to which the last command writes.
+
+        Returns:
+            The list of running processes.
+        '''
+        processes = []
+        try:
+            for index, stage in enumerate(self.stages):
+                stdout = render_file if index == len(self.stages) - 1 else subprocess.PIPE
+                try:
+                    processes.append(subprocess.Popen(stage.fragments, stdin=stdin, stdout=stdout))
+                except OSError as e:
+                    raise PhixError("Could not launch postprocess with command {0}: {1}".format(stage, e))
+                finally:
+                    # Only the next command should hold the read end of each
+                    # pipe, so that a command which exits breaks the pipe.
+                    if index > 0:
+                        stdin.close()
+                stdin = processes[-1].stdout
+        except PhixError:
+            self.stop(processes)
+            raise
+        return processes
+
+    @staticmethod
+    def stop(processes):
+        for process in processes:
+            if process.poll() is None:
+                process.kill()
+            process.wait()
+
+    def wait(self, processes):
+        '''Wait for the processes started by start() to finish.
+
+        Raises:
+            PhixError: If any of them failed.
+        '''
+        returncodes = [process.wait() for process in processes]
+        log.info("returncodes = {0}".format(returncodes))
+        # A failed command breaks its pipe, which may make the commands before
+        # it fail too, so the last failure is the best explanation.
+        for stage, returncode in reversed(list(zip(self.stages, returncodes))):
+            if returncode != 0:
+                raise PhixError("Could not launch postprocess with command {0}".format(stage))
+
+    def run_file(self, input_path, render_path):
+        '''Pass an SVG file through the pipeline.
+
+        Args:
+            input_path: The path to the SVG file produced by the tool.
+
+            render_path: The path to which the output of the pipeline is
+                written.
+
+        Raises:
+            PhixError: If the pipeline could not be run successfully.
+        '''
+        if not self.is_piped:
+            with open(input_path, 'rb') as input_file:
+                svg = self.transform(input_file.read())
+            with open(render_path, 'wb') as render_file:
+                render_file.write(svg)
+            return
+        with open(input_path, 'rb') as input_file:
+            with open(render_path, 'wb') as render_file:
+                processes = self.start(input_file, render_file)
+        self.wait(processes)
+
+def compile_postprocess(postprocess, postprocessors=None):
+    '''Compile a postprocess into a pipeline.
+
+    Args:
+        postprocess: The postprocess, or an already compiled pipeline, or None.
+
+        postprocessors: An optional dictionary mapping names to the Python
+            callables which may be used as stages.
+
+    Returns:
+        A PostprocessPipeline, or None if postprocess is None.
+
+    Raises:
+        PhixError: If the postprocess could not be compiled.
+    '''
+    if postprocess is None or isinstance(postprocess, PostprocessPipeline):
+        return postprocess
+    return PostprocessPipeline(postprocess, postprocessors)
+
+_pipelines_lock = threading.Lock()
+
+def postprocess_pipeline(builder, postprocess):
+    '''Get the compiled pipeline for a postprocess.
+
+    Each distinct postprocess is compiled at most once per build, however many
+    diagrams use it, using the Python postprocessors of the build.
+
+    Args:
+        builder: The Sphinx builder.
+
+        postprocess: The postprocess, or None.
+
+    Returns:
+        A PostprocessPipeline, or None if postprocess is None.
+
+    Raises:
+        PhixError: If the postprocess could not be compiled.
+    '''
+    if postprocess is None:
+        return None
+    with _pipelines_lock:
+        pipelines = getattr(builder, 'phix_postprocess_pipelines', None)
+        if pipelines is None:
+            pipelines = builder.phix_postprocess_pipelines = {}
+        if postprocess not in pipelines:
+            try:
+                pipelines[postprocess] = compile_postprocess(
+                    postprocess, getattr(builder.config, 'phix_postprocessors', None))
+            except PhixError as e:
+                pipelines[postprocess] = e
+    pipeline = pipelines[postprocess]
+    if isinstance(pipeline, PhixError):
+        raise pipeline
+    return pipeline
+
+class Postprocessors(dict):
+    '''The Python postprocessors of a build, which are left out when the
+    environment is pickled, since they may well not be picklable.'''
+
+    def __reduce__(self):
+        return (dict, (dict.fromkeys(self),))
+
+# Python postprocessors which phix itself provides, keyed by name. Those in
+# phix_postprocessors take precedence.
+builtin_postprocessors = {}
+
+def prepare_postprocessors(app):
+    '''Prepare the postprocessors of the build when the builder is created.'''
+    postprocessors = app.config.phix_postprocessors or {}
+    if not isinstance(postprocessors, dict):
+        raise PhixError("phix_postprocessors must be a dictionary of callables")
+    merged = Postprocessors(builtin_postprocessors)
+    merged.update(postprocessors)
+    app.config.phix_postprocessors = merged
+    app.builder.phix_postprocess_pipelines = {}
+
+def setup_postprocessors(app):
+    '''Register the configuration value and event handler of the Python
+    postprocessors, unless they have already been registered.'''
+    if 'phix_postprocessors' in app.config:
+        return
+    app.add_config_value('phix_postprocessors', {}, '')
+    app.connect('builder-inited', prepare_postprocessors)
+
+def note_render_job(env, tool, job):
+    '''Record a rendering which will be needed to write the current document.
+
+    Render jobs are recorded while documents are read so that a tool can render
+    all of the diagrams it is asked for together, before any document is
+    written.
+
+    Args:
+        env: The Sphinx build environment.
+
+        tool: The name of the phix tool which will render the job.
+
+        job: A picklable dictionary describing the rendering.
+    '''
+    if not hasattr(env, 'phix_render_jobs'):
+        env.phix_render_jobs = {}
+    env.phix_render_jobs.setdefault(env.docname, []).append((tool, job))
+
+def pending_render_jobs(env, tool):
+    '''Get the render jobs recorded for a tool by every document.
+
+    Args:
+        env: The Sphinx build environment.
+
+        tool: The name of the phix tool.
+
+    Returns:
+        A list of job dictionaries.
+    '''
+    return [job
+            for jobs in getattr(env, 'phix_render_jobs', {}).values()
+            for job_tool, job in jobs
+            if job_tool == tool]
+
+def purge_render_jobs(app, env, docname):
+    '''Forget the render jobs of a document which is about to be re-read.'''
+    getattr(env, 'phix_render_jobs', {}).pop(docname, None)
+
+def merge_render_jobs(app, env, docnames, other):
+    '''Merge the render jobs of documents read in parallel.'''
+    if not hasattr(env, 'phix_render_jobs'):
+        env.phix_render_jobs = {}
+    for docname in docnames:
+        if docname in getattr(other, 'phix_render_jobs', {}):
+            env.phix_render_jobs[docname] = other.phix_render_jobs[docname]
+
+def setup_render_jobs(app):
+    '''Register the event handlers which maintain the render jobs.
+
+    This is called from the setup() of each phix extension which records render
+    jobs, so it does nothing if it has already been called for app.
+    '''
+    if getattr(app, 'phix_render_jobs_setup', False):
+        return
+    app.connect('env-purge-doc', purge_render_jobs)
+    app.connect('env-merge-info', merge_render_jobs)
+    app.phix_render_jobs_setup = True
+
 def is_64_windows():
     return 'PROGRAMFILES(X86)' in os.environ
 
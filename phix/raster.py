@@ -0,0 +1,284 @@
+'''Raster fallbacks of diagrams, for clients which cannot draw SVG.
+
+Email digests, old embedded browsers and services which preview pages cannot
+show an SVG diagram. When the phix_raster_formats configuration value names
+png, webp or both, each diagram in HTML output is also rasterized at each of
+the widths in phix_raster_widths, and embedded in a <picture> from which an
+SVG-capable browser takes the SVG, and any other client the raster closest to
+the size it needs.
+
+Rasters are made by a single Inkscape process in shell mode, or by cairosvg if
+it is installed, in one batch once the diagrams have been rendered. WebP
+rasters are converted from PNG with Pillow. Rasters are kept in the render
+cache under the digest of the SVG and the width, so that each is made only
+once.
+'''
+
+import logging
+import os
+import shutil
+import tempfile
+import threading
+
+try:
+    import cairosvg
+except ImportError:
+    cairosvg = None
+
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+from .cache import cache_key, get_cache, touch
+from .phix import PhixError, scratch_directory
+
+log = logging.getLogger('phix.raster')
+logging.basicConfig()
+
+RASTER_FORMATS = ('png', 'webp')
+CONVERTERS = ('inkscape', 'cairosvg')
+
+# The MIME type of each raster format.
+MIME_TYPES = {'png': 'image/png',
+              'webp': 'image/webp'}
+
+
+def raster_settings(builder):
+    '''Determine the rasters to be made of each diagram.
+
+    Returns:
+        A 2-tuple of the formats, from RASTER_FORMATS, and the widths in
+        pixels, from the phix_raster_formats and phix_raster_widths
+        configuration values. Both are empty unless the builder writes HTML.
+
+    Raises:
+        PhixError: If either configuration value is invalid, or WebP is
+            requested but Pillow is not installed.
+    '''
+    formats = getattr(builder.config, 'phix_raster_formats', None)
+    if not formats or getattr(builder, 'format', None) != 'html':
+        return (), ()
+    if hasattr(formats, 'split'):
+        formats = formats.split()
+    for format in formats:
+        if format not in RASTER_FORMATS:
+            raise PhixError('phix_raster_formats may only contain {0}, not {1!r}'.format(
+                ', '.join(RASTER_FORMATS), format))
+    if 'webp' in formats and Image is None:
+        raise PhixError('Pillow is needed to write WebP rasters')
+    try:
+        widths = sorted(set(int(width) for width in builder.config.phix_raster_widths))
+    except (TypeError, ValueError):
+        raise PhixError('phix_raster_widths must be a list of numbers of pixels, not {0!r}'.format(
+            builder.config.phix_raster_widths))
+    if not widths or widths[0] <= 0:
+        raise PhixError('phix_raster_widths must contain positive numbers of pixels, not {0!r}'.format(
+            builder.config.phix_raster_widths))
+    return tuple(formats), tuple(widths)
+
+def converter(builder, setting='phix_rasterizer'):
+    '''Determine the converter from SVG given by a configuration value, such as
+    phix_rasterizer, which by default is cairosvg if it is installed, and
+    otherwise Inkscape.
+
+    Returns:
+        Either 'inkscape' or 'cairosvg'.
+    '''
+    name = getattr(builder.config, setting)
+    if name is None:
+        return 'inkscape' if cairosvg is None else 'cairosvg'
+    if name not in CONVERTERS:
+        raise PhixError('{0} must be one of {1}, not {2!r}'.format(
+            setting, ', '.join(CONVERTERS), name))
+    if name == 'cairosvg' and cairosvg is None:
+        raise PhixError('the cairosvg module is not installed')
+    return name
+
+def raster_key(svg_path, width):
+    '''The cache key of the rasters of an SVG file at one width, which depends
+    only upon its contents and the width. The formats are distinguished by the
+    suffixes of their cache entries.'''
+    return cache_key(svg_path, 'raster', width)
+
+def missing_rasters(builder, svg_path):
+    '''Find the rasters of an SVG file which are not in the render cache.
+
+    Returns:
+        A list of (width, format) pairs.
+    '''
+    formats, widths = raster_settings(builder)
+    cache = get_cache(builder)
+    missing = []
+    for width in widths:
+        key = raster_key(svg_path, width)
+        missing.extend((width, format) for format in formats
+                       if not os.path.isfile(cache.path(key, '.' + format)))
+    return missing
+
+_queue_lock = threading.Lock()
+
+def queue_rasters(builder, svg_path):
+    '''Note that an SVG file in the render cache needs rasters, which are made
+    by rasterize_queued() once all of the diagrams have been rendered.'''
+    if missing_rasters(builder, svg_path):
+        with _queue_lock:
+            queued = getattr(builder, 'phix_raster_queue', None)
+            if queued is None:
+                queued = builder.phix_raster_queue = []
+            if svg_path not in queued:
+                queued.append(svg_path)
+
+def rasterize_queued(builder):
+    '''Make the rasters of every queued SVG file in one batch.
+
+    Failures are only logged, since they are tried again, and reported, when
+    the diagrams are written.
+    '''
+    queued = getattr(builder, 'phix_raster_queue', None) or []
+    builder.phix_raster_queue = []
+    if not queued:
+        return
+    try:
+        failures = rasterize_to_cache(builder, queued)
+    except PhixError as e:
+        log.info('Could not rasterize {0} diagrams: {1}'.format(len(queued), e))
+        return
+    for svg_path, message in failures:
+        log.info('Could not rasterize {0}: {1}'.format(svg_path, message))
+    builder.info('phix: rasterized {0} diagrams'.format(len(queued) - len(failures)))
+
+def rasterize_to_cache(builder, svg_paths):
+    '''Make the missing rasters of several SVG files in the render cache, in one
+    batch which launches the rasterizer at most once.
+
+    Args:
+        builder: The Sphinx builder.
+
+        svg_paths: The paths to the SVG files.
+
+    Returns:
+        A list of (svg_path, message) pairs, one for each SVG file which could
+        not be rasterized.
+
+    Raises:
+        PhixError: If the rasterizer could not be started.
+    '''
+    cache = get_cache(builder)
+    requests = [(svg_path, width, formats)
+                for svg_path in svg_paths
+                for width, formats in group_by_width(missing_rasters(builder, svg_path))]
+    if not requests:
+        return []
+
+    failures = []
+    output_dir = tempfile.mkdtemp(dir=scratch_directory(builder))
+    export = None
+    try:
+        export, close = png_exporter(builder)
+        for index, (svg_path, width, formats) in enumerate(requests):
+            png_path = os.path.join(output_dir, '{0}.png'.format(index))
+            key = raster_key(svg_path, width)
+            try:
+                export(svg_path, png_path, width)
+                if 'png' in formats:
+                    cache.store(key, png_path, suffix='.png')
+                if 'webp' in formats:
+                    webp_path = os.path.join(output_dir, '{0}.webp'.format(index))
+                    convert_to_webp(png_path, webp_path)
+                    cache.store(key, webp_path, suffix='.webp')
+            except PhixError as e:
+                if not any(failed_path == svg_path for failed_path, _ in failures):
+                    failures.append((svg_path, str(e)))
+    finally:
+        if export is not None:
+            close()
+        shutil.rmtree(output_dir, ignore_errors=True)
+    return failures
+
+def group_by_width(rasters):
+    '''Group (width, format) pairs into (width, formats) pairs, since every
+    format of one width is made from the same PNG.'''
+    groups = []
+    for width, format in rasters:
+        if groups and groups[-1][0] == width:
+            groups[-1][1].append(format)
+        else:
+            groups.append((width, [format]))
+    return groups
+
+def png_exporter(builder):
+    '''Start the rasterizer.
+
+    Returns:
+        A 2-tuple of a function which exports an SVG file as a PNG of a given
+        width, accepting the path of the SVG file, the path of the PNG and the
+        width, and a function which stops the rasterizer.
+
+    Raises:
+        PhixError: If the rasterizer could not be started.
+    '''
+    if converter(builder) == 'cairosvg':
+        def export(svg_path, png_path, width):
+            try:
+                cairosvg.svg2png(url=svg_path, write_to=png_path, output_width=width)
+            except Exception as e:
+                raise PhixError('cairosvg could not rasterize {0}: {1}'.format(svg_path, e))
+        return export, lambda: None
+
+    # Imported here because the inkscape module imports the html module, which
+    # imports this module.
+    from .inkscape import InkscapeShell
+    shell = InkscapeShell()
+    return shell.export_png, shell.close
+
+def convert_to_webp(png_path, webp_path):
+    '''Convert a PNG to a lossless WebP, which suits the flat colours and sharp
+    edges of diagrams.'''
+    try:
+        image = Image.open(png_path)
+        image.save(webp_path, 'WEBP', lossless=True, quality=100, method=6)
+    except (IOError, OSError) as e:
+        raise PhixError('Could not convert {0} to WebP: {1}'.format(png_path, e))
+
+def write_rasters(builder, render_path):
+    '''Write the rasters of a rendered diagram alongside it, making any which
+    are not already cached.
+
+    Args:
+        builder: The Sphinx builder.
+
+        render_path: The path of the rendered SVG file, such as
+            _images/diagram.svg.
+
+    Returns:
+        A list of (format, [(filename, width), ...]) pairs, one for each format
+        in phix_raster_formats, where the filenames, such as
+        diagram-480w.png, are those of the rasters in the directory of
+        render_path. The list is empty if no rasters are to be made.
+
+    Raises:
+        PhixError: If the rasters could not be written.
+    '''
+    formats, widths = raster_settings(builder)
+    if not formats:
+        return []
+    failures = rasterize_to_cache(builder, [render_path])
+    if failures:
+        raise PhixError(failures[0][1])
+
+    cache = get_cache(builder)
+    base = os.path.splitext(render_path)[0]
+    rasters = [(format, []) for format in formats]
+    for width in widths:
+        key = raster_key(render_path, width)
+        for format, filenames in rasters:
+            entry_path = cache.path(key, '.' + format)
+            raster_path = '{0}-{1}w.{2}'.format(base, width, format)
+            try:
+                shutil.copyfile(entry_path, raster_path)
+            except (IOError, OSError) as e:
+                raise PhixError('Could not write {0}: {1}'.format(raster_path, e))
+            touch(entry_path)
+            filenames.append((os.path.basename(raster_path), width))
+    return rasters
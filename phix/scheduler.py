@@ -0,0 +1,810 @@
+'''Renders the diagrams needed by a build in parallel, before writing begins.
+
+While documents are read, each phix directive records a render job. Once
+reading is complete, each phix tool plans its jobs into render tasks - a task
+might export every diagram from one ArgoUML project, or one batch of Dia files
+- and the tasks of all of the tools are run together, at most
+phix_parallel_jobs at a time. Threads suffice because the work is done by
+external processes and network requests. The renderings are placed in the
+render cache, from which the visitors retrieve them as the documents are
+written.
+
+Since the tools differ greatly in the resources they need - each ArgoUML task
+is a JVM, whereas a WSD task is a network request - the phix_max_jobs
+dictionary can also limit the number of concurrent tasks of each tool. With
+phix_adaptive_jobs enabled, no new task is started while the system is short
+of memory or heavily loaded, unless nothing else is running.
+
+The rendering produced by a tool and its postprocessed form are cached
+separately. The tool rendering is cached under a key which does not include
+the postprocess, and the output of the postprocess under the digest of the
+tool rendering together with the postprocess, so that changing only the
+postprocess does not run the tool again, and a tool rendering which is
+byte-for-byte unchanged is not postprocessed again. A tool which can write its
+rendering to a stream, rather than only to a file, has it teed into the cache
+entry, the digest and the stdin of each postprocess of commands as it is
+produced; see stream_to_cache().
+
+The forms of a final rendering which are written alongside it - compressed as
+given by phix_precompress, and its thumbnail - are also prepared in the cache
+by the task which produced it, so that they are made in parallel with the
+rendering of other diagrams. Rasters, and the PDFs included in LaTeX output,
+which need a converter to be launched, are instead made in one batch once all
+of the render tasks have finished.
+'''
+
+import collections
+import functools
+import hashlib
+import logging
+import multiprocessing
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+
+from .cache import alias_key, cache_key, content_key, get_cache, parse_size, remove_quietly
+from . import compress
+from . import latex
+from . import optimize
+from . import raster
+from . import thumbnail
+from .phix import (PhixError,
+                   pending_render_jobs,
+                   postprocess_pipeline,
+                   scratch_directory,
+                   setup_postprocessors,
+                   setup_render_jobs,
+                   setup_scratch_directory)
+
+log = logging.getLogger('phix.scheduler')
+logging.basicConfig()
+
+
+def register_planner(app, tool, planner, memory=None):
+    '''Register the function which plans the render tasks for a phix tool.
+
+    Args:
+        app: The Sphinx application.
+
+        tool: The name with which the tool records its render jobs.
+
+        planner: A function accepting the Sphinx application and a list of the
+            render jobs of the tool, and returning a list of tasks. Each task is
+            a callable, accepting no arguments, which places its renderings in
+            the render cache and records any failures with
+            note_render_failure().
+
+        memory: An optional function, accepting no arguments, which estimates
+            the number of bytes of memory each task of the tool needs. With
+            phix_adaptive_jobs enabled, a task is not started unless this
+            much memory is available.
+    '''
+    setup(app)
+    app.phix_planners[tool] = (planner, memory)
+
+def note_render_failure(builder, key, message):
+    '''Record why a rendering could not be produced, for reporting when the
+    node which needs it is written.'''
+    log.info('Could not render {0}: {1}'.format(key, message))
+    builder.phix_render_failures[key] = message
+
+def note_unexpected_failure(builder, key, exc_info):
+    '''Record a failure to render which was not reported as a PhixError, such
+    as an OSError from a tool which is not installed, logging its traceback
+    since it may reveal a fault in phix itself.
+
+    Args:
+        builder: The Sphinx builder.
+
+        key: The cache key of the rendering.
+
+        exc_info: The exception, as returned by sys.exc_info().
+    '''
+    log.warning('Unexpected failure to render {0}'.format(key), exc_info=exc_info)
+    note_render_failure(builder, key, '{0}: {1}'.format(exc_info[0].__name__, exc_info[1]))
+
+def render_failure(builder, *keys):
+    '''Explain why a rendering is not in the render cache.
+
+    Args:
+        builder: The Sphinx builder.
+
+        keys: The cache keys of the rendering, such as those of the tool
+            rendering and of its postprocessed form, in the order in which
+            their failures should be preferred.
+
+    Returns:
+        The first message recorded by note_render_failure() for any of the
+        keys, or a general message if none was recorded.
+    '''
+    failures = getattr(builder, 'phix_render_failures', {})
+    for key in keys:
+        if key in failures:
+            return failures[key]
+    return 'it was not rendered before writing began'
+
+def render_to_cache(builder, key, render):
+    '''Render into a temporary file and store the result in the render cache.
+
+    Args:
+        builder: The Sphinx builder.
+
+        key: The cache key of the rendering.
+
+        render: A callable accepting the path to which it should render. It may
+            return a dictionary of metadata to store with the rendering.
+
+    Returns:
+        True if the rendering was stored in the cache, otherwise False, in which
+        case the failure has been recorded.
+    '''
+    output_dir = tempfile.mkdtemp(dir=scratch_directory(builder))
+    try:
+        output_path = os.path.join(output_dir, 'output.svg')
+        metadata = render(output_path)
+        if not os.path.isfile(output_path):
+            raise PhixError('no graphics were rendered')
+        get_cache(builder).store(key, output_path, metadata=metadata)
+        return True
+    except PhixError:
+        note_render_failure(builder, key, str(sys.exc_info()[1]))
+        return False
+    except Exception:
+        note_unexpected_failure(builder, key, sys.exc_info())
+        return False
+    finally:
+        shutil.rmtree(output_dir, ignore_errors=True)
+
+def rendering_pipeline(builder, postprocess):
+    '''Get the compiled pipeline through which a tool rendering is passed: the
+    postprocess of the rendering, followed by the optimizer if the
+    phix_optimize_svg configuration value is set.
+
+    Args:
+        builder: The Sphinx builder.
+
+        postprocess: The postprocess, or None.
+
+    Returns:
+        A PostprocessPipeline, or None if there is nothing to do.
+
+    Raises:
+        PhixError: If the pipeline could not be compiled.
+    '''
+    options = getattr(builder.config, 'phix_optimize_svg', False)
+    if options:
+        stage = ' '.join([optimize.POSTPROCESSOR_NAME, optimize.format_options(options)]).strip()
+        postprocess = stage if postprocess is None else '{0} | {1}'.format(postprocess, stage)
+    return postprocess_pipeline(builder, postprocess)
+
+def postprocessed_key(builder, key, postprocess):
+    '''Compute the cache key of the postprocessed form of a tool rendering.
+
+    Args:
+        builder: The Sphinx builder.
+
+        key: The cache key of the tool rendering.
+
+        postprocess: The postprocess, or None.
+
+    Returns:
+        The cache key of the postprocessed rendering, which is key itself if
+        there is nothing to do. Since any postprocess may include the
+        optimizer, the key depends upon its version.
+
+    Raises:
+        PhixError: If the postprocess could not be compiled.
+    '''
+    pipeline = rendering_pipeline(builder, postprocess)
+    if pipeline is None:
+        return key
+    return alias_key(key, 'postprocessed', pipeline.signature, optimize.OPTIMIZER_VERSION)
+
+def postprocess_to_cache(builder, key, postprocess, name=None):
+    '''Postprocess a tool rendering from the render cache into the render cache.
+
+    The output of the postprocess is cached under the digest of the tool
+    rendering and the postprocess, so that a rendering which is identical to
+    one postprocessed before - perhaps from another source - is not
+    postprocessed again.
+
+    Args:
+        builder: The Sphinx builder.
+
+        key: The cache key of the tool rendering, which must be in the cache.
+
+        postprocess: The postprocess, or None.
+
+        name: An optional name for the rendering, such as the path of its
+            source, with which to report the bytes saved by the optimizer.
+
+    Returns:
+        True if the postprocessed rendering was stored in the cache, otherwise
+        False, in which case the failure has been recorded.
+    '''
+    cache = get_cache(builder)
+    try:
+        final_key = postprocessed_key(builder, key, postprocess)
+    except PhixError:
+        # The failure is reported when the node is written.
+        return False
+    if final_key == key:
+        return True
+
+    pipeline = rendering_pipeline(builder, postprocess)
+    output_dir = tempfile.mkdtemp(dir=scratch_directory(builder))
+    try:
+        result_key = cache_key(cache.path(key), 'postprocess', pipeline.signature)
+        if result_key in cache:
+            log.info('Reusing postprocessed {0} for {1}'.format(result_key, final_key))
+        else:
+            output_path = os.path.join(output_dir, 'output.svg')
+            try:
+                pipeline.run_file(cache.path(key), output_path)
+            except (IOError, OSError) as e:
+                raise PhixError('Could not postprocess {0}: {1}'.format(cache.path(key), e))
+            store_postprocessed(builder, key, pipeline, result_key, output_path, name)
+        cache.store(final_key, cache.path(result_key), metadata=cache.metadata(key))
+        return True
+    except PhixError:
+        note_render_failure(builder, final_key, str(sys.exc_info()[1]))
+        return False
+    except Exception:
+        note_unexpected_failure(builder, final_key, sys.exc_info())
+        return False
+    finally:
+        shutil.rmtree(output_dir, ignore_errors=True)
+
+def store_postprocessed(builder, key, pipeline, result_key, output_path, name=None):
+    '''Store the output of a postprocess in the render cache under the digest
+    of the tool rendering and the postprocess, and report the bytes saved by
+    the optimizer if the postprocess includes it.
+
+    Raises:
+        PhixError: If the output could not be stored.
+    '''
+    get_cache(builder).store(result_key, output_path)
+    if any(stage.fragments[0] == optimize.POSTPROCESSOR_NAME for stage in pipeline.stages):
+        note_bytes_saved(builder,
+                         name or key,
+                         os.path.getsize(get_cache(builder).path(key)),
+                         os.path.getsize(output_path))
+
+class RenderTee(object):
+    '''A file-like object which passes each chunk of a tool rendering, as it
+    is written, to the cache entry of the rendering, to the digest from which
+    the keys of its postprocessed forms are computed, and to the stdin of each
+    postprocess of commands alone.'''
+
+    def __init__(self, entry_file, pipes):
+        '''
+        Args:
+            entry_file: The file to which the cache entry is written.
+
+            pipes: The stdin of the first command of each postprocess.
+        '''
+        self.entry_file = entry_file
+        self.pipes = list(pipes)
+        self.digest = hashlib.sha1()
+        self.size = 0
+
+    def write(self, chunk):
+        self.entry_file.write(chunk)
+        self.digest.update(chunk)
+        self.size += len(chunk)
+        for pipe in list(self.pipes):
+            try:
+                pipe.write(chunk)
+            except (IOError, OSError):
+                # The command has stopped reading, and its failure is reported
+                # once it has been waited for.
+                self.pipes.remove(pipe)
+                self.close_pipe(pipe)
+
+    def close(self):
+        '''Close the pipes, so that each command sees the end of its input.'''
+        for pipe in self.pipes:
+            self.close_pipe(pipe)
+        self.pipes = []
+
+    @staticmethod
+    def close_pipe(pipe):
+        try:
+            pipe.close()
+        except (IOError, OSError):
+            pass
+
+def streamed_postprocesses(builder, key, jobs):
+    '''Group the render jobs which need a tool rendering by the cache key of
+    their postprocessed rendering, separating those whose postprocess can be
+    run as the rendering is produced: those of commands alone.
+
+    Returns:
+        A 2-tuple. The first element is an ordered dictionary mapping the key of
+        each postprocessed rendering to be streamed to a pair of its pipeline
+        and the jobs which need it. The second is a list of the other jobs.
+    '''
+    streamed = collections.OrderedDict()
+    others = []
+    for job in jobs:
+        try:
+            pipeline = rendering_pipeline(builder, job['postprocess'])
+            final_key = postprocessed_key(builder, key, job['postprocess'])
+        except PhixError:
+            # The failure is reported when the node is written.
+            continue
+        if pipeline is not None and pipeline.is_piped:
+            streamed.setdefault(final_key, (pipeline, []))[1].append(job)
+        else:
+            others.append(job)
+    return streamed, others
+
+def stream_to_cache(builder, key, jobs, render):
+    '''Render into the render cache through a stream, postprocessing the
+    rendering for each of the render jobs which need it.
+
+    As the rendering is written, it is teed into its cache entry, into the
+    digest from which the keys of its postprocessed forms are computed, and
+    into the stdin of each postprocess of commands alone, so that neither the
+    rendering nor its postprocessed forms pass through an intermediate file. A
+    postprocess with Python stages, which needs the whole rendering, is run
+    from the cache entry once it is complete.
+
+    Args:
+        builder: The Sphinx builder.
+
+        key: The cache key of the tool rendering.
+
+        jobs: The render jobs which need the rendering, each of which has a
+            'postprocess' entry.
+
+        render: A callable accepting a file-like object to which it should
+            write the rendering. It may return a dictionary of metadata to
+            store with the rendering.
+
+    Returns:
+        True if the tool rendering was stored in the cache, otherwise False, in
+        which case the failure has been recorded.
+    '''
+    cache = get_cache(builder)
+    streamed, others = streamed_postprocesses(builder, key, jobs)
+    output_dir = tempfile.mkdtemp(dir=scratch_directory(builder))
+    started = []
+    partial_path = None
+    stored = False
+    try:
+        try:
+            for index, (final_key, (pipeline, final_jobs)) in enumerate(streamed.items()):
+                output_path = os.path.join(output_dir, '{0}.svg'.format(index))
+                with open(output_path, 'wb') as output_file:
+                    try:
+                        processes = pipeline.start(subprocess.PIPE, output_file)
+                    except PhixError:
+                        note_render_failure(builder, final_key, str(sys.exc_info()[1]))
+                        continue
+                started.append((final_key, pipeline, final_jobs, processes, output_path))
+
+            partial_path = cache.begin_store(key)
+            with open(partial_path, 'wb') as entry_file:
+                tee = RenderTee(entry_file, [processes[0].stdin for _, _, _, processes, _ in started])
+                try:
+                    metadata = render(tee)
+                finally:
+                    tee.close()
+            if tee.size == 0:
+                raise PhixError('no graphics were rendered')
+            cache.finish_store(key, partial_path, metadata=metadata)
+            stored = True
+        except PhixError:
+            note_render_failure(builder, key, str(sys.exc_info()[1]))
+            return False
+        except Exception:
+            note_unexpected_failure(builder, key, sys.exc_info())
+            return False
+        finally:
+            if not stored:
+                for _, pipeline, _, processes, _ in started:
+                    pipeline.stop(processes)
+                if partial_path is not None:
+                    remove_quietly(partial_path)
+
+        for final_key, pipeline, final_jobs, processes, output_path in started:
+            try:
+                pipeline.wait(processes)
+                result_key = content_key(tee.digest.copy(), 'postprocess', pipeline.signature)
+                if result_key in cache:
+                    log.info('Reusing postprocessed {0} for {1}'.format(result_key, final_key))
+                else:
+                    store_postprocessed(builder, key, pipeline, result_key, output_path,
+                                        job_name(final_jobs[0]))
+                cache.store(final_key, cache.path(result_key), metadata=cache.metadata(key))
+            except PhixError:
+                note_render_failure(builder, final_key, str(sys.exc_info()[1]))
+                continue
+            except Exception:
+                note_unexpected_failure(builder, final_key, sys.exc_info())
+                continue
+            for job in final_jobs:
+                prepare_forms(builder, final_key, job)
+        postprocess_jobs(builder, key, others)
+        return True
+    finally:
+        shutil.rmtree(output_dir, ignore_errors=True)
+
+def postprocess_jobs(builder, key, jobs):
+    '''Postprocess a tool rendering from the render cache for each of the
+    render jobs which need it.
+
+    Args:
+        builder: The Sphinx builder.
+
+        key: The cache key of the tool rendering.
+
+        jobs: The render jobs, each of which has a 'postprocess' entry.
+    '''
+    for job in jobs:
+        if postprocess_to_cache(builder, key, job['postprocess'], job_name(job)):
+            prepare_forms(builder, postprocessed_key(builder, key, job['postprocess']), job)
+
+def job_name(job):
+    '''The name of a render job with which to report on its rendering: the
+    path of its source, and the name of its diagram if it has one.'''
+    name = job.get('uri')
+    if job.get('diagram'):
+        name = '{0} ({1})'.format(name, job['diagram'])
+    return name
+
+def prepare_forms(builder, key, job):
+    '''Prepare in the render cache the forms of a final rendering which are
+    written alongside it: those compressed as given by phix_precompress, and
+    its thumbnail, so that they are ready when the diagram is written. Its
+    rasters, or its PDF for LaTeX output, are queued, to be made in one batch
+    once rendering is complete.
+
+    A failure is only logged, since each form is tried again, and any failure
+    reported, when the diagram is written.
+
+    Args:
+        builder: The Sphinx builder.
+
+        key: The cache key of the final rendering.
+
+        job: The render job which needs the rendering.
+    '''
+    cache = get_cache(builder)
+    if key not in cache:
+        return
+    try:
+        formats = compress.precompress_formats(builder)
+        if formats:
+            compress.compress_to_cache(builder, cache.path(key), formats)
+    except PhixError:
+        log.info('Could not precompress {0}'.format(key), exc_info=sys.exc_info())
+    try:
+        width = thumbnail.thumbnail_width(builder, job)
+        if width is not None:
+            thumbnail.thumbnail_to_cache(builder, cache.path(key), width)
+    except PhixError:
+        log.info('Could not make a thumbnail of {0}'.format(key), exc_info=sys.exc_info())
+    try:
+        raster.queue_rasters(builder, cache.path(key))
+    except PhixError:
+        log.info('Could not queue the rasters of {0}'.format(key), exc_info=sys.exc_info())
+    latex.queue_pdf(builder, cache.path(key))
+
+def forms_prepared(builder, key, job, formats):
+    '''Determine whether the forms of a cached final rendering which are
+    written alongside it are all in the render cache.'''
+    svg_path = get_cache(builder).path(key)
+    if formats and not compress.is_compressed(builder, svg_path, formats):
+        return False
+    try:
+        width = thumbnail.thumbnail_width(builder, job)
+        if width is not None and not thumbnail.is_thumbnailed(builder, svg_path, width):
+            return False
+        if latex.missing_pdf(builder, svg_path):
+            return False
+        return not raster.missing_rasters(builder, svg_path)
+    except PhixError:
+        # The failure is reported when the node is written.
+        return True
+
+_bytes_saved_lock = threading.Lock()
+
+def note_bytes_saved(builder, name, size, optimized_size):
+    '''Report the bytes saved by optimizing a rendering, and add them to the
+    total for the build.'''
+    builder.info('phix: optimized {0} from {1} to {2} bytes, saving {3}'.format(
+        name, size, optimized_size, size - optimized_size))
+    with _bytes_saved_lock:
+        builder.phix_bytes_saved = getattr(builder, 'phix_bytes_saved', 0) + size - optimized_size
+
+def plan_jobs(builder, jobs, render_key, is_cached=None):
+    '''Determine which render jobs need their tool to be run, and which only
+    need a cached tool rendering to be postprocessed.
+
+    Args:
+        builder: The Sphinx builder.
+
+        jobs: The render jobs of a tool, each of which has a 'postprocess'
+            entry.
+
+        render_key: A function which computes the cache key of the tool
+            rendering of a job, without its postprocess.
+
+        is_cached: An optional function which determines whether the cache
+            entry with a given key may be used. By default any entry in the
+            render cache may be used.
+
+    Returns:
+        A 2-tuple. The first element is an ordered dictionary mapping the key of
+        each tool rendering which is needed to the list of jobs which need it.
+        The second is a list of render tasks which postprocess the tool
+        renderings which are already cached, or prepare the forms written
+        alongside final renderings which are cached without them.
+    '''
+    cache = get_cache(builder)
+    if is_cached is None:
+        is_cached = cache.__contains__
+    try:
+        formats = compress.precompress_formats(builder)
+    except PhixError:
+        # The failure is reported when the nodes are written.
+        formats = ()
+    unrendered = collections.OrderedDict()
+    rendered = collections.OrderedDict()
+    prepare_tasks = []
+    final_keys = set()
+    for job in jobs:
+        try:
+            key = render_key(job)
+            final_key = postprocessed_key(builder, key, job['postprocess'])
+        except PhixError:
+            # The failure is reported when the node is written.
+            continue
+        if final_key in final_keys:
+            continue
+        final_keys.add(final_key)
+        if is_cached(final_key):
+            if not forms_prepared(builder, final_key, job, formats):
+                prepare_tasks.append(functools.partial(prepare_forms, builder, final_key, job))
+            continue
+        if final_key != key and is_cached(key):
+            rendered.setdefault(key, []).append(job)
+        else:
+            unrendered.setdefault(key, []).append(job)
+    return unrendered, [functools.partial(postprocess_jobs, builder, key, key_jobs)
+                        for key, key_jobs in rendered.items()] + prepare_tasks
+
+def fetch_rendering(builder, key, postprocess, render_path):
+    '''Copy the postprocessed form of a tool rendering from the render cache.
+
+    Args:
+        builder: The Sphinx builder.
+
+        key: The cache key of the tool rendering.
+
+        postprocess: The postprocess, or None.
+
+        render_path: The path to which the rendering is copied.
+
+    Raises:
+        PhixError: If the rendering is not in the cache, explaining why not.
+    '''
+    final_key = postprocessed_key(builder, key, postprocess)
+    if not get_cache(builder).fetch(final_key, render_path):
+        raise PhixError(render_failure(builder, key, final_key))
+
+def parallel_jobs(config):
+    '''The number of render tasks to run at once.
+
+    Returns:
+        The phix_parallel_jobs configuration value, or the number of CPUs if it
+        is None.
+    '''
+    jobs = config.phix_parallel_jobs
+    if jobs is None:
+        jobs = cpu_count()
+    return max(1, int(jobs))
+
+def cpu_count():
+    try:
+        return multiprocessing.cpu_count()
+    except NotImplementedError:
+        return 1
+
+def available_memory():
+    '''The number of bytes of memory available for new processes.
+
+    Returns:
+        The MemAvailable figure from /proc/meminfo, or None where that is not
+        available.
+    '''
+    try:
+        with open('/proc/meminfo', 'r') as meminfo:
+            for line in meminfo:
+                if line.startswith('MemAvailable:'):
+                    return int(line.split()[1]) * 1024
+    except (IOError, OSError, ValueError, IndexError):
+        pass
+    return None
+
+def load_average():
+    '''The one minute load average, or None where that is not available.'''
+    try:
+        return os.getloadavg()[0]
+    except (AttributeError, OSError):
+        return None
+
+
+class Dispatcher(object):
+    '''Runs render tasks on a number of threads, subject to a limit on the
+    total number of running tasks, a limit for each tool and, optionally, the
+    memory and load of the system.'''
+
+    # How often, in seconds, a throttled dispatcher re-examines the system.
+    poll_interval = 0.5
+
+    def __init__(self, total_limit, tool_limits, memory_estimates=None,
+                 min_free_memory=None, max_load=None):
+        '''
+        Args:
+            total_limit: The largest number of tasks to run at once.
+
+            tool_limits: A dictionary giving the largest number of tasks of
+                each tool to run at once. Tools which are absent are limited
+                only by total_limit.
+
+            memory_estimates: A dictionary giving the number of bytes each task
+                of a tool is expected to need, or None to ignore memory.
+
+            min_free_memory: The number of bytes of memory which must remain
+                available for a new task to start, or None to ignore memory.
+
+            max_load: The load average above which no new task is started, or
+                None to ignore the load.
+        '''
+        self.total_limit = total_limit
+        self.tool_limits = tool_limits
+        self.memory_estimates = memory_estimates or {}
+        self.min_free_memory = min_free_memory
+        self.max_load = max_load
+        self.queues = collections.OrderedDict()
+        self.running = collections.defaultdict(int)
+        self.condition = threading.Condition()
+
+    def add(self, tool, task):
+        self.queues.setdefault(tool, collections.deque()).append(task)
+
+    def pressure(self, tool):
+        '''Determine whether the system is too busy to start a task of tool.'''
+        if self.min_free_memory is not None or tool in self.memory_estimates:
+            memory = available_memory()
+            if memory is not None:
+                needed = (self.min_free_memory or 0) + (self.memory_estimates.get(tool) or 0)
+                if memory < needed:
+                    log.info('Deferring {0} task: {1} bytes available, {2} needed'.format(
+                        tool, memory, needed))
+                    return True
+        if self.max_load is not None:
+            load = load_average()
+            if load is not None and load > self.max_load:
+                log.info('Deferring {0} task: load average {1}'.format(tool, load))
+                return True
+        return False
+
+    def next_task(self):
+        '''Wait until a task may be started.
+
+        Returns:
+            A (tool, task) pair, or None if no tasks remain.
+        '''
+        with self.condition:
+            while True:
+                if not any(self.queues.values()):
+                    return None
+                total_running = sum(self.running.values())
+                if total_running < self.total_limit:
+                    for tool, tasks in self.queues.items():
+                        if not tasks or self.running[tool] >= self.tool_limits.get(tool, self.total_limit):
+                            continue
+                        # Never defer the only task, or nothing would run.
+                        if total_running > 0 and self.pressure(tool):
+                            continue
+                        self.running[tool] += 1
+                        return tool, tasks.popleft()
+                self.condition.wait(self.poll_interval)
+
+    def task_done(self, tool):
+        with self.condition:
+            self.running[tool] -= 1
+            self.condition.notify_all()
+
+    def work(self):
+        while True:
+            item = self.next_task()
+            if item is None:
+                return
+            tool, task = item
+            try:
+                task()
+            except Exception:
+                # A task should record its own failures, but one which does
+                # not must not take its thread, and so part of the capacity to
+                # run the remaining tasks, with it.
+                log.error('A {0} render task failed'.format(tool), exc_info=sys.exc_info())
+            finally:
+                self.task_done(tool)
+
+    def run(self):
+        '''Run all of the tasks, returning when they have finished.'''
+        count = sum(len(tasks) for tasks in self.queues.values())
+        threads = [threading.Thread(target=self.work)
+                   for _ in range(min(self.total_limit, count))]
+        log.info('Running {0} render tasks on {1} threads'.format(count, len(threads)))
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+
+def render_all(app, env):
+    '''Plan and run the render tasks of every phix tool.
+
+    This is called once reading is complete, and returns when all of the tasks
+    have finished.
+
+    Args:
+        app: The Sphinx application.
+
+        env: The Sphinx build environment.
+    '''
+    app.builder.phix_render_failures = {}
+    config = app.config
+
+    adaptive = config.phix_adaptive_jobs
+    dispatcher = Dispatcher(parallel_jobs(config),
+                            dict((tool, max(1, int(limit)))
+                                 for tool, limit in (config.phix_max_jobs or {}).items()),
+                            min_free_memory=parse_size(config.phix_min_free_memory) if adaptive else None,
+                            max_load=(config.phix_max_load or cpu_count()) if adaptive else None)
+
+    for tool, (planner, memory) in app.phix_planners.items():
+        tool_tasks = planner(app, pending_render_jobs(env, tool))
+        log.info('{0} render tasks for {1}'.format(len(tool_tasks), tool))
+        if adaptive and memory is not None and tool_tasks:
+            dispatcher.memory_estimates[tool] = memory()
+        for task in tool_tasks:
+            dispatcher.add(tool, task)
+
+    app.builder.phix_bytes_saved = 0
+    dispatcher.run()
+    raster.rasterize_queued(app.builder)
+    latex.convert_queued(app.builder)
+    if app.builder.phix_bytes_saved:
+        app.builder.info('phix: the optimizer saved {0} bytes in total'.format(
+            app.builder.phix_bytes_saved))
+
+def setup(app):
+    '''Register the configuration values and event handlers of the scheduler.
+
+    This is called for each phix tool which registers a planner, so it does
+    nothing if the scheduler has already been set up.
+    '''
+    if 'phix_parallel_jobs' in app.config:
+        return
+    setup_render_jobs(app)
+    setup_scratch_directory(app)
+    setup_postprocessors(app)
+    app.phix_planners = collections.OrderedDict()
+    app.add_config_value('phix_parallel_jobs', None, '')
+    app.add_config_value('phix_max_jobs', {}, '')
+    app.add_config_value('phix_adaptive_jobs', False, '')
+    app.add_config_value('phix_min_free_memory', '256M', '')
+    app.add_config_value('phix_max_load', None, '')
+    app.add_config_value('phix_optimize_svg', False, '')
+    app.connect('env-updated', render_all)
@@ -0,0 +1,93 @@
+'''Reads the geometry of SVG documents, shared by the ways in which phix embeds
+and previews diagrams.
+'''
+
+import re
+
+from xml.dom import minidom
+from xml.parsers.expat import ExpatError
+
+from .phix import PhixError
+
+# The number of CSS pixels in each absolute unit of length.
+PIXELS_PER_UNIT = {'': 1.0,
+                   'px': 1.0,
+                   'pt': 96.0 / 72,
+                   'pc': 16.0,
+                   'in': 96.0,
+                   'cm': 96.0 / 2.54,
+                   'mm': 96.0 / 25.4}
+
+LENGTH_EXPR = re.compile(r'^\s*([0-9.eE+-]+)\s*([a-z]*)\s*$')
+
+def parse_svg(svg, purpose):
+    try:
+        return minidom.parseString(svg)
+    except ExpatError as e:
+        raise PhixError('Could not parse SVG to {0}: {1}'.format(purpose, e))
+
+def view_box(root):
+    '''Determine the viewBox of an svg element, from its width and height if
+    it has none.
+
+    Returns:
+        The viewBox as a string, or None if it could not be determined.
+    '''
+    if root.hasAttribute('viewBox'):
+        return root.getAttribute('viewBox')
+    try:
+        return '0 0 {0} {1}'.format(float(root.getAttribute('width')),
+                                    float(root.getAttribute('height')))
+    except ValueError:
+        # Dimensions with units cannot be used in a viewBox.
+        return None
+
+def length_in_pixels(length):
+    '''Convert an SVG length, such as 12.5mm, to CSS pixels.
+
+    Returns:
+        The length as a float, or None for a relative length such as 100% or
+        2em, or one which could not be parsed.
+    '''
+    match = LENGTH_EXPR.match(length)
+    if match is None or match.group(2) not in PIXELS_PER_UNIT:
+        return None
+    try:
+        return float(match.group(1)) * PIXELS_PER_UNIT[match.group(2)]
+    except ValueError:
+        return None
+
+def intrinsic_size(svg):
+    '''Determine the size at which an SVG document is drawn by default.
+
+    The size is taken from the width and height of the svg element if both are
+    absolute lengths, and otherwise from its viewBox.
+
+    Args:
+        svg: The SVG document as bytes.
+
+    Returns:
+        A 2-tuple of the width and height in CSS pixels, or None if the size
+        could not be determined.
+
+    Raises:
+        PhixError: If the SVG could not be parsed.
+    '''
+    document = parse_svg(svg, 'determine its size')
+    try:
+        root = document.documentElement
+        width = length_in_pixels(root.getAttribute('width'))
+        height = length_in_pixels(root.getAttribute('height'))
+        if not (width and height):
+            box = root.getAttribute('viewBox').replace(',', ' ').split()
+            if len(box) != 4:
+                return None
+            try:
+                width, height = float(box[2]), float(box[3])
+            except ValueError:
+                return None
+        if width <= 0 or height <= 0:
+            return None
+        return width, height
+    finally:
+        document.unlink()
@@ -0,0 +1,203 @@
+import json
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import unittest
+
+from phix import argouml_server
+from phix.argouml import argouml_version
+from phix.argouml_server import (RenderServer, acquire_launch_lock, address_path, connect,
+                                 create_exclusively, main, worker_command)
+from phix.phix import PhixError
+
+
+# Stands in for a JVM with ArgoUML loaded, writing the name of the current
+# diagram as its graphics. The diagram named Missing is not in the project.
+FAKE_WORKER = '''import sys
+diagram = None
+for line in iter(sys.stdin.readline, ''):
+    action, argument = line.rstrip('\\n').split('=', 1)
+    if action.endswith('ActionGotoDiagram'):
+        diagram = argument
+        if diagram == 'Missing':
+            print('ERROR no such diagram')
+            sys.stdout.flush()
+            continue
+    elif action.endswith('ActionSaveGraphics'):
+        with open(argument, 'w') as output_file:
+            output_file.write('<svg>{0}</svg>'.format(diagram))
+    print('OK')
+    sys.stdout.flush()
+'''
+
+
+class RenderServerTests(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.environ = dict(os.environ)
+        os.environ['XDG_RUNTIME_DIR'] = self.directory
+        self.worker_path = os.path.join(self.directory, 'worker.py')
+        with open(self.worker_path, 'w') as worker_file:
+            worker_file.write(FAKE_WORKER)
+        os.environ['ARGOUML_WORKER_LAUNCH'] = '"{0}" "{1}"'.format(sys.executable, self.worker_path)
+        self.zargo_path = os.path.join(self.directory, 'model.zargo')
+        with open(self.zargo_path, 'wb') as zargo_file:
+            zargo_file.write(b'model')
+        self.server = None
+
+    def tearDown(self):
+        if self.server is not None:
+            self.server.stopping = True
+            self.thread.join()
+        os.environ.clear()
+        os.environ.update(self.environ)
+        shutil.rmtree(self.directory)
+
+    def start(self, idle_timeout=60, version=None):
+        self.server = RenderServer(idle_timeout, 2, worker_command(), version)
+        self.thread = threading.Thread(target=self.server.serve, args=(address_path(),))
+        self.thread.daemon = True
+        self.thread.start()
+        deadline = time.time() + 5
+        while time.time() < deadline:
+            connected = connect()
+            if connected is not None:
+                connected[0].close()
+                return
+            time.sleep(0.05)
+        self.fail('The server did not start')
+
+    def send(self, message):
+        connection, _ = connect()
+        try:
+            connection.sendall((json.dumps(message) + '\n').encode('utf-8'))
+            return json.loads(connection.makefile('rb').readline().decode('utf-8'))
+        finally:
+            connection.close()
+
+    def test_address_is_private(self):
+        self.start()
+        self.assertEqual(os.path.dirname(address_path()), self.directory)
+        if os.name == 'posix':
+            self.assertEqual(os.stat(address_path()).st_mode & 0o777, 0o600)
+
+    def test_render(self):
+        self.start()
+        classes_path = os.path.join(self.directory, 'classes.svg')
+        missing_path = os.path.join(self.directory, 'missing.svg')
+        argouml_server.render(self.zargo_path, [('Classes', classes_path), ('Missing', missing_path)])
+        with open(classes_path, 'r') as classes_file:
+            self.assertEqual(classes_file.read(), '<svg>Classes</svg>')
+        self.assertFalse(os.path.exists(missing_path))
+
+    def test_commands_in_requests_are_not_run(self):
+        self.start()
+        pwned_path = os.path.join(self.directory, 'pwned')
+        command = [sys.executable, '-c', 'open({0!r}, "w")'.format(pwned_path)]
+        response = argouml_server.request({'command': 'render',
+                                           'zargo': self.zargo_path,
+                                           'diagrams': [],
+                                           'launch': command,
+                                           'worker': command})
+        self.assertFalse(response['ok'])
+        self.assertFalse(os.path.exists(pwned_path))
+
+    def test_server_of_another_version_retires(self):
+        self.start(version='argouml 0.34')
+        classes_path = os.path.join(self.directory, 'classes.svg')
+        response = argouml_server.request({'command': 'render',
+                                           'zargo': self.zargo_path,
+                                           'diagrams': [('Classes', classes_path)],
+                                           'worker': worker_command(),
+                                           'version': argouml_version()})
+        self.assertTrue(response['retired'])
+        self.assertFalse(os.path.exists(classes_path))
+        self.thread.join(5)
+        self.assertFalse(self.thread.is_alive())
+        self.server = None
+
+    def test_client_replaces_server_of_another_version(self):
+        self.start(version='argouml 0.34')
+        classes_path = os.path.join(self.directory, 'classes.svg')
+        try:
+            argouml_server.render(self.zargo_path, [('Classes', classes_path)])
+        finally:
+            main(['--stop'])
+        with open(classes_path, 'r') as classes_file:
+            self.assertEqual(classes_file.read(), '<svg>Classes</svg>')
+        self.thread.join(5)
+        self.server = None
+
+    def test_bad_token_is_rejected(self):
+        self.start()
+        classes_path = os.path.join(self.directory, 'classes.svg')
+        response = self.send({'command': 'render',
+                              'token': 'guessed',
+                              'zargo': self.zargo_path,
+                              'diagrams': [('Classes', classes_path)]})
+        self.assertEqual(response, {'ok': False, 'error': 'Invalid token'})
+        self.assertFalse(os.path.exists(classes_path))
+
+    def test_idle_server_exits(self):
+        self.start(idle_timeout=0.2)
+        self.thread.join(5)
+        self.assertFalse(self.thread.is_alive())
+        self.assertFalse(os.path.exists(address_path()))
+        self.server = None
+
+    def test_only_one_server_serves(self):
+        self.start()
+        other = RenderServer(60, 2, worker_command())
+        self.assertRaises(PhixError, other.serve, address_path())
+
+    def test_busy_worker_is_closed_when_it_is_done(self):
+        server = RenderServer(60, 1, worker_command())
+        try:
+            first = server.worker(self.zargo_path)
+            first.lock.acquire()
+            thread = threading.Thread(target=server.worker, args=('other.zargo',))
+            thread.start()
+            time.sleep(0.2)
+            # The first worker is evicted, but is still rendering.
+            self.assertFalse(first.closed)
+            self.assertEqual(first.process.poll(), None)
+            first.lock.release()
+            thread.join(10)
+            self.assertTrue(first.closed)
+        finally:
+            for worker in server.workers.values():
+                worker.close()
+            server.server_close()
+
+    def test_server_needs_a_worker(self):
+        worker_launch = os.environ.pop('ARGOUML_WORKER_LAUNCH', None)
+        try:
+            self.assertRaises(SystemExit, main, ['--idle-timeout', '0.1'])
+        finally:
+            if worker_launch is not None:
+                os.environ['ARGOUML_WORKER_LAUNCH'] = worker_launch
+        self.assertFalse(os.path.exists(address_path()))
+
+
+class LaunchLockTests(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.lock_path = os.path.join(self.directory, 'server.lock')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_only_one_build_launches(self):
+        self.assertTrue(acquire_launch_lock(self.lock_path))
+        self.assertFalse(acquire_launch_lock(self.lock_path))
+
+    def test_stale_lock_is_broken(self):
+        create_exclusively(self.lock_path).close()
+        os.utime(self.lock_path, (1000, 1000))
+        self.assertTrue(acquire_launch_lock(self.lock_path))
+
+if __name__ == '__main__':
+    unittest.main()
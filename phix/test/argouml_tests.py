@@ -0,0 +1,150 @@
+import json
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+from phix.argouml import argouml_version, create_graphics_batch, plan_render, render_key
+from phix.cache import get_cache
+from phix.phix import PhixError
+from phix.scheduler import render_failure
+from phix.test.fakes import App, Builder
+
+
+# Stands in for ArgoUML in batch mode, recording the arguments of each launch
+# and writing the name of each diagram as its graphics. The diagram named
+# Missing is not in the project, and a project which says broken cannot be
+# opened.
+FAKE_ARGOUML = '''import json
+import os
+import sys
+args = sys.argv[1:]
+with open(os.environ['FAKE_ARGOUML_LOG'], 'a') as log_file:
+    log_file.write(json.dumps(args) + '\\n')
+diagram = None
+for index in range(1, len(args), 2):
+    action, argument = args[index + 1].split('=', 1)
+    if action.endswith('ActionOpenProject'):
+        with open(argument, 'r') as zargo_file:
+            if zargo_file.read() == 'broken':
+                sys.exit(1)
+    elif action.endswith('ActionGotoDiagram'):
+        diagram = argument
+    elif action.endswith('ActionSaveGraphics') and diagram != 'Missing':
+        with open(argument, 'w') as output_file:
+            output_file.write('<svg>{0}</svg>'.format(diagram))
+'''
+
+
+class ArgoUmlTests(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        argouml_path = os.path.join(self.directory, 'argouml.py')
+        with open(argouml_path, 'w') as argouml_file:
+            argouml_file.write(FAKE_ARGOUML)
+        self.log_path = os.path.join(self.directory, 'argouml.log')
+        self.environ = dict(os.environ)
+        os.environ['ARGOUML_LAUNCH'] = '"{0}" "{1}"'.format(sys.executable, argouml_path)
+        os.environ['FAKE_ARGOUML_LOG'] = self.log_path
+        self.zargo_path = self.zargo('model.zargo', 'model')
+        self.builder = Builder(self.directory)
+        self.builder.phix_scratch_dir = os.path.join(self.directory, 'scratch')
+        os.makedirs(self.builder.phix_scratch_dir)
+
+    def tearDown(self):
+        os.environ.clear()
+        os.environ.update(self.environ)
+        shutil.rmtree(self.directory)
+
+    def zargo(self, name, content):
+        zargo_path = os.path.join(self.directory, name)
+        with open(zargo_path, 'w') as zargo_file:
+            zargo_file.write(content)
+        return zargo_path
+
+    def launches(self):
+        with open(self.log_path, 'r') as log_file:
+            return [json.loads(line) for line in log_file]
+
+    def render(self, jobs):
+        for task in plan_render(App(self.builder), jobs):
+            task()
+        return [render_key(job) for job in jobs]
+
+    def test_command_opens_the_project_once(self):
+        classes_path = os.path.join(self.directory, 'classes.svg')
+        states_path = os.path.join(self.directory, 'states.svg')
+        create_graphics_batch(self.zargo_path, [('Classes', classes_path), ('States', states_path)])
+        self.assertEqual(self.launches(), [[
+            '-batch',
+            '-command', 'org.argouml.uml.ui.ActionOpenProject=' + self.zargo_path,
+            '-command', 'org.argouml.ui.cmd.ActionGotoDiagram=Classes',
+            '-command', 'org.argouml.uml.ui.ActionSaveGraphics=' + classes_path,
+            '-command', 'org.argouml.ui.cmd.ActionGotoDiagram=States',
+            '-command', 'org.argouml.uml.ui.ActionSaveGraphics=' + states_path]])
+        with open(states_path, 'r') as states_file:
+            self.assertEqual(states_file.read(), '<svg>States</svg>')
+
+    def test_failed_launch_raises_phix_error(self):
+        self.assertRaises(PhixError,
+                          create_graphics_batch,
+                          self.zargo('broken.zargo', 'broken'),
+                          [('Classes', os.path.join(self.directory, 'classes.svg'))])
+
+    def test_missing_diagram_fails_alone(self):
+        keys = self.render([{'uri': self.zargo_path, 'diagram': diagram, 'postprocess': None}
+                            for diagram in ('Classes', 'Missing', 'States')])
+        self.assertEqual(len(self.launches()), 1)
+        cache = get_cache(self.builder)
+        self.assertEqual([key in cache for key in keys], [True, False, True])
+        self.assertTrue(render_failure(self.builder, keys[1]).startswith(
+            'The diagram Missing was not exported.'))
+
+    def test_daemon_without_worker_launches_argouml(self):
+        os.environ.pop('ARGOUML_WORKER_LAUNCH', None)
+        self.builder.config.phix_argouml_daemon = True
+        keys = self.render([{'uri': self.zargo_path, 'diagram': 'Classes', 'postprocess': None}])
+        self.assertEqual(len(self.launches()), 1)
+        self.assertTrue(keys[0] in get_cache(self.builder))
+        self.assertEqual(len(self.builder.warnings), 1)
+        self.assertTrue(self.builder.warnings[0].startswith('phix_argouml_daemon is set, but'))
+
+    def test_failed_launch_fails_each_diagram(self):
+        zargo_path = self.zargo('broken.zargo', 'broken')
+        keys = self.render([{'uri': zargo_path, 'diagram': diagram, 'postprocess': None}
+                            for diagram in ('Classes', 'States')])
+        for key in keys:
+            self.assertFalse(key in get_cache(self.builder))
+            self.assertTrue(render_failure(self.builder, key).startswith('Could not launch ArgoUML'))
+
+class ArgoUmlVersionTests(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.environ = dict(os.environ)
+        os.environ.pop('ARGOUML_LAUNCH', None)
+        os.environ['PATH'] = os.pathsep.join([self.directory, os.environ.get('PATH', '')])
+        self.jar_path = os.path.join(self.directory, 'argouml.jar')
+        self.write(self.jar_path, 'jar')
+        script_path = os.path.join(self.directory, 'argouml')
+        self.write(script_path, '#!/bin/sh\nexec java -jar "$(dirname "$0")/argouml.jar" "$@"\n')
+        os.chmod(script_path, 0o755)
+
+    def tearDown(self):
+        os.environ.clear()
+        os.environ.update(self.environ)
+        shutil.rmtree(self.directory)
+
+    def write(self, path, content):
+        with open(path, 'w') as output_file:
+            output_file.write(content)
+
+    @unittest.skipIf(os.name != 'posix', 'the launch script is a shell script')
+    def test_script_on_path_and_its_jar_are_identified(self):
+        version = argouml_version()
+        self.assertTrue(os.path.join(self.directory, 'argouml') + ':' in version)
+        self.write(self.jar_path, 'upgraded jar')
+        self.assertNotEqual(argouml_version(), version)
+
+if __name__ == '__main__':
+    unittest.main()
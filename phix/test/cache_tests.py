@@ -0,0 +1,172 @@
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+
+from phix.cache import RenderCache, cache_key, main, parse_size
+from phix.phix import PhixError
+
+
+class CacheKeyTests(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.source_path = os.path.join(self.directory, 'test.wsd')
+        with open(self.source_path, 'wb') as source_file:
+            source_file.write(b'A->B: hello')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_key_is_stable(self):
+        self.assertEqual(cache_key(self.source_path, 'wsd', 'rose'),
+                         cache_key(self.source_path, 'wsd', 'rose'))
+
+    def test_key_depends_on_options(self):
+        self.assertNotEqual(cache_key(self.source_path, 'wsd', 'rose'),
+                            cache_key(self.source_path, 'wsd', 'napkin'))
+
+    def test_key_depends_on_source_bytes(self):
+        before = cache_key(self.source_path, 'wsd')
+        with open(self.source_path, 'wb') as source_file:
+            source_file.write(b'A->B: goodbye')
+        self.assertNotEqual(before, cache_key(self.source_path, 'wsd'))
+
+    def test_missing_source_raises_phix_error(self):
+        self.assertRaises(PhixError,
+                          cache_key,
+                          os.path.join(self.directory, 'missing.wsd'))
+
+
+class RenderCacheTests(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.cache = RenderCache(os.path.join(self.directory, 'cache'))
+        self.rendered_path = os.path.join(self.directory, 'rendered.svg')
+        with open(self.rendered_path, 'wb') as rendered_file:
+            rendered_file.write(b'<svg/>')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_fetch_misses_when_empty(self):
+        destination = os.path.join(self.directory, 'out.svg')
+        self.assertFalse(self.cache.fetch('0123abcd', destination))
+        self.assertFalse(os.path.exists(destination))
+
+    def test_fetch_after_store(self):
+        self.cache.store('0123abcd', self.rendered_path)
+        destination = os.path.join(self.directory, 'out', 'out.svg')
+        self.assertTrue(self.cache.fetch('0123abcd', destination))
+        with open(destination, 'rb') as destination_file:
+            self.assertEqual(destination_file.read(), b'<svg/>')
+
+    def test_metadata_is_stored_with_entry(self):
+        self.cache.store('0123abcd', self.rendered_path, metadata={'fetched': 1000})
+        self.assertEqual(self.cache.metadata('0123abcd'), {'fetched': 1000})
+
+    def test_metadata_is_none_when_absent(self):
+        self.cache.store('0123abcd', self.rendered_path)
+        self.assertEqual(self.cache.metadata('0123abcd'), None)
+
+    def test_concurrent_stores_of_one_entry_succeed(self):
+        failures = []
+        def store():
+            try:
+                for _ in range(50):
+                    self.cache.store('0123abcd', self.rendered_path, metadata={'fetched': 1000})
+            except PhixError as e:
+                failures.append(e)
+        threads = [threading.Thread(target=store) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(failures, [])
+        self.assertEqual(sorted(os.listdir(os.path.dirname(self.cache.path('0123abcd')))),
+                         ['0123abcd.json', '0123abcd.svg'])
+        self.assertEqual(self.cache.metadata('0123abcd'), {'fetched': 1000})
+
+    def test_storing_without_metadata_removes_stale_metadata(self):
+        self.cache.store('0123abcd', self.rendered_path, metadata={'fetched': 1000})
+        self.cache.store('0123abcd', self.rendered_path, suffix='.svgz')
+        self.assertEqual(self.cache.metadata('0123abcd'), {'fetched': 1000})
+        self.cache.store('0123abcd', self.rendered_path)
+        self.assertEqual(self.cache.metadata('0123abcd'), None)
+
+    def test_entry_and_metadata_are_evicted_together(self):
+        self.cache.store('aa01', self.rendered_path, metadata={'fetched': 1000})
+        self.cache.store('bb02', self.rendered_path, metadata={'fetched': 1000})
+        for key, last_used in (('aa01', 1000), ('bb02', 2000)):
+            os.utime(self.cache.path(key), (last_used, last_used))
+            os.utime(self.cache.path(key, '.json'), (last_used, last_used))
+        # A recent fetch of aa01 touches only its rendering.
+        os.utime(self.cache.path('aa01'), (3000, 3000))
+        self.assertEqual(len(self.cache.entries()), 2)
+        self.cache.max_size = self.cache.stats()['size'] - 1
+        self.assertEqual(self.cache.evict(), 1)
+        self.assertTrue(os.path.exists(self.cache.path('aa01')))
+        self.assertTrue(os.path.exists(self.cache.path('aa01', '.json')))
+        self.assertFalse(os.path.exists(self.cache.path('bb02')))
+        self.assertFalse(os.path.exists(self.cache.path('bb02', '.json')))
+
+    def test_evict_removes_least_recently_used(self):
+        self.cache.store('aa01', self.rendered_path)
+        self.cache.store('bb02', self.rendered_path)
+        os.utime(self.cache.path('aa01'), (1000, 1000))
+        os.utime(self.cache.path('bb02'), (2000, 2000))
+        self.cache.max_size = len(b'<svg/>')
+        self.assertEqual(self.cache.evict(), 1)
+        self.assertFalse(os.path.exists(self.cache.path('aa01')))
+        self.assertTrue(os.path.exists(self.cache.path('bb02')))
+
+    def test_stats_accumulate_across_builds(self):
+        self.cache.store('aa01', self.rendered_path)
+        destination = os.path.join(self.directory, 'out.svg')
+        self.cache.fetch('aa01', destination)
+        self.cache.fetch('bb02', destination)
+        self.cache.save_stats()
+        self.cache.fetch('aa01', destination)
+        self.cache.save_stats()
+        stats = RenderCache(self.cache.directory).stats()
+        self.assertEqual(stats['entries'], 1)
+        self.assertEqual(stats['hits'], 2)
+        self.assertEqual(stats['misses'], 1)
+        self.assertAlmostEqual(stats['hit_ratio'], 2.0 / 3)
+
+    def test_clear_removes_entries_and_stats(self):
+        self.cache.store('aa01', self.rendered_path, metadata={'fetched': 1000})
+        self.cache.fetch('aa01', os.path.join(self.directory, 'out.svg'))
+        self.cache.save_stats()
+        self.cache.clear()
+        self.assertEqual(os.listdir(self.cache.directory), [])
+
+    def test_clear_refuses_what_is_not_a_cache(self):
+        self.cache.store('aa01', self.rendered_path)
+        for path in (os.path.join(self.cache.directory, 'notes.txt'),
+                     os.path.join(self.cache.directory, 'aa', 'notes.txt')):
+            with open(path, 'w') as other_file:
+                other_file.write('mine')
+            self.assertRaises(PhixError, self.cache.clear)
+            self.assertTrue('aa01' in self.cache)
+            os.remove(path)
+
+    def test_main_refuses_to_clear_what_is_not_a_cache(self):
+        with open(os.path.join(self.directory, 'notes.txt'), 'w') as other_file:
+            other_file.write('mine')
+        self.assertRaises(SystemExit, main, ['--dir', self.directory, '--clear'])
+        self.assertTrue(os.path.exists(self.rendered_path))
+
+
+class ParseSizeTests(unittest.TestCase):
+    def test_units(self):
+        self.assertEqual(parse_size('512'), 512)
+        self.assertEqual(parse_size('2k'), 2048)
+        self.assertEqual(parse_size('1.5G'), 3 * 1024 ** 3 // 2)
+        self.assertEqual(parse_size(None), None)
+
+    def test_nonsense_raises_phix_error(self):
+        self.assertRaises(PhixError, parse_size, 'lots')
+
+if __name__ == '__main__':
+    unittest.main()
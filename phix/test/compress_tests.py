@@ -0,0 +1,87 @@
+import gzip
+import io
+import os
+import shutil
+import tempfile
+import unittest
+
+from phix import compress
+from phix.cache import get_cache
+from phix.compress import compress_to_cache, precompress_formats, write_precompressed
+from phix.phix import PhixError
+from phix.scheduler import plan_jobs
+from phix.test.fakes import Builder
+
+
+SVG = b'<svg xmlns="http://www.w3.org/2000/svg">' + b'<rect width="10" height="10"/>' * 100 + b'</svg>'
+
+
+class PrecompressTests(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.builder = Builder(self.directory, phix_precompress=['gz', 'svgz'])
+        self.render_path = os.path.join(self.directory, '_images', 'diagram.svg')
+        os.makedirs(os.path.dirname(self.render_path))
+        with open(self.render_path, 'wb') as render_file:
+            render_file.write(SVG)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def read(self, path):
+        with open(path, 'rb') as input_file:
+            return input_file.read()
+
+    def test_siblings_are_written(self):
+        write_precompressed(self.builder, self.render_path)
+        compressed = self.read(os.path.join(self.directory, '_images', 'diagram.svg.gz'))
+        self.assertEqual(gzip.GzipFile(fileobj=io.BytesIO(compressed)).read(), SVG)
+        self.assertEqual(self.read(os.path.join(self.directory, '_images', 'diagram.svgz')), compressed)
+        self.assertTrue(len(compressed) < len(SVG))
+
+    def test_compression_is_deterministic(self):
+        self.assertEqual(compress.compress(SVG, 'gzip'), compress.compress(SVG, 'gzip'))
+
+    def test_compressed_forms_are_cached(self):
+        key = compress_to_cache(self.builder, self.render_path, ['gz'])
+        cache = get_cache(self.builder)
+        self.assertTrue(os.path.isfile(cache.path(key, '.svg.gz')))
+        self.assertFalse(os.path.isfile(cache.path(key, '.svgz')))
+        original = compress.compress
+        compress.compress = None
+        try:
+            self.assertEqual(compress_to_cache(self.builder, self.render_path, ['gz']), key)
+        finally:
+            compress.compress = original
+
+    def test_nothing_is_written_by_default(self):
+        self.builder.config.phix_precompress = []
+        write_precompressed(self.builder, self.render_path)
+        self.assertEqual(os.listdir(os.path.dirname(self.render_path)), ['diagram.svg'])
+
+    def test_only_html_is_precompressed(self):
+        self.builder.format = 'latex'
+        self.assertEqual(precompress_formats(self.builder), ())
+
+    def test_unknown_format_raises_phix_error(self):
+        self.builder.config.phix_precompress = ['zip']
+        self.assertRaises(PhixError, precompress_formats, self.builder)
+
+    @unittest.skipIf(compress.brotli is None, 'brotli is not installed')
+    def test_brotli(self):
+        self.builder.config.phix_precompress = 'br'
+        write_precompressed(self.builder, self.render_path)
+        compressed = self.read(os.path.join(self.directory, '_images', 'diagram.svg.br'))
+        self.assertEqual(compress.brotli.decompress(compressed), SVG)
+
+    def test_cached_renderings_are_planned_for_compression(self):
+        cache = get_cache(self.builder)
+        cache.store('aa01', self.render_path)
+        unrendered, tasks = plan_jobs(self.builder, [{'postprocess': None}], lambda job: 'aa01')
+        self.assertEqual((len(unrendered), len(tasks)), (0, 1))
+        tasks[0]()
+        unrendered, tasks = plan_jobs(self.builder, [{'postprocess': None}], lambda job: 'aa01')
+        self.assertEqual((len(unrendered), len(tasks)), (0, 0))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,114 @@
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+from phix.cache import get_cache
+from phix.dia import make_batches, plan_render, render_batch, render_key
+from phix.scheduler import render_failure
+from phix.test.fakes import App, Builder
+
+
+# Stands in for Dia, recording the files of each launch. A file which says
+# broken cannot be exported at all, and one which says alone is exported
+# only when it is exported on its own.
+FAKE_DIA = '''import os
+import sys
+args = sys.argv[1:]
+if args == ['--version']:
+    print('0.97.3')
+    sys.exit(0)
+if args[0] == '-t':
+    output_dir, dia_paths = args[3], args[4:]
+    outputs = [(dia_path, os.path.join(output_dir, os.path.splitext(os.path.basename(dia_path))[0] + '.svg'))
+               for dia_path in dia_paths]
+else:
+    outputs = [(args[0], args[2])]
+with open(os.environ['FAKE_DIA_LOG'], 'a') as log_file:
+    log_file.write(' '.join(os.path.basename(dia_path) for dia_path, _ in outputs) + '\\n')
+status = 0
+for dia_path, output_path in outputs:
+    with open(dia_path, 'r') as dia_file:
+        content = dia_file.read()
+    if content == 'broken' or (content == 'alone' and len(outputs) > 1):
+        status = 1
+        continue
+    with open(output_path, 'w') as output_file:
+        output_file.write('<svg>{0}</svg>'.format(content))
+sys.exit(status if len(outputs) == 1 else 0)
+'''
+
+
+class MakeBatchesTests(unittest.TestCase):
+    def test_files_with_one_basename_are_in_different_batches(self):
+        self.assertEqual(make_batches(['a/x.dia', 'b/x.dia', 'a/y.dia', 'c/x.dia'], 50),
+                         [['a/x.dia', 'a/y.dia'], ['b/x.dia'], ['c/x.dia']])
+
+    def test_batches_are_no_larger_than_the_batch_size(self):
+        dia_uris = ['{0}.dia'.format(index) for index in range(5)]
+        self.assertEqual(make_batches(dia_uris, 2),
+                         [['0.dia', '1.dia'], ['2.dia', '3.dia'], ['4.dia']])
+
+
+class RenderBatchTests(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        dia_path = os.path.join(self.directory, 'dia.py')
+        with open(dia_path, 'w') as dia_file:
+            dia_file.write(FAKE_DIA)
+        self.log_path = os.path.join(self.directory, 'launches.log')
+        self.environ = dict(os.environ)
+        os.environ['DIA_LAUNCH'] = '"{0}" "{1}"'.format(sys.executable, dia_path)
+        os.environ['FAKE_DIA_LOG'] = self.log_path
+        self.builder = Builder(self.directory, phix_dia_batch_size=2)
+        self.builder.phix_scratch_dir = os.path.join(self.directory, 'scratch')
+        os.makedirs(self.builder.phix_scratch_dir)
+
+    def tearDown(self):
+        os.environ.clear()
+        os.environ.update(self.environ)
+        shutil.rmtree(self.directory)
+
+    def jobs(self, contents):
+        jobs = []
+        for name, content in contents:
+            dia_uri = os.path.join(self.directory, name)
+            with open(dia_uri, 'w') as dia_file:
+                dia_file.write(content)
+            jobs.append({'uri': dia_uri, 'postprocess': None})
+        return jobs
+
+    def launches(self):
+        with open(self.log_path, 'r') as log_file:
+            return log_file.read().splitlines()
+
+    def test_each_batch_is_one_launch(self):
+        jobs = self.jobs([('a.dia', 'a'), ('b.dia', 'b'), ('c.dia', 'c')])
+        tasks = plan_render(App(self.builder), jobs)
+        self.assertEqual(len(tasks), 2)
+        for task in tasks:
+            task()
+        self.assertEqual(self.launches(), ['a.dia b.dia', 'c.dia'])
+        cache = get_cache(self.builder)
+        for job in jobs:
+            with open(cache.path(render_key(job)), 'r') as entry_file:
+                self.assertEqual(entry_file.read(), '<svg>{0}</svg>'.format(
+                    os.path.splitext(os.path.basename(job['uri']))[0]))
+
+    def test_files_missing_from_a_batch_are_rendered_alone(self):
+        jobs = self.jobs([('good.dia', 'good'), ('alone.dia', 'alone'), ('broken.dia', 'broken')])
+        keys = [render_key(job) for job in jobs]
+        render_batch(App(self.builder),
+                     dict((job['uri'], {key: [job]}) for job, key in zip(jobs, keys)))
+        launches = self.launches()
+        self.assertEqual(sorted(launches[0].split()), ['alone.dia', 'broken.dia', 'good.dia'])
+        self.assertEqual(sorted(launches[1:]), ['alone.dia', 'broken.dia'])
+        cache = get_cache(self.builder)
+        self.assertTrue(keys[0] in cache)
+        self.assertTrue(keys[1] in cache)
+        self.assertFalse(keys[2] in cache)
+        self.assertTrue(render_failure(self.builder, keys[2]).startswith('Could not launch Dia'))
+
+if __name__ == '__main__':
+    unittest.main()
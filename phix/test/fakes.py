@@ -0,0 +1,140 @@
+'''Stand-ins for the Sphinx objects, and the external converters, used by the
+phix tests.'''
+
+import os
+
+# The configuration values registered by the phix extensions, with their
+# defaults, except that the cache has no size limit.
+DEFAULTS = {
+    'phix_adaptive_jobs': False,
+    'phix_argouml_daemon': False,
+    'phix_argouml_daemon_projects': 2,
+    'phix_argouml_daemon_timeout': 900,
+    'phix_cache_dir': None,
+    'phix_cache_size': None,
+    'phix_dia_batch_size': 50,
+    'phix_html_embed': 'object',
+    'phix_html_lazy': False,
+    'phix_html_sprite_scope': 'page',
+    'phix_inkscape_shell': 1,
+    'phix_max_jobs': {},
+    'phix_max_load': None,
+    'phix_min_free_memory': '256M',
+    'phix_optimize_svg': False,
+    'phix_parallel_jobs': None,
+    'phix_pdf_converter': None,
+    'phix_postprocessors': {},
+    'phix_precompress': [],
+    'phix_raster_formats': [],
+    'phix_raster_widths': [480, 960, 1920],
+    'phix_rasterizer': None,
+    'phix_scratch_dir': None,
+    'phix_thumbnail': False,
+    'phix_thumbnail_width': 240,
+    'phix_wsd_cache_ttl': None,
+    'phix_wsd_connect_timeout': 10,
+    'phix_wsd_engine': 'server',
+    'phix_wsd_failure_limit': 3,
+    'phix_wsd_fallback': True,
+    'phix_wsd_max_in_flight': 8,
+    'phix_wsd_rate_limit': None,
+    'phix_wsd_read_timeout': 60,
+    'phix_wsd_refresh': False,
+}
+
+
+class Config(object):
+    '''A Sphinx configuration holding every phix configuration value.'''
+
+    def __init__(self, **values):
+        '''
+        Args:
+            values: Configuration values which differ from DEFAULTS.
+        '''
+        self.__dict__.update(DEFAULTS)
+        self.__dict__.update(values)
+
+    def __contains__(self, name):
+        return name in self.__dict__
+
+
+class Builder(object):
+    '''A Sphinx builder, which records the messages and warnings it is given.'''
+
+    def __init__(self, directory, format='html', **values):
+        '''
+        Args:
+            directory: A directory, within which the builder has its doctree
+                and output directories.
+
+            format: The format the builder writes, such as html or latex.
+
+            values: Configuration values which differ from DEFAULTS.
+        '''
+        self.config = Config(**values)
+        self.format = format
+        self.doctreedir = os.path.join(directory, 'doctrees')
+        self.outdir = os.path.join(directory, format)
+        if format == 'html':
+            self.imgpath = '../_images'
+        self.current_docname = 'index'
+        self.phix_render_failures = {}
+        self.messages = []
+        self.warnings = []
+
+    def info(self, message):
+        self.messages.append(message)
+
+    def warn(self, message):
+        self.warnings.append(message)
+
+
+class Environment(object):
+    '''A Sphinx build environment.'''
+
+    def __init__(self, found_docs):
+        self.found_docs = set(found_docs)
+
+
+class App(object):
+    '''A Sphinx application.'''
+
+    def __init__(self, builder, found_docs=('index',)):
+        '''
+        Args:
+            builder: The builder of the build.
+
+            found_docs: The names of the documents of the project.
+        '''
+        self.builder = builder
+        self.config = builder.config
+        self.env = Environment(found_docs)
+
+
+class Translator(object):
+    '''A Sphinx translator, such as the HTML or LaTeX translator.'''
+
+    def __init__(self, builder):
+        self.builder = builder
+        self.body = []
+
+
+class Exporter(object):
+    '''A stand-in for a converter from SVG, such as the rasterizer, to be
+    installed in place of a function such as raster.png_exporter.
+
+    Each export writes the name of the SVG file, followed by any further
+    arguments such as the width, to the output file, and is recorded in
+    exports.
+    '''
+
+    def __init__(self):
+        self.exports = []
+
+    def __call__(self, builder):
+        def export(svg_path, output_path, *args):
+            self.exports.append((svg_path,) + args)
+            with open(output_path, 'wb') as output_file:
+                output_file.write(' '.join([os.path.basename(svg_path)] +
+                                           [str(arg) for arg in args]).encode('ascii'))
+        return export, lambda: None
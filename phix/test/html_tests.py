@@ -0,0 +1,306 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from phix.html import (SpriteDiagram, append_diagram, append_page_sprite, inline_svg,
+                       lazy_markup, object_markup, sprite_use, thumbnail_markup,
+                       write_site_sprite)
+from phix.phix import PhixError
+from phix.svg import intrinsic_size
+from phix.test.fakes import App, Builder, Translator
+
+
+DIAGRAM = b'''<?xml version="1.0" encoding="UTF-8"?>
+<!DOCTYPE svg PUBLIC "-//W3C//DTD SVG 1.1//EN" "http://www.w3.org/Graphics/SVG/1.1/DTD/svg11.dtd">
+<svg xmlns="http://www.w3.org/2000/svg" xmlns:xlink="http://www.w3.org/1999/xlink"
+     width="200" height="100">
+  <style type="text/css">.box{fill:url(#shade)} .other{stroke:red}</style>
+  <defs>
+    <linearGradient id="shade"><stop offset="0"/></linearGradient>
+    <marker id="arrow"><path d="M 0,0 L 5,0"/></marker>
+  </defs>
+  <rect class="box" x="0" y="0" width="10" height="10" style="marker-end:url(#arrow)"/>
+  <use xlink:href="#arrow"/>
+  <a xlink:href="#elsewhere"/>
+</svg>'''
+
+
+class InlineSvgTests(unittest.TestCase):
+    def test_ids_and_references_are_prefixed(self):
+        markup = inline_svg(DIAGRAM, 'phix1-')
+        self.assertTrue('id="phix1-shade"' in markup)
+        self.assertTrue('id="phix1-arrow"' in markup)
+        self.assertTrue('url(#phix1-shade)' in markup)
+        self.assertTrue('marker-end:url(#phix1-arrow)' in markup)
+        self.assertTrue('xlink:href="#phix1-arrow"' in markup)
+        self.assertFalse('id="shade"' in markup)
+
+    def test_references_to_other_ids_are_kept(self):
+        self.assertTrue('xlink:href="#elsewhere"' in inline_svg(DIAGRAM, 'phix1-'))
+
+    def test_classes_are_prefixed(self):
+        markup = inline_svg(DIAGRAM, 'phix1-')
+        self.assertTrue('class="phix1-box"' in markup)
+        self.assertTrue('.phix1-box{' in markup)
+        # Selectors for classes which the diagram does not use match nothing,
+        # rather than elements of the page.
+        self.assertTrue(':not(*){stroke:red}' in markup)
+        self.assertFalse('.other' in markup)
+
+    def test_id_selectors_are_prefixed(self):
+        markup = inline_svg(b'<svg><style>#box, .box #box {fill:red}</style>'
+                            b'<rect id="box" class="box"/></svg>', 'phix1-')
+        self.assertTrue('#phix1-box, .phix1-box #phix1-box {fill:red}' in markup)
+
+    def test_group_rules_are_renamed_within(self):
+        markup = inline_svg(b'<svg><style>@media print{.box{fill:red}}</style>'
+                            b'<rect class="box"/></svg>', 'phix1-')
+        self.assertTrue('@media print{.phix1-box{fill:red}}' in markup)
+
+    def test_unscoped_rules_raise_phix_error(self):
+        for style in (b'rect{fill:red}', b'.box, *{fill:red}'):
+            self.assertRaises(PhixError, inline_svg,
+                              b'<svg><style>' + style + b'</style><rect class="box"/></svg>',
+                              'phix1-')
+
+    def test_prologue_is_dropped(self):
+        markup = inline_svg(DIAGRAM, 'phix1-')
+        self.assertTrue(markup.startswith('<svg'))
+        self.assertFalse('DOCTYPE' in markup)
+
+    def test_size_scales_the_drawing(self):
+        markup = inline_svg(DIAGRAM, 'phix1-', width='50%', height='100%')
+        self.assertTrue('viewBox="0 0 200.0 100.0"' in markup)
+        self.assertTrue('width="50%"' in markup)
+        self.assertFalse('height=' in markup.split('>')[0])
+
+    def test_border(self):
+        self.assertTrue('border: 2px solid' in inline_svg(DIAGRAM, 'phix1-', border=2))
+
+    def test_invalid_svg_raises_phix_error(self):
+        self.assertRaises(PhixError, inline_svg, b'<svg>', 'phix1-')
+
+
+class SizeTests(unittest.TestCase):
+    def test_size_from_width_and_height(self):
+        self.assertEqual(intrinsic_size(DIAGRAM), (200.0, 100.0))
+
+    def test_absolute_units_are_converted_to_pixels(self):
+        width, height = intrinsic_size(b'<svg width="25.4mm" height="72pt"/>')
+        self.assertAlmostEqual(width, 96.0)
+        self.assertAlmostEqual(height, 96.0)
+
+    def test_size_from_view_box(self):
+        self.assertEqual(intrinsic_size(b'<svg width="100%" viewBox="0,0,40,30"/>'), (40.0, 30.0))
+
+    def test_unknown_size(self):
+        self.assertEqual(intrinsic_size(b'<svg width="100%"/>'), None)
+
+
+class MarkupTests(unittest.TestCase):
+    def node(self, **options):
+        node = {'width': '100%', 'height': '100%', 'border': 0, 'alt': 'A "diagram"'}
+        node.update(options)
+        return node
+
+    def test_object_is_given_an_aspect_ratio(self):
+        markup = object_markup(self.node(), '_images/a.svg', (200.0, 100.0))
+        self.assertTrue('aspect-ratio: 200 / 100' in markup)
+        self.assertFalse('height="' in markup)
+
+    def test_object_keeps_a_given_height(self):
+        markup = object_markup(self.node(height='300px'), '_images/a.svg', (200.0, 100.0))
+        self.assertTrue('height="300px"' in markup)
+        self.assertFalse('aspect-ratio' in markup)
+
+    def test_object_of_unknown_size(self):
+        self.assertTrue('height="100%"' in object_markup(self.node(), '_images/a.svg'))
+
+    def test_lazy_image_has_intrinsic_size(self):
+        markup = lazy_markup(self.node(border=1), '_images/a.svg', (200.4, 100.0))
+        self.assertTrue(markup.startswith('<img src="_images/a.svg"'))
+        self.assertTrue('loading="lazy"' in markup)
+        self.assertTrue('width="200" height="100"' in markup)
+        self.assertTrue('style="width: 100%; height: auto; border: 1px solid"' in markup)
+        self.assertTrue('alt="A &quot;diagram&quot;"' in markup)
+
+    def test_thumbnail_holds_the_diagram_until_clicked(self):
+        markup = thumbnail_markup(self.node(), '_images/a.svg', '_images/a.thumbnail.svg', (240.0, 120.0),
+                                  '<object data="_images/a.svg"></object>')
+        self.assertTrue(markup.startswith('<template class="phix-diagram"><object data="_images/a.svg"></object></template><a '))
+        self.assertTrue('href="_images/a.svg"' in markup)
+        self.assertTrue('<img src="_images/a.thumbnail.svg"' in markup)
+        self.assertTrue('width="240" height="120"' in markup)
+
+
+OTHER_DIAGRAM = b'''<svg xmlns="http://www.w3.org/2000/svg" viewBox="0 0 50 50">
+  <defs>
+    <marker id="head"><path d="M 0,0 L 5,0"/></marker>
+  </defs>
+  <line id="arrow" style="marker-end:url(#head)"/>
+</svg>'''
+
+
+class SpriteDiagramTests(unittest.TestCase):
+    def entries(self, diagram):
+        return dict(diagram.entries)
+
+    def test_diagram_becomes_a_symbol(self):
+        diagram = SpriteDiagram(DIAGRAM)
+        symbol = self.entries(diagram)[diagram.symbol_id]
+        self.assertTrue('<symbol id="{0}" viewBox="0 0 200.0 100.0">'.format(diagram.symbol_id) in symbol)
+        self.assertTrue('<rect' in symbol)
+        self.assertFalse('<marker' in symbol)
+
+    def test_identical_definitions_are_shared(self):
+        first = SpriteDiagram(DIAGRAM)
+        second = SpriteDiagram(OTHER_DIAGRAM)
+        shared = set(self.entries(first)) & set(self.entries(second))
+        self.assertEqual(len(shared), 1)
+        name = shared.pop()
+        self.assertTrue(name.startswith('phix-def-'))
+        self.assertTrue('marker-end:url(#{0})'.format(name) in self.entries(first)[first.symbol_id])
+        self.assertTrue('marker-end:url(#{0})'.format(name) in self.entries(second)[second.symbol_id])
+
+    def test_other_ids_are_prefixed(self):
+        diagram = SpriteDiagram(OTHER_DIAGRAM)
+        prefix = diagram.symbol_id[:-len('diagram')]
+        self.assertTrue('id="{0}arrow"'.format(prefix) in self.entries(diagram)[diagram.symbol_id])
+
+    def test_style_sheet_selectors_are_prefixed(self):
+        diagram = SpriteDiagram(DIAGRAM)
+        prefix = diagram.symbol_id[:-len('diagram')]
+        symbol = self.entries(diagram)[diagram.symbol_id]
+        self.assertTrue('.{0}box{{fill:url(#'.format(prefix) in symbol)
+        self.assertTrue('class="{0}box"'.format(prefix) in symbol)
+
+    def test_use_refers_to_the_symbol(self):
+        diagram = SpriteDiagram(DIAGRAM)
+        markup = diagram.use('#' + diagram.symbol_id, width='50%', height='100%')
+        self.assertTrue('href="#{0}"'.format(diagram.symbol_id) in markup)
+        self.assertTrue('viewBox="0 0 200.0 100.0"' in markup)
+        self.assertTrue('width="50%"' in markup)
+        self.assertFalse('height=' in markup)
+
+    def test_invalid_svg_raises_phix_error(self):
+        self.assertRaises(PhixError, SpriteDiagram, b'<svg>')
+
+
+class SpriteTests(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.render_paths = []
+        for index, svg in enumerate([DIAGRAM, OTHER_DIAGRAM]):
+            render_path = os.path.join(self.directory, 'diagram{0}.svg'.format(index))
+            with open(render_path, 'wb') as render_file:
+                render_file.write(svg)
+            self.render_paths.append(render_path)
+        self.node = {'width': '100%', 'height': '100%', 'border': 0}
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def use(self, translator, render_path):
+        return sprite_use(translator, self.node, '../_images/diagram.svg', render_path)
+
+    def test_page_sprite_is_appended_to_the_page(self):
+        builder = Builder(self.directory)
+        translator = Translator(builder)
+        for render_path in self.render_paths + self.render_paths:
+            self.assertTrue('href="#phix-' in self.use(translator, render_path))
+        context = {'body': '<p>text</p>'}
+        append_page_sprite(App(builder), 'index', 'page.html', context, None)
+        self.assertTrue(context['body'].startswith('<p>text</p><svg'))
+        self.assertEqual(context['body'].count('<symbol'), 2)
+        self.assertEqual(context['body'].count('<marker'), 1)
+
+    def test_site_sprite_is_written_when_the_build_finishes(self):
+        builder = Builder(self.directory, phix_html_sprite_scope='site')
+        translator = Translator(builder)
+        for render_path in self.render_paths:
+            self.assertTrue('href="../_images/phix-sprite.svg#phix-' in self.use(translator, render_path))
+        write_site_sprite(App(builder), None)
+        with open(os.path.join(builder.outdir, '_images', 'phix-sprite.svg'), 'rb') as sprite_file:
+            sprite = sprite_file.read().decode('utf-8')
+        self.assertEqual(sprite.count('<symbol'), 2)
+        self.assertEqual(sprite.count('<marker'), 1)
+        self.assertFalse('position: absolute' in sprite)
+
+    def build_site(self, pages, found_docs):
+        '''Write the given pages, each drawing the given diagrams, and get the
+        site sprite.'''
+        builder = Builder(self.directory, phix_html_sprite_scope='site')
+        translator = Translator(builder)
+        app = App(builder, found_docs)
+        for pagename, render_paths in pages:
+            builder.current_docname = pagename
+            for render_path in render_paths:
+                self.use(translator, render_path)
+            append_page_sprite(app, pagename, 'page.html', {'body': ''}, None)
+        write_site_sprite(app, None)
+        with open(os.path.join(builder.outdir, '_images', 'phix-sprite.svg'), 'rb') as sprite_file:
+            return sprite_file.read().decode('utf-8')
+
+    def test_site_sprite_keeps_entries_of_pages_not_rewritten(self):
+        self.build_site([('index', self.render_paths[:1]), ('other', self.render_paths[1:])],
+                        ['index', 'other'])
+        sprite = self.build_site([('index', self.render_paths[:1])], ['index', 'other'])
+        self.assertEqual(sprite.count('<symbol'), 2)
+
+    def test_site_sprite_drops_entries_no_page_draws(self):
+        self.build_site([('index', self.render_paths[:1]), ('other', self.render_paths[1:])],
+                        ['index', 'other'])
+        sprite = self.build_site([('index', [])], ['index', 'other'])
+        self.assertEqual(sprite.count('<symbol'), 1)
+        sprite = self.build_site([], ['index'])
+        self.assertEqual(sprite.count('<symbol'), 0)
+        self.assertEqual(sprite.count('<marker'), 0)
+        self.assertEqual(os.listdir(os.path.join(self.directory, 'doctrees', 'phix-sprite')),
+                         ['pages.json'])
+
+
+class HtmlTranslator(Translator):
+    def starttag(self, node, tagname, **attributes):
+        return '<{0}>'.format(tagname)
+
+
+class AppendDiagramTests(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.render_path = os.path.join(self.directory, 'html', '_images', 'diagram.svg')
+        os.makedirs(os.path.dirname(self.render_path))
+        with open(self.render_path, 'wb') as render_file:
+            render_file.write(DIAGRAM)
+        self.node = {'uri': 'diagram.wsd', 'width': '100%', 'height': '100%', 'border': 0,
+                     'alt': '', 'new_window_flag': False}
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def append(self, **values):
+        translator = HtmlTranslator(Builder(self.directory, phix_thumbnail_width=100, **values))
+        append_diagram(translator, self.node, 'phix', '../_images/diagram.svg', self.render_path)
+        self.assertEqual(translator.builder.warnings, [])
+        return ''.join(translator.body)
+
+    def test_inline_diagram_is_written_into_the_page(self):
+        self.assertTrue('<linearGradient' in self.append(phix_html_embed='inline'))
+
+    def test_unscoped_style_sheet_falls_back_to_an_object(self):
+        with open(self.render_path, 'wb') as render_file:
+            render_file.write(b'<svg width="10" height="10"><style>rect{fill:red}</style><rect/></svg>')
+        translator = HtmlTranslator(Builder(self.directory, phix_html_embed='inline'))
+        append_diagram(translator, self.node, 'phix', '../_images/diagram.svg', self.render_path)
+        self.assertTrue('<object data="../_images/diagram.svg"' in ''.join(translator.body))
+        self.assertEqual(len(translator.builder.warnings), 1)
+
+    def test_thumbnailed_diagram_is_loaded_when_clicked(self):
+        for embed in ('inline', 'sprite'):
+            markup = self.append(phix_html_embed=embed, phix_thumbnail=True)
+            self.assertTrue('<template class="phix-diagram"><object data="../_images/diagram.svg"' in markup)
+            self.assertFalse('<linearGradient' in markup)
+            self.assertFalse('<use' in markup)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,211 @@
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+from phix.cache import get_cache
+from phix.inkscape import InkscapeShell, plan_render, render_key
+from phix.phix import PhixError
+from phix.scheduler import postprocessed_key, render_failure
+from phix.test.fakes import App, Builder
+
+
+# Stands in for Inkscape, in shell mode or launched for one drawing, and
+# records what it does. Its shell accepts only the syntax of its version, and
+# when launched for one drawing, it exports to stdout if asked to. A drawing
+# which says broken cannot be exported, and one which starts with crash makes
+# the shell exit, though it can be exported on its own.
+FAKE_INKSCAPE = '''import os
+import re
+import sys
+VERSION = {0!r}
+
+def log(message):
+    with open(os.environ['FAKE_INKSCAPE_LOG'], 'a') as log_file:
+        log_file.write(message + '\\n')
+
+def export(drawing_path, output_path):
+    with open(drawing_path, 'r') as drawing_file:
+        content = drawing_file.read()
+    if content != 'broken':
+        if output_path == '-':
+            sys.stdout.write('<svg>{{0}}</svg>'.format(content))
+        else:
+            with open(output_path, 'w') as output_file:
+                output_file.write('<svg>{{0}}</svg>'.format(content))
+    return content
+
+def prompt():
+    sys.stdout.write('\\n> ' if VERSION.startswith('1.') else '\\n>')
+    sys.stdout.flush()
+
+args = sys.argv[1:]
+if args == ['--version']:
+    print('Inkscape {{0}} (fake)'.format(VERSION))
+elif args == ['--shell']:
+    log('shell')
+    sys.stdout.write('Inkscape interactive shell mode.')
+    prompt()
+    if VERSION.startswith('1.'):
+        syntax = re.compile(r'file-open:(.*?); vacuum-defs; export-plain-svg; export-filename:(.*?); export-do')
+    else:
+        syntax = re.compile(r'"(.*?)" --vacuum-defs "--export-plain-svg=(.*?)"')
+    for line in iter(sys.stdin.readline, ''):
+        if line.strip() == 'quit':
+            break
+        match = syntax.match(line)
+        if match is None:
+            sys.stdout.write('Unknown command')
+        else:
+            drawing_path, output_path = match.groups()
+            log('export ' + os.path.basename(drawing_path))
+            with open(drawing_path, 'r') as drawing_file:
+                if drawing_file.read().startswith('crash'):
+                    sys.exit(1)
+            export(drawing_path, output_path)
+        prompt()
+else:
+    log('launch ' + os.path.basename(args[0]))
+    if args[-1] == '--export-filename=-':
+        output_path = '-'
+    else:
+        output_path = args[2][len('--export-plain-svg='):]
+    if export(args[0], output_path) == 'broken':
+        sys.exit(1)
+'''
+
+
+class FakeInkscapeTestCase(unittest.TestCase):
+    version = '1.2.2'
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        inkscape_path = os.path.join(self.directory, 'inkscape.py')
+        with open(inkscape_path, 'w') as inkscape_file:
+            inkscape_file.write(FAKE_INKSCAPE.format(self.version))
+        self.log_path = os.path.join(self.directory, 'inkscape.log')
+        self.environ = dict(os.environ)
+        os.environ['INKSCAPE_LAUNCH'] = '"{0}" "{1}"'.format(sys.executable, inkscape_path)
+        os.environ['FAKE_INKSCAPE_LOG'] = self.log_path
+
+    def tearDown(self):
+        os.environ.clear()
+        os.environ.update(self.environ)
+        shutil.rmtree(self.directory)
+
+    def drawing(self, name, content):
+        drawing_path = os.path.join(self.directory, name)
+        with open(drawing_path, 'w') as drawing_file:
+            drawing_file.write(content)
+        return drawing_path
+
+    def log(self):
+        with open(self.log_path, 'r') as log_file:
+            return log_file.read().splitlines()
+
+
+class InkscapeShellTests(FakeInkscapeTestCase):
+    def test_export(self):
+        shell = InkscapeShell(timeout=10)
+        try:
+            output_path = os.path.join(self.directory, 'out.svg')
+            shell.export(self.drawing('a.svg', 'a'), output_path)
+            with open(output_path, 'r') as output_file:
+                self.assertEqual(output_file.read(), '<svg>a</svg>')
+            self.assertRaises(PhixError,
+                              shell.export,
+                              self.drawing('broken.svg', 'broken'),
+                              os.path.join(self.directory, 'broken.svg.out'))
+            self.assertEqual(shell.process.poll(), None)
+        finally:
+            shell.close()
+        self.assertEqual(self.log(), ['shell', 'export a.svg', 'export broken.svg'])
+
+    def test_exit_is_detected(self):
+        shell = InkscapeShell(timeout=10)
+        try:
+            self.assertRaises(PhixError,
+                              shell.export,
+                              self.drawing('crash.svg', 'crash'),
+                              os.path.join(self.directory, 'crash.svg.out'))
+            self.assertNotEqual(shell.process.poll(), None)
+        finally:
+            shell.close()
+
+
+class OldInkscapeShellTests(InkscapeShellTests):
+    # Inkscape 0.92 takes command line arguments in shell mode, not actions.
+    version = '0.92.4'
+
+
+# Stands in for a postprocess command, which shouts.
+UPPER_SCRIPT = '''import sys
+data = sys.stdin.read()
+if 'FAIL' in data.upper():
+    sys.exit(1)
+sys.stdout.write(data.upper())
+'''
+
+
+class RenderQueueTests(FakeInkscapeTestCase):
+    def render(self, contents, postprocess=None, **values):
+        builder = Builder(self.directory, **values)
+        builder.phix_scratch_dir = os.path.join(self.directory, 'scratch')
+        os.makedirs(builder.phix_scratch_dir)
+        jobs = [{'uri': self.drawing(name, content), 'postprocess': postprocess}
+                for name, content in contents]
+        for task in plan_render(App(builder), jobs):
+            task()
+        return builder, [render_key(job) for job in jobs]
+
+    def test_failed_drawings_are_exported_alone(self):
+        builder, keys = self.render([('a.svg', 'a'), ('crash.svg', 'crash'), ('b.svg', 'b'),
+                                     ('broken.svg', 'broken'), ('c.svg', 'c')])
+        self.assertEqual(self.log(), ['shell', 'export a.svg', 'export crash.svg',
+                                      'launch crash.svg',
+                                      'shell', 'export b.svg', 'export broken.svg',
+                                      'launch broken.svg',
+                                      'export c.svg'])
+        cache = get_cache(builder)
+        self.assertEqual([key in cache for key in keys], [True, True, True, False, True])
+        self.assertTrue(render_failure(builder, keys[3]).startswith('Could not launch Inkscape'))
+
+    def test_shell_is_restarted_a_limited_number_of_times(self):
+        builder, keys = self.render([('crash{0}.svg'.format(index), 'crash{0}'.format(index))
+                                     for index in range(6)])
+        log = self.log()
+        self.assertEqual(log.count('shell'), 4)
+        self.assertEqual(log[-2:], ['launch crash4.svg', 'launch crash5.svg'])
+        cache = get_cache(builder)
+        self.assertTrue(all(key in cache for key in keys))
+
+    def test_drawings_are_launched_alone_without_shells(self):
+        builder, keys = self.render([('a.svg', 'a'), ('b.svg', 'b')], phix_inkscape_shell=0)
+        self.assertEqual(self.log(), ['launch a.svg', 'launch b.svg'])
+        with open(get_cache(builder).path(keys[1]), 'r') as entry_file:
+            self.assertEqual(entry_file.read(), '<svg>b</svg>')
+
+    def test_launched_drawings_are_postprocessed(self):
+        upper_path = os.path.join(self.directory, 'upper.py')
+        with open(upper_path, 'w') as upper_file:
+            upper_file.write(UPPER_SCRIPT)
+        postprocess = '{0} {1}'.format(sys.executable, upper_path)
+        builder, keys = self.render([('a.svg', 'a'), ('fail.svg', 'fail')],
+                                    postprocess, phix_inkscape_shell=0)
+        cache = get_cache(builder)
+        with open(cache.path(postprocessed_key(builder, keys[0], postprocess)), 'r') as entry_file:
+            self.assertEqual(entry_file.read(), '<SVG>A</SVG>')
+        # The drawing is cached even though its postprocess failed.
+        self.assertTrue(keys[1] in cache)
+        self.assertTrue(render_failure(builder, postprocessed_key(builder, keys[1], postprocess)).startswith(
+            'Could not launch postprocess'))
+        self.assertEqual(os.listdir(builder.phix_scratch_dir), [])
+
+
+class OldRenderQueueTests(RenderQueueTests):
+    # Inkscape 0.92 cannot export to stdout.
+    version = '0.92.4'
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,87 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from phix import latex
+from phix.latex import (convert_queued, includegraphics_markup, latex_length, missing_pdf,
+                        queue_pdf, write_pdf)
+from phix.test.fakes import Builder, Exporter
+
+
+SVG = b'<svg xmlns="http://www.w3.org/2000/svg" width="800" height="400"/>'
+
+
+class PdfTests(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.builder = Builder(self.directory, 'latex')
+        self.render_path = os.path.join(self.directory, 'diagram.svg')
+        with open(self.render_path, 'wb') as render_file:
+            render_file.write(SVG)
+        self.pdf_exporter = latex.pdf_exporter
+        self.exporter = latex.pdf_exporter = Exporter()
+
+    def tearDown(self):
+        latex.pdf_exporter = self.pdf_exporter
+        shutil.rmtree(self.directory)
+
+    def test_pdf_is_written_alongside(self):
+        pdf_path = write_pdf(self.builder, self.render_path)
+        self.assertEqual(pdf_path, os.path.join(self.directory, 'diagram.pdf'))
+        with open(pdf_path, 'rb') as pdf_file:
+            self.assertEqual(pdf_file.read(), b'diagram.svg')
+        self.assertFalse(missing_pdf(self.builder, self.render_path))
+
+    def test_pdf_is_cached(self):
+        write_pdf(self.builder, self.render_path)
+        write_pdf(self.builder, self.render_path)
+        self.assertEqual(len(self.exporter.exports), 1)
+
+    def test_only_latex_needs_pdf(self):
+        self.builder.format = 'html'
+        self.assertFalse(missing_pdf(self.builder, self.render_path))
+        queue_pdf(self.builder, self.render_path)
+        convert_queued(self.builder)
+        self.assertEqual(self.exporter.exports, [])
+
+    def test_queued_pdfs_are_made_in_one_batch(self):
+        other_path = os.path.join(self.directory, 'other.svg')
+        with open(other_path, 'wb') as other_file:
+            other_file.write(SVG.replace(b'400', b'300'))
+        for svg_path in (self.render_path, other_path, self.render_path):
+            queue_pdf(self.builder, svg_path)
+        convert_queued(self.builder)
+        self.assertEqual(self.exporter.exports, [(self.render_path,), (other_path,)])
+        self.assertEqual(self.builder.messages, ['phix: converted 2 diagrams to PDF'])
+        self.assertFalse(missing_pdf(self.builder, other_path))
+
+
+class MarkupTests(unittest.TestCase):
+    def test_lengths(self):
+        self.assertEqual(latex_length('100%'), '\\linewidth')
+        self.assertEqual(latex_length('50%'), '0.5\\linewidth')
+        self.assertEqual(latex_length('400px'), '300bp')
+        self.assertEqual(latex_length('400'), '300bp')
+        self.assertEqual(latex_length('5cm'), '5cm')
+        self.assertEqual(latex_length('10vw'), None)
+
+    def test_width_only(self):
+        node = {'width': '50%', 'height': '100%'}
+        self.assertEqual(includegraphics_markup(node, 'classes.pdf'),
+                         '\n\\noindent\\includegraphics[width=0.5\\linewidth]{{classes}.pdf}\n\n')
+
+    def test_width_and_height_keep_aspect_ratio(self):
+        node = {'width': '10cm', 'height': '200px', 'align': 'center'}
+        self.assertEqual(includegraphics_markup(node, 'my.classes.pdf'),
+                         '\n\\begin{center}\n'
+                         '\\includegraphics[width=10cm,height=150bp,keepaspectratio]{{my.classes}.pdf}\n'
+                         '\\end{center}\n')
+
+    def test_right_alignment(self):
+        node = {'width': '100%', 'height': '100%', 'align': 'right'}
+        self.assertTrue(includegraphics_markup(node, 'a.pdf').startswith(
+            '\n\\noindent\\hspace*{\\fill}\\includegraphics'))
+
+if __name__ == '__main__':
+    unittest.main()
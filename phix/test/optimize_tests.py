@@ -0,0 +1,127 @@
+import unittest
+
+from phix.optimize import format_options, optimize, parse_options, postprocessor, round_numbers
+from phix.phix import PhixError
+
+
+DRAWING = b'''<?xml version="1.0" encoding="UTF-8" standalone="no"?>
+<!-- Created with Inkscape -->
+<svg xmlns="http://www.w3.org/2000/svg"
+     xmlns:xlink="http://www.w3.org/1999/xlink"
+     xmlns:inkscape="http://www.inkscape.org/namespaces/inkscape"
+     xmlns:sodipodi="http://sodipodi.sourceforge.net/DTD/sodipodi-0.dtd"
+     width="210.000000" height="100%" inkscape:version="0.48">
+  <sodipodi:namedview id="base"/>
+  <metadata><title>Drawing</title></metadata>
+  <defs>
+    <linearGradient id="used"><stop offset="0"/></linearGradient>
+    <linearGradient id="unused"><stop offset="0"/></linearGradient>
+    <marker id="arrow"><path d="M 0.000000,0.000000 L 5.0000001,-0.0000004"/></marker>
+  </defs>
+  <g inkscape:label="Layer 1">
+    <rect x="10.123456" y="0" style="fill:url(#used); stroke : #000000;stroke-width:1.000000px"/>
+    <rect x="20.5" y="0" style="fill:url(#used);stroke:#000000;stroke-width:1.000000px"/>
+    <rect x="30.5" y="0" style="fill:url(#used);stroke:#000000;stroke-width:1.000000px"/>
+    <use xlink:href="#arrow"/>
+    <text x="1" y="2"> Hello  <tspan>World</tspan></text>
+  </g>
+</svg>'''
+
+
+class OptimizeTests(unittest.TestCase):
+    def test_output_is_smaller(self):
+        self.assertTrue(len(optimize(DRAWING)) < len(DRAWING))
+
+    def test_metadata_is_stripped(self):
+        svg = optimize(DRAWING)
+        for fragment in (b'Created with', b'sodipodi', b'inkscape', b'<metadata'):
+            self.assertFalse(fragment in svg, fragment)
+        self.assertTrue(b'xmlns:xlink' in svg)
+
+    def test_numbers_are_rounded(self):
+        svg = optimize(DRAWING, precision=2)
+        self.assertTrue(b'x="10.12"' in svg)
+        self.assertTrue(b'width="210"' in svg)
+        self.assertTrue(b'd="M 0,0 L 5,0"' in svg)
+        self.assertTrue(b'height="100%"' in svg)
+
+    def test_compact_numbers_stay_apart(self):
+        self.assertEqual(round_numbers('M1-0.0001L5 5', 3), 'M1 0L5 5')
+        self.assertEqual(round_numbers('3-0.0002 4,4', 3), '3 0 4,4')
+        self.assertEqual(round_numbers('M1.5.5', 3), 'M1.5.5')
+        self.assertEqual(round_numbers('M1.5.5', 0), 'M2 0')
+        self.assertEqual(round_numbers('M1.25.5', 1), 'M1.2.5')
+        self.assertEqual(round_numbers('M1-2.4-.5', 0), 'M1-2 0')
+        self.assertEqual(round_numbers('translate(1.0004,-2)', 3), 'translate(1,-2)')
+
+    def test_compact_path_data_is_rounded(self):
+        svg = optimize(b'<svg xmlns="http://www.w3.org/2000/svg"><path d="M1-0.0001L5 5"/>'
+                       b'<polygon points="3-0.0002 4,4"/><path d="M1.5.5"/></svg>', precision=0)
+        self.assertTrue(b'd="M1 0L5 5"' in svg)
+        self.assertTrue(b'points="3 0 4,4"' in svg)
+        self.assertTrue(b'd="M2 0"' in svg)
+
+    def test_unused_defs_are_removed(self):
+        svg = optimize(DRAWING)
+        self.assertFalse(b'id="unused"' in svg)
+        self.assertTrue(b'id="used"' in svg)
+        self.assertTrue(b'id="arrow"' in svg)
+
+    def test_whitespace_in_text_is_kept(self):
+        self.assertTrue(b'> Hello  <tspan>' in optimize(DRAWING))
+        self.assertFalse(b'>\n  <' in optimize(DRAWING))
+
+    def test_identical_styles_are_merged(self):
+        svg = optimize(DRAWING)
+        self.assertEqual(svg.count(b'stroke-width:1.000000px'), 1)
+        self.assertEqual(svg.count(b'class="phix-'), 3)
+
+    def test_styles_are_not_merged_alongside_a_style_sheet(self):
+        drawing = DRAWING.replace(b'<defs>', b'<defs><style>.box{stroke:red}</style>').replace(
+            b'<rect x="20.5"', b'<rect class="box" x="20.5"')
+        svg = optimize(drawing)
+        self.assertEqual(svg.count(b'style="fill:url(#used);stroke:#000000;stroke-width:1.000000px"'), 3)
+        self.assertTrue(b'class="box"' in svg)
+        self.assertFalse(b'phix-' in svg)
+
+    def test_styles_are_not_merged_over_presentation_attributes(self):
+        drawing = DRAWING.replace(b'<rect x="20.5"', b'<rect stroke="red" x="20.5"')
+        svg = optimize(drawing)
+        self.assertTrue(b'stroke="red" x="20.5" y="0" style="fill:url(#used);stroke:#000000' in svg)
+        self.assertEqual(svg.count(b'class="phix-'), 2)
+
+    def test_options_can_be_disabled(self):
+        svg = optimize(DRAWING,
+                       precision=None,
+                       strip_metadata=False,
+                       collapse_whitespace=False,
+                       remove_unused_defs=False,
+                       merge_styles=False)
+        self.assertTrue(b'x="10.123456"' in svg)
+        self.assertTrue(b'id="unused"' in svg)
+        self.assertTrue(b'sodipodi:namedview' in svg)
+
+    def test_invalid_svg_raises_phix_error(self):
+        self.assertRaises(PhixError, optimize, b'<svg>')
+
+
+class OptionsTests(unittest.TestCase):
+    def test_postprocessor_arguments(self):
+        options = parse_options(['precision=1', 'merge-styles=no'])
+        self.assertEqual(options['precision'], 1)
+        self.assertFalse(options['merge_styles'])
+        self.assertTrue(options['strip_metadata'])
+        self.assertTrue(b'x="10.1"' in postprocessor(DRAWING, 'precision=1'))
+
+    def test_options_round_trip(self):
+        options = {'precision': 2, 'merge_styles': False}
+        self.assertEqual(format_options(options), 'merge_styles=no precision=2')
+        self.assertEqual(parse_options(format_options(options).split())['precision'], 2)
+        self.assertEqual(format_options(True), '')
+
+    def test_nonsense_raises_phix_error(self):
+        self.assertRaises(PhixError, parse_options, ['colour=blue'])
+        self.assertRaises(PhixError, parse_options, ['precision=lots'])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -6,6 +6,7 @@ import phix.argouml
 import phix.dia
 import phix.inkscape
 import phix.websequencediagram
+from phix.websequencediagram_server import StandInServer
 
 
 test_dir = os.path.split(__file__)[0]
@@ -59,9 +60,14 @@ class Tests(unittest.TestCase):
         build_project('inkscape_project')
 
     def test_websequencediagrams(self):
-        '''Build a project using the WSD extension.
+        '''Build a project using the WSD extension, against a stand-in server.
         '''
-        build_project('websequencediagram_project')
+        with StandInServer() as server:
+            os.environ['PHIX_WEBSEQUENCEDIAGRAM_SERVER'] = server.url
+            try:
+                build_project('websequencediagram_project')
+            finally:
+                del os.environ['PHIX_WEBSEQUENCEDIAGRAM_SERVER']
 
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,193 @@
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+from phix.cache import get_cache
+from phix.phix import PhixError, PostprocessPipeline, compile_postprocess
+from phix.scheduler import (plan_jobs, postprocess_to_cache, postprocessed_key, render_failure,
+                            stream_to_cache)
+from phix.test.fakes import Builder
+
+
+def upper(svg):
+    return svg.upper()
+
+def append(svg, suffix):
+    return svg + suffix.encode('utf-8')
+
+calls = []
+
+def counted(svg):
+    calls.append(svg)
+    return svg.upper()
+
+CAT_SCRIPT = b'''import shutil, sys
+shutil.copyfileobj(sys.stdin.buffer, sys.stdout.buffer)
+'''
+
+
+class PostprocessPipelineTests(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.input_path = os.path.join(self.directory, 'input.svg')
+        self.render_path = os.path.join(self.directory, 'output.svg')
+        with open(self.input_path, 'wb') as input_file:
+            input_file.write(b'<svg/>')
+        # A command which copies stdin to stdout, on any platform.
+        cat_path = os.path.join(self.directory, 'cat.py')
+        with open(cat_path, 'wb') as cat_file:
+            cat_file.write(CAT_SCRIPT)
+        self.cat = '{0} {1}'.format(sys.executable, cat_path)
+        self.postprocessors = {'upper': upper, 'append': append}
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def rendered(self):
+        with open(self.render_path, 'rb') as render_file:
+            return render_file.read()
+
+    def test_stages_are_split_on_bars(self):
+        pipeline = PostprocessPipeline('upper | append x', self.postprocessors)
+        self.assertEqual([str(stage) for stage in pipeline.stages],
+                         ['upper', 'append x'])
+        self.assertFalse(pipeline.is_piped)
+
+    def test_python_stages_run_in_process(self):
+        pipeline = PostprocessPipeline('upper | append <!---->', self.postprocessors)
+        pipeline.run_file(self.input_path, self.render_path)
+        self.assertEqual(self.rendered(), b'<SVG/><!---->')
+
+    def test_commands_are_piped(self):
+        pipeline = PostprocessPipeline('{0} | {0}'.format(self.cat))
+        self.assertTrue(pipeline.is_piped)
+        pipeline.run_file(self.input_path, self.render_path)
+        self.assertEqual(self.rendered(), b'<svg/>')
+
+    def test_commands_and_python_stages_mix(self):
+        pipeline = PostprocessPipeline('{0} | upper'.format(self.cat), self.postprocessors)
+        self.assertFalse(pipeline.is_piped)
+        pipeline.run_file(self.input_path, self.render_path)
+        self.assertEqual(self.rendered(), b'<SVG/>')
+
+    def test_compile_passes_pipelines_through(self):
+        pipeline = PostprocessPipeline('upper', self.postprocessors)
+        self.assertIs(compile_postprocess(pipeline), pipeline)
+        self.assertIs(compile_postprocess(None), None)
+
+    def test_empty_stage_raises_phix_error(self):
+        self.assertRaises(PhixError, PostprocessPipeline, 'upper | | upper', self.postprocessors)
+
+    def test_failing_postprocessor_raises_phix_error(self):
+        pipeline = PostprocessPipeline('append', self.postprocessors)
+        self.assertRaises(PhixError, pipeline.run_file, self.input_path, self.render_path)
+
+
+class PostprocessCacheTests(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.builder = Builder(self.directory, phix_postprocessors={'counted': counted})
+        self.cache = get_cache(self.builder)
+        del calls[:]
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def store_rendering(self, key, svg):
+        rendered_path = os.path.join(self.directory, 'rendered.svg')
+        with open(rendered_path, 'wb') as rendered_file:
+            rendered_file.write(svg)
+        self.cache.store(key, rendered_path)
+
+    def fetch(self, key):
+        with open(self.cache.path(key), 'rb') as entry_file:
+            return entry_file.read()
+
+    def test_postprocessed_key_ignores_spacing(self):
+        self.assertEqual(postprocessed_key(self.builder, 'aa01', 'counted'),
+                         postprocessed_key(self.builder, 'aa01', '  counted '))
+        self.assertEqual(postprocessed_key(self.builder, 'aa01', None), 'aa01')
+
+    def test_postprocess_is_cached_by_rendering(self):
+        self.store_rendering('aa01', b'<svg/>')
+        self.store_rendering('bb02', b'<svg/>')
+        self.assertTrue(postprocess_to_cache(self.builder, 'aa01', 'counted'))
+        self.assertTrue(postprocess_to_cache(self.builder, 'bb02', 'counted'))
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(self.fetch(postprocessed_key(self.builder, 'bb02', 'counted')), b'<SVG/>')
+
+    def test_cached_rendering_is_only_postprocessed(self):
+        self.store_rendering('aa01', b'<svg/>')
+        source_path = os.path.join(self.directory, 'source.svg')
+        with open(source_path, 'wb') as source_file:
+            source_file.write(b'<svg/>')
+        job = {'uri': source_path, 'postprocess': 'counted'}
+        unrendered, tasks = plan_jobs(self.builder, [job, dict(job)], lambda job: 'aa01')
+        self.assertEqual(len(unrendered), 0)
+        self.assertEqual(len(tasks), 1)
+        tasks[0]()
+        unrendered, tasks = plan_jobs(self.builder, [job], lambda job: 'aa01')
+        self.assertEqual((len(unrendered), len(tasks)), (0, 0))
+
+
+def render_in_chunks(output_file):
+    output_file.write(b'<svg>')
+    output_file.write(b'</svg>')
+    return {'engine': 'test'}
+
+
+class StreamToCacheTests(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.cat_path = os.path.join(self.directory, 'cat.py')
+        with open(self.cat_path, 'wb') as cat_file:
+            cat_file.write(CAT_SCRIPT)
+        self.cat = '{0} {1}'.format(sys.executable, self.cat_path)
+        self.builder = Builder(self.directory, phix_postprocessors={'counted': counted})
+        self.builder.phix_scratch_dir = os.path.join(self.directory, 'scratch')
+        os.makedirs(self.builder.phix_scratch_dir)
+        self.cache = get_cache(self.builder)
+        del calls[:]
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def fetch(self, key):
+        with open(self.cache.path(key), 'rb') as entry_file:
+            return entry_file.read()
+
+    def test_rendering_is_teed_into_each_postprocess(self):
+        jobs = [{'uri': 'a.wsd', 'postprocess': postprocess}
+                for postprocess in (self.cat, 'counted', None)]
+        self.assertTrue(stream_to_cache(self.builder, 'aa01', jobs, render_in_chunks))
+        self.assertEqual(self.fetch('aa01'), b'<svg></svg>')
+        self.assertEqual(self.cache.metadata('aa01'), {'engine': 'test'})
+        self.assertEqual(self.fetch(postprocessed_key(self.builder, 'aa01', self.cat)), b'<svg></svg>')
+        self.assertEqual(self.fetch(postprocessed_key(self.builder, 'aa01', 'counted')), b'<SVG></SVG>')
+        self.assertEqual(os.listdir(self.builder.phix_scratch_dir), [])
+
+    def test_streamed_postprocess_is_found_by_rendering(self):
+        stream_to_cache(self.builder, 'aa01', [{'uri': 'a.wsd', 'postprocess': self.cat}], render_in_chunks)
+        rendered_path = os.path.join(self.directory, 'rendered.svg')
+        with open(rendered_path, 'wb') as rendered_file:
+            rendered_file.write(b'<svg></svg>')
+        self.cache.store('bb02', rendered_path)
+        # An identical rendering is not postprocessed again, so the command is
+        # not needed.
+        os.remove(self.cat_path)
+        self.assertTrue(postprocess_to_cache(self.builder, 'bb02', self.cat))
+        self.assertEqual(self.fetch(postprocessed_key(self.builder, 'bb02', self.cat)), b'<svg></svg>')
+
+    def test_failed_rendering_stores_nothing(self):
+        def render(output_file):
+            output_file.write(b'<svg')
+            raise PhixError('Could not contact the server')
+        self.assertFalse(stream_to_cache(self.builder, 'aa01', [{'uri': 'a.wsd', 'postprocess': self.cat}], render))
+        self.assertFalse('aa01' in self.cache)
+        self.assertEqual(render_failure(self.builder, 'aa01'), 'Could not contact the server')
+        self.assertEqual(os.listdir(os.path.dirname(self.cache.path('aa01'))), [])
+
+if __name__ == '__main__':
+    unittest.main()
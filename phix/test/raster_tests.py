@@ -0,0 +1,100 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from phix import raster
+from phix.html import picture_markup, sizes_attribute
+from phix.phix import PhixError
+from phix.raster import (group_by_width, missing_rasters, queue_rasters, raster_settings,
+                         rasterize_queued, write_rasters)
+from phix.test.fakes import Builder, Exporter
+
+
+SVG = b'<svg xmlns="http://www.w3.org/2000/svg" width="800" height="400"/>'
+
+
+class RasterTests(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.builder = Builder(self.directory, phix_raster_formats=['png'], phix_raster_widths=[960, 480])
+        self.render_path = os.path.join(self.directory, '_images', 'diagram.svg')
+        os.makedirs(os.path.dirname(self.render_path))
+        with open(self.render_path, 'wb') as render_file:
+            render_file.write(SVG)
+        self.png_exporter = raster.png_exporter
+        self.exporter = raster.png_exporter = Exporter()
+
+    def tearDown(self):
+        raster.png_exporter = self.png_exporter
+        shutil.rmtree(self.directory)
+
+    def test_settings(self):
+        self.assertEqual(raster_settings(self.builder), (('png',), (480, 960)))
+        self.builder.format = 'latex'
+        self.assertEqual(raster_settings(self.builder), ((), ()))
+
+    def test_invalid_settings_raise_phix_error(self):
+        self.builder.config.phix_raster_formats = ['gif']
+        self.assertRaises(PhixError, raster_settings, self.builder)
+        self.builder.config.phix_raster_formats = ['png']
+        self.builder.config.phix_raster_widths = [0]
+        self.assertRaises(PhixError, raster_settings, self.builder)
+
+    def test_formats_of_one_width_are_grouped(self):
+        self.assertEqual(group_by_width([(480, 'png'), (480, 'webp'), (960, 'png')]),
+                         [(480, ['png', 'webp']), (960, ['png'])])
+
+    def test_rasters_are_written_alongside(self):
+        rasters = write_rasters(self.builder, self.render_path)
+        self.assertEqual(rasters, [('png', [('diagram-480w.png', 480), ('diagram-960w.png', 960)])])
+        with open(os.path.join(self.directory, '_images', 'diagram-960w.png'), 'rb') as png_file:
+            self.assertEqual(png_file.read(), b'diagram.svg 960')
+        self.assertEqual(missing_rasters(self.builder, self.render_path), [])
+
+    def test_rasters_are_cached(self):
+        write_rasters(self.builder, self.render_path)
+        write_rasters(self.builder, self.render_path)
+        self.assertEqual(len(self.exporter.exports), 2)
+
+    def test_queued_rasters_are_made_in_one_batch(self):
+        other_path = os.path.join(self.directory, 'other.svg')
+        with open(other_path, 'wb') as other_file:
+            other_file.write(SVG.replace(b'400', b'300'))
+        for svg_path in (self.render_path, other_path, self.render_path):
+            queue_rasters(self.builder, svg_path)
+        rasterize_queued(self.builder)
+        self.assertEqual(len(self.exporter.exports), 4)
+        self.assertEqual(self.builder.messages, ['phix: rasterized 2 diagrams'])
+        self.assertEqual(missing_rasters(self.builder, other_path), [])
+
+
+class PictureTests(unittest.TestCase):
+    node = {'width': '50%', 'height': '100%', 'border': 0, 'alt': 'Classes'}
+
+    def test_sizes(self):
+        self.assertEqual(sizes_attribute('50%'), '50vw')
+        self.assertEqual(sizes_attribute('400px'), '400px')
+        self.assertEqual(sizes_attribute('10em'), None)
+
+    def test_svg_comes_first(self):
+        markup = picture_markup(self.node,
+                                '_images/a.svg',
+                                (800.0, 400.0),
+                                [('webp', [('a-480w.webp', 480), ('a-960w.webp', 960)]),
+                                 ('png', [('a-480w.png', 480), ('a-960w.png', 960)])],
+                                lazy=True)
+        self.assertTrue(markup.startswith('<picture class="phix-picture">'
+                                          '<source srcset="_images/a.svg" type="image/svg+xml" />'
+                                          '<source srcset="_images/a-480w.webp 480w, _images/a-960w.webp 960w"'))
+        self.assertTrue('<img src="_images/a-960w.png" srcset="_images/a-480w.png 480w, _images/a-960w.png 960w"'
+                        ' sizes="50vw"' in markup)
+        self.assertTrue('width="800" height="400" loading="lazy"' in markup)
+
+    def test_webp_only_falls_back_to_webp(self):
+        markup = picture_markup(self.node, '_images/a.svg', None, [('webp', [('a-480w.webp', 480)])])
+        self.assertTrue('<img src="_images/a-480w.webp"' in markup)
+        self.assertFalse('type="image/webp"' in markup)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,117 @@
+import logging
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+
+from phix import scheduler
+from phix.cache import get_cache
+from phix.scheduler import Dispatcher, render_failure, render_to_cache
+from phix.test.fakes import Builder
+
+
+def missing_tool(output_path):
+    raise OSError(2, 'No such file or directory', 'argouml')
+
+
+class RenderToCacheTests(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.builder = Builder(self.directory)
+        logging.getLogger('phix.scheduler').disabled = True
+
+    def tearDown(self):
+        logging.getLogger('phix.scheduler').disabled = False
+        shutil.rmtree(self.directory)
+
+    def test_rendering_is_stored(self):
+        def render(output_path):
+            with open(output_path, 'wb') as output_file:
+                output_file.write(b'<svg/>')
+        self.assertTrue(render_to_cache(self.builder, 'aa01', render))
+        self.assertTrue('aa01' in get_cache(self.builder))
+
+    def test_unexpected_exception_is_recorded(self):
+        self.assertFalse(render_to_cache(self.builder, 'aa01', missing_tool))
+        self.assertTrue(render_failure(self.builder, 'aa01').endswith(
+            "Error: [Errno 2] No such file or directory: 'argouml'"))
+
+
+class DispatcherTests(unittest.TestCase):
+    def setUp(self):
+        logging.getLogger('phix.scheduler').disabled = True
+
+    def tearDown(self):
+        logging.getLogger('phix.scheduler').disabled = False
+
+    def test_failing_task_does_not_stop_its_thread(self):
+        dispatcher = Dispatcher(1, {})
+        done = []
+        def fail():
+            raise ValueError('max() arg is an empty sequence')
+        dispatcher.add('wsd', fail)
+        for index in range(3):
+            dispatcher.add('wsd', lambda index=index: done.append(index))
+        dispatcher.run()
+        self.assertEqual(done, [0, 1, 2])
+
+
+class ConcurrencyTests(unittest.TestCase):
+    def setUp(self):
+        self.lock = threading.Lock()
+        self.running = {}
+        self.most_running = {}
+        self.available_memory = scheduler.available_memory
+
+    def tearDown(self):
+        scheduler.available_memory = self.available_memory
+
+    def task(self, tool):
+        '''A task which records how many tasks of each tool, and in total, run
+        alongside it.'''
+        def run():
+            with self.lock:
+                for name in (tool, 'total'):
+                    self.running[name] = self.running.get(name, 0) + 1
+                    self.most_running[name] = max(self.most_running.get(name, 0), self.running[name])
+            time.sleep(0.1)
+            with self.lock:
+                for name in (tool, 'total'):
+                    self.running[name] -= 1
+        return run
+
+    def run_tasks(self, dispatcher, tools):
+        dispatcher.poll_interval = 0.01
+        for tool in tools:
+            dispatcher.add(tool, self.task(tool))
+        dispatcher.run()
+
+    def test_tool_limit(self):
+        self.run_tasks(Dispatcher(4, {'inkscape': 2}), ['inkscape'] * 6 + ['wsd'] * 4)
+        self.assertEqual(self.most_running['inkscape'], 2)
+        self.assertEqual(self.most_running['wsd'], 2)
+        self.assertEqual(self.most_running['total'], 4)
+
+    def test_memory_pressure(self):
+        scheduler.available_memory = lambda: 1200
+        dispatcher = Dispatcher(4, {}, memory_estimates={'argouml': 1000}, min_free_memory=500)
+        self.assertTrue(dispatcher.pressure('argouml'))
+        self.assertFalse(dispatcher.pressure('wsd'))
+        scheduler.available_memory = lambda: 1500
+        self.assertFalse(dispatcher.pressure('argouml'))
+
+    def test_tasks_are_deferred_while_memory_is_short(self):
+        scheduler.available_memory = lambda: 1200
+        self.run_tasks(Dispatcher(4, {}, memory_estimates={'argouml': 1000}, min_free_memory=500),
+                       ['argouml'] * 4)
+        self.assertEqual(self.most_running['argouml'], 1)
+
+    def test_unknown_memory_is_not_pressure(self):
+        scheduler.available_memory = lambda: None
+        self.run_tasks(Dispatcher(4, {}, memory_estimates={'argouml': 1000}, min_free_memory=500),
+                       ['argouml'] * 4)
+        self.assertEqual(self.most_running['argouml'], 4)
+
+if __name__ == '__main__':
+    unittest.main()
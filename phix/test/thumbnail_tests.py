@@ -0,0 +1,85 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from phix.cache import get_cache
+from phix.phix import PhixError
+from phix.scheduler import plan_jobs
+from phix.svg import intrinsic_size
+from phix.test.fakes import Builder
+from phix.thumbnail import (is_thumbnailed, thumbnail_option, thumbnail_svg, thumbnail_width,
+                            write_thumbnail)
+
+
+SVG = b'''<svg xmlns="http://www.w3.org/2000/svg" width="800" height="400">
+  <title>Classes</title>
+  <rect x="10.123" y="20.456" width="100.5" height="50.25"/>
+  <text x="12" y="30">Customer</text>
+</svg>'''
+
+
+class ThumbnailTests(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.builder = Builder(self.directory, phix_thumbnail_width=200)
+        self.render_path = os.path.join(self.directory, '_images', 'diagram.svg')
+        os.makedirs(os.path.dirname(self.render_path))
+        with open(self.render_path, 'wb') as render_file:
+            render_file.write(SVG)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_thumbnail_is_scaled_and_simplified(self):
+        thumbnail = thumbnail_svg(SVG, 200)
+        self.assertEqual(intrinsic_size(thumbnail), (200.0, 100.0))
+        self.assertTrue(b'viewBox="0 0 800 400"' in thumbnail)
+        self.assertFalse(b'Customer' in thumbnail)
+        self.assertFalse(b'<title' in thumbnail)
+        self.assertTrue(b'x="10"' in thumbnail)
+
+    def test_compact_path_data_keeps_its_coordinates(self):
+        thumbnail = thumbnail_svg(b'<svg xmlns="http://www.w3.org/2000/svg" width="800" height="400">'
+                                  b'<path d="M1.5.5L10-0.4z"/></svg>', 200)
+        self.assertTrue(b'd="M2 0L10 0z"' in thumbnail)
+
+    def test_thumbnail_of_unknown_size_raises_phix_error(self):
+        self.assertRaises(PhixError, thumbnail_svg, b'<svg width="100%"/>', 200)
+
+    def test_option(self):
+        self.assertTrue(thumbnail_option(None))
+        self.assertTrue(thumbnail_option('yes'))
+        self.assertFalse(thumbnail_option('no'))
+        self.assertRaises(ValueError, thumbnail_option, 'maybe')
+
+    def test_option_overrides_configuration(self):
+        self.assertEqual(thumbnail_width(self.builder, {}), None)
+        self.assertEqual(thumbnail_width(self.builder, {'thumbnail': True}), 200)
+        self.builder.config.phix_thumbnail = True
+        self.assertEqual(thumbnail_width(self.builder, {}), 200)
+        self.assertEqual(thumbnail_width(self.builder, {'thumbnail': False}), None)
+
+    def test_only_html_has_thumbnails(self):
+        self.builder.format = 'latex'
+        self.assertEqual(thumbnail_width(self.builder, {'thumbnail': True}), None)
+
+    def test_thumbnail_is_written_alongside(self):
+        thumbnail_path, size = write_thumbnail(self.builder, self.render_path, 200)
+        self.assertEqual(thumbnail_path, os.path.join(self.directory, '_images', 'diagram.thumbnail.svg'))
+        self.assertTrue(os.path.isfile(thumbnail_path))
+        self.assertEqual(size, (200.0, 100.0))
+        self.assertTrue(is_thumbnailed(self.builder, self.render_path, 200))
+        self.assertFalse(is_thumbnailed(self.builder, self.render_path, 100))
+
+    def test_cached_renderings_are_planned_for_thumbnails(self):
+        get_cache(self.builder).store('aa01', self.render_path)
+        job = {'postprocess': None, 'thumbnail': True}
+        unrendered, tasks = plan_jobs(self.builder, [job], lambda job: 'aa01')
+        self.assertEqual((len(unrendered), len(tasks)), (0, 1))
+        tasks[0]()
+        unrendered, tasks = plan_jobs(self.builder, [job], lambda job: 'aa01')
+        self.assertEqual((len(unrendered), len(tasks)), (0, 0))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,116 @@
+import io
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+
+from phix.phix import PhixError
+from phix.websequencediagram_client import WSDClient, httplib
+from phix.websequencediagram_server import StandInServer
+
+
+class StaleConnection(object):
+    '''A pooled connection which the server closed while it was idle.'''
+
+    def __init__(self):
+        self.requests = []
+
+    def request(self, method, path, body, headers):
+        self.requests.append(method)
+
+    def getresponse(self):
+        raise httplib.BadStatusLine('')
+
+    def close(self):
+        pass
+
+
+class WSDClientTests(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.server = StandInServer()
+        self.server.start()
+
+    def tearDown(self):
+        self.server.stop()
+        shutil.rmtree(self.directory)
+
+    def retrieve(self, client, name='out.svg'):
+        output_path = os.path.join(self.directory, name)
+        client.retrieve('A->B: hello', output_path, 'vs2010', '1')
+        with open(output_path, 'rb') as output_file:
+            return output_file.read()
+
+    def test_retrieve_downloads_rendering(self):
+        client = WSDClient(self.server.url)
+        self.assertIn(b'A-&gt;B: hello', self.retrieve(client))
+        client.close()
+
+    def test_downloads_large_payloads(self):
+        self.server.payload_size = 1024 * 1024
+        client = WSDClient(self.server.url)
+        self.assertTrue(len(self.retrieve(client)) >= 1024 * 1024)
+        client.close()
+
+    def test_connections_are_reused(self):
+        client = WSDClient(self.server.url, max_in_flight=2)
+        threads = [threading.Thread(target=self.retrieve, args=(client, '{0}.svg'.format(index)))
+                   for index in range(10)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        client.close()
+        self.assertEqual(self.server.counts['posts'], 10)
+        self.assertTrue(self.server.counts['connections'] <= 2)
+
+    def test_server_error_raises_phix_error(self):
+        self.server.error_rate = 1.0
+        client = WSDClient(self.server.url)
+        self.assertRaises(PhixError, self.retrieve, client)
+        client.close()
+
+    def test_error_response_is_not_written_to_output(self):
+        client = WSDClient(self.server.url)
+        output = io.BytesIO()
+        self.assertRaises(PhixError, client.request, 'GET', self.server.url + '?svg=missing', output=output)
+        self.assertEqual(output.getvalue(), b'')
+        self.assertIn(b'A-&gt;B: hello', self.retrieve(client))
+        client.close()
+        self.assertEqual(self.server.counts['connections'], 1)
+
+    def test_stale_connection_is_retried_for_idempotent_requests(self):
+        client = WSDClient(self.server.url)
+        stale = StaleConnection()
+        client.idle.append(stale)
+        self.assertRaises(PhixError, client.request, 'GET', self.server.url + '?svg=missing')
+        self.assertEqual(stale.requests, ['GET'])
+        self.assertEqual(self.server.counts['gets'], 1)
+        client.close()
+
+    def test_stale_connection_is_not_retried_for_other_requests(self):
+        client = WSDClient(self.server.url)
+        stale = StaleConnection()
+        client.idle.append(stale)
+        self.assertRaises(PhixError, client.request, 'POST', self.server.url, b'message=A-%3EB')
+        self.assertEqual(stale.requests, ['POST'])
+        self.assertEqual(self.server.counts.get('posts', 0), 0)
+        client.close()
+
+    def test_read_timeout_raises_phix_error(self):
+        self.server.latency = 1.0
+        client = WSDClient(self.server.url, read_timeout=0.1)
+        self.assertRaises(PhixError, self.retrieve, client)
+        client.close()
+
+    def test_server_is_not_contacted_after_failure_limit(self):
+        self.server.error_rate = 1.0
+        client = WSDClient(self.server.url, failure_limit=2)
+        for _ in range(4):
+            self.assertRaises(PhixError, self.retrieve, client)
+        client.close()
+        self.assertEqual(self.server.counts['posts'], 2)
+
+if __name__ == '__main__':
+    unittest.main()
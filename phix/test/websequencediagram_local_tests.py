@@ -0,0 +1,72 @@
+import unittest
+import xml.dom.minidom
+
+from phix.phix import PhixError
+from phix.websequencediagram_local import parse, render
+
+
+SOURCE = '''title Login
+participant "Web Browser" as B
+# A comment
+B->+Server: POST /login
+Server-->>-B: 200 OK
+alt valid
+    note over B,Server: welcome
+else invalid
+    Server->Server: log\\nfailure
+end
+'''
+
+
+class ParseTests(unittest.TestCase):
+    def test_participants_in_order_of_appearance(self):
+        self.assertEqual(parse(SOURCE).participants, ['Web Browser', 'Server'])
+
+    def test_title(self):
+        self.assertEqual(parse(SOURCE).title, ['Login'])
+
+    def test_message_with_activation(self):
+        events = parse(SOURCE).events
+        self.assertEqual(events[0], ('message', 0, 1, ['POST /login'], False, False))
+        self.assertEqual(events[1], ('activate', 1))
+
+    def test_dashed_open_message_with_deactivation(self):
+        events = parse(SOURCE).events
+        self.assertEqual(events[2], ('message', 1, 0, ['200 OK'], True, True))
+        self.assertEqual(events[3], ('deactivate', 1))
+
+    def test_groups_and_notes(self):
+        kinds = [event[0] for event in parse(SOURCE).events[4:]]
+        self.assertEqual(kinds, ['group', 'note', 'else', 'message', 'end'])
+
+    def test_multiline_note(self):
+        events = parse('note left of A\nfirst\nsecond\nend note\n').events
+        self.assertEqual(events, [('note', 'left of', [0], ['first', 'second'])])
+
+    def test_empty_multiline_note(self):
+        events = parse('note over A\nend note\n').events
+        self.assertEqual(events, [('note', 'over', [0], [])])
+
+    def test_unsupported_syntax_raises_phix_error(self):
+        self.assertRaises(PhixError, parse, 'autonumber 1\n')
+
+    def test_unmatched_end_raises_phix_error(self):
+        self.assertRaises(PhixError, parse, 'end\n')
+
+
+class RenderTests(unittest.TestCase):
+    def test_render_produces_svg(self):
+        document = xml.dom.minidom.parseString(render(SOURCE).encode('utf-8'))
+        self.assertEqual(document.documentElement.tagName, 'svg')
+
+    def test_render_is_deterministic(self):
+        self.assertEqual(render(SOURCE), render(SOURCE))
+
+    def test_empty_note_is_drawn(self):
+        self.assertEqual(render('note over A\nend note\n').count('fill="#ffffcc"'), 1)
+
+    def test_text_is_escaped(self):
+        self.assertIn('a &lt;b&gt;', render('A->B: a <b>\n'))
+
+if __name__ == '__main__':
+    unittest.main()
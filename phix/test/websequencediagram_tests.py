@@ -0,0 +1,123 @@
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+from docutils import nodes
+
+from phix.cache import get_cache
+from phix.test.fakes import App, Builder, Translator
+from phix.websequencediagram import close_clients, fetch_diagram, is_fresh, plan_render
+from phix.websequencediagram_server import StandInServer
+
+
+class FallbackTests(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.server = StandInServer()
+        self.server.start()
+        self.wsd_path = os.path.join(self.directory, 'hello.wsd')
+        self.node = {'uri': self.wsd_path,
+                     'style': 'default',
+                     'api_version': '1',
+                     'server_url': self.server.url,
+                     'postprocess': None}
+
+    def tearDown(self):
+        self.server.stop()
+        shutil.rmtree(self.directory)
+
+    def build(self, text, **values):
+        '''Render a diagram of the given text, and write it as a build would.
+
+        Returns:
+            The builder, and the rendering written, or None if the diagram was
+            skipped.
+        '''
+        with open(self.wsd_path, 'w') as wsd_file:
+            wsd_file.write(text)
+        builder = Builder(self.directory, phix_wsd_failure_limit=1, **values)
+        app = App(builder)
+        try:
+            for task in plan_render(app, [self.node]):
+                task()
+        finally:
+            close_clients(app, None)
+        try:
+            _, render_path = fetch_diagram(Translator(builder), self.node)
+        except nodes.SkipNode:
+            return builder, None
+        with open(render_path, 'rb') as render_file:
+            return builder, render_file.read()
+
+    def test_diagram_is_retrieved(self):
+        builder, rendering = self.build('A->B: hello')
+        self.assertIn(b'A-&gt;B: hello', rendering)
+        self.assertEqual(builder.warnings, [])
+
+    def test_last_good_rendering_is_used_when_the_server_fails(self):
+        self.build('A->B: hello')
+        self.server.error_rate = 1.0
+        builder, rendering = self.build('A->B: goodbye')
+        self.assertIn(b'A-&gt;B: hello', rendering)
+        self.assertEqual(len(builder.warnings), 1)
+        self.assertTrue(builder.warnings[0].startswith('Using the last good rendering of '))
+
+    def test_failure_is_reported_without_fallback(self):
+        self.build('A->B: hello')
+        self.server.error_rate = 1.0
+        builder, rendering = self.build('A->B: goodbye', phix_wsd_fallback=False)
+        self.assertEqual(rendering, None)
+        self.assertEqual(len(builder.warnings), 1)
+        self.assertTrue(builder.warnings[0].startswith('Could not render '))
+
+    def test_only_stale_renderings_are_retrieved_again(self):
+        self.build('A->B: hello')
+        posts = self.server.counts['posts']
+        self.build('A->B: hello', phix_wsd_cache_ttl=3600)
+        self.assertEqual(self.server.counts['posts'], posts)
+        time.sleep(0.01)
+        self.build('A->B: hello', phix_wsd_cache_ttl=0)
+        self.assertEqual(self.server.counts['posts'], posts + 1)
+
+
+class FreshnessTests(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.builder = Builder(self.directory)
+        self.cache = get_cache(self.builder)
+        rendered_path = os.path.join(self.directory, 'rendered.svg')
+        with open(rendered_path, 'wb') as rendered_file:
+            rendered_file.write(b'<svg/>')
+        self.cache.store('aa01', rendered_path, metadata={'fetched': time.time() - 100})
+        self.refresh = os.environ.pop('PHIX_WSD_REFRESH', None)
+
+    def tearDown(self):
+        os.environ.pop('PHIX_WSD_REFRESH', None)
+        if self.refresh is not None:
+            os.environ['PHIX_WSD_REFRESH'] = self.refresh
+        shutil.rmtree(self.directory)
+
+    def is_fresh(self, key='aa01', **values):
+        for name, value in values.items():
+            setattr(self.builder.config, name, value)
+        return is_fresh(self.builder.config, self.cache, key)
+
+    def test_without_ttl_cached_diagrams_are_fresh(self):
+        self.assertTrue(self.is_fresh())
+        self.assertFalse(self.is_fresh('bb02'))
+
+    def test_ttl(self):
+        self.assertTrue(self.is_fresh(phix_wsd_cache_ttl=200))
+        self.assertFalse(self.is_fresh(phix_wsd_cache_ttl=50))
+
+    def test_refresh(self):
+        self.assertFalse(self.is_fresh(phix_wsd_refresh=True))
+        os.environ['PHIX_WSD_REFRESH'] = '0'
+        self.assertTrue(self.is_fresh(phix_wsd_refresh=True))
+        os.environ['PHIX_WSD_REFRESH'] = '1'
+        self.assertFalse(self.is_fresh())
+
+if __name__ == '__main__':
+    unittest.main()
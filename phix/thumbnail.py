@@ -0,0 +1,196 @@
+'''Small previews of diagrams, shown in HTML in place of the diagrams until
+they are clicked.
+
+A page of many large diagrams is slow to load, though a reader wants only a
+few of them. A diagram with a thumbnail is shown as a simplified preview, no
+more than phix_thumbnail_width pixels wide, and the diagram itself is loaded
+only when the preview is clicked. The thumbnail option of a directive, or the
+phix_thumbnail configuration value for every diagram, chooses which diagrams
+have thumbnails.
+
+A thumbnail is made from the final SVG of the diagram, whichever tool drew it:
+its text, which is too small to read in a preview, is removed, and its
+coordinates are rounded by the optimizer. Thumbnails are kept in the render
+cache under the digest of the SVG and the width, and are made by the render
+tasks as each diagram is rendered.
+'''
+
+import logging
+import os
+import shutil
+import tempfile
+
+from docutils.parsers.rst import directives
+
+from .cache import cache_key, get_cache, touch
+from .optimize import OPTIMIZER_VERSION, optimize
+from .phix import PhixError, scratch_directory
+from .svg import intrinsic_size, parse_svg, view_box
+
+log = logging.getLogger('phix.thumbnail')
+logging.basicConfig()
+
+# The suffix of the file written for the thumbnail of each diagram, which is
+# also the suffix of its cache entry.
+THUMBNAIL_SUFFIX = '.thumbnail.svg'
+
+# The elements which are removed from thumbnails.
+TEXT_ELEMENTS = ('text', 'title', 'desc')
+
+
+def thumbnail_option(argument):
+    '''Convert and validate the :thumbnail: option of a directive.
+
+    The option may be given without an argument, or with yes or no, so that a
+    diagram can be shown without a thumbnail when phix_thumbnail is set.
+    '''
+    if argument is None or not argument.strip():
+        return True
+    return directives.choice(argument, ('yes', 'no')) == 'yes'
+
+def thumbnail_width(builder, node):
+    '''Determine the width of the thumbnail of a diagram.
+
+    Args:
+        builder: The Sphinx builder.
+
+        node: The phix docutils node, or the render job, of the diagram.
+
+    Returns:
+        The width in pixels, or None if the diagram has no thumbnail, as is
+        always so unless the builder writes HTML.
+    '''
+    if getattr(builder, 'format', None) != 'html':
+        return None
+    enabled = node.get('thumbnail')
+    if enabled is None:
+        enabled = getattr(builder.config, 'phix_thumbnail', False)
+    if not enabled:
+        return None
+    try:
+        width = int(builder.config.phix_thumbnail_width)
+    except (TypeError, ValueError):
+        raise PhixError('phix_thumbnail_width must be a number of pixels, not {0!r}'.format(
+            builder.config.phix_thumbnail_width))
+    if width <= 0:
+        raise PhixError('phix_thumbnail_width must be positive, not {0}'.format(width))
+    return width
+
+def thumbnail_svg(svg, width):
+    '''Make a thumbnail of an SVG document.
+
+    Args:
+        svg: The SVG document as bytes.
+
+        width: The width of the thumbnail in pixels. Its height keeps the
+            aspect ratio of the document.
+
+    Returns:
+        The thumbnail as bytes.
+
+    Raises:
+        PhixError: If the SVG could not be parsed, or its size determined.
+    '''
+    size = intrinsic_size(svg)
+    if size is None:
+        raise PhixError('Could not determine the size of the diagram')
+    document = parse_svg(svg, 'make a thumbnail')
+    try:
+        root = document.documentElement
+        for name in TEXT_ELEMENTS:
+            for element in list(root.getElementsByTagName(name)):
+                element.parentNode.removeChild(element)
+        box = view_box(root) or '0 0 {0} {1}'.format(size[0], size[1])
+        root.setAttribute('viewBox', box)
+        root.setAttribute('width', str(width))
+        root.setAttribute('height', str(max(1, int(round(width * size[1] / size[0])))))
+        simplified = document.toxml('utf-8')
+    finally:
+        document.unlink()
+    # A thumbnail is too small for fractions of the original units to show.
+    return optimize(simplified, precision=0)
+
+def thumbnail_key(svg_path, width):
+    '''The cache key of the thumbnail of an SVG file, which depends only upon
+    its contents, the width of the thumbnail and the version of the optimizer
+    which rounds it.'''
+    return cache_key(svg_path, 'thumbnail', width, OPTIMIZER_VERSION)
+
+def is_thumbnailed(builder, svg_path, width):
+    '''Determine whether the thumbnail of an SVG file is in the render cache.'''
+    cache = get_cache(builder)
+    return os.path.isfile(cache.path(thumbnail_key(svg_path, width), THUMBNAIL_SUFFIX))
+
+def thumbnail_to_cache(builder, svg_path, width):
+    '''Make the thumbnail of an SVG file in the render cache, unless it is
+    already cached.
+
+    Args:
+        builder: The Sphinx builder.
+
+        svg_path: The path to the SVG file.
+
+        width: The width of the thumbnail in pixels.
+
+    Returns:
+        The cache key of the thumbnail.
+
+    Raises:
+        PhixError: If the thumbnail could not be made or stored.
+    '''
+    cache = get_cache(builder)
+    key = thumbnail_key(svg_path, width)
+    if os.path.isfile(cache.path(key, THUMBNAIL_SUFFIX)):
+        return key
+
+    try:
+        with open(svg_path, 'rb') as svg_file:
+            svg = svg_file.read()
+    except (IOError, OSError) as e:
+        raise PhixError('Could not read {0}: {1}'.format(svg_path, e))
+
+    output_dir = tempfile.mkdtemp(dir=scratch_directory(builder))
+    try:
+        output_path = os.path.join(output_dir, 'output' + THUMBNAIL_SUFFIX)
+        thumbnail = thumbnail_svg(svg, width)
+        with open(output_path, 'wb') as output_file:
+            output_file.write(thumbnail)
+        cache.store(key, output_path, suffix=THUMBNAIL_SUFFIX)
+        log.info('Made a thumbnail of {0} in {1} bytes, from {2}'.format(
+            svg_path, len(thumbnail), len(svg)))
+    except (IOError, OSError) as e:
+        raise PhixError('Could not make a thumbnail of {0}: {1}'.format(svg_path, e))
+    finally:
+        shutil.rmtree(output_dir, ignore_errors=True)
+    return key
+
+def write_thumbnail(builder, render_path, width):
+    '''Write the thumbnail of a rendered diagram alongside it, making it unless
+    it is already cached.
+
+    Args:
+        builder: The Sphinx builder.
+
+        render_path: The path of the rendered SVG file, such as
+            _images/diagram.svg.
+
+        width: The width of the thumbnail in pixels.
+
+    Returns:
+        A 2-tuple of the path to which the thumbnail was written, such as
+        _images/diagram.thumbnail.svg, and its size in pixels.
+
+    Raises:
+        PhixError: If the thumbnail could not be written.
+    '''
+    cache = get_cache(builder)
+    entry_path = cache.path(thumbnail_to_cache(builder, render_path, width), THUMBNAIL_SUFFIX)
+    thumbnail_path = os.path.splitext(render_path)[0] + THUMBNAIL_SUFFIX
+    try:
+        shutil.copyfile(entry_path, thumbnail_path)
+        with open(thumbnail_path, 'rb') as thumbnail_file:
+            size = intrinsic_size(thumbnail_file.read())
+    except (IOError, OSError) as e:
+        raise PhixError('Could not write {0}: {1}'.format(thumbnail_path, e))
+    touch(entry_path)
+    return thumbnail_path, size
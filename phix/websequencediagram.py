@@ -1,20 +1,12 @@
 '''Phix tool for rendering websequencediagrams as SVG.
 '''
 
+import functools
 import logging
 import os
 import posixpath
-import subprocess
-import shlex
-import re
-import string
 import sys
-
-if sys.version_info.major == 2:
-    from urllib import urlencode, urlopen, urlretrieve
-else:
-    from urllib.parse import urlencode
-    from urllib.request import urlopen, urlretrieve
+import time
 
 from docutils import nodes
 from docutils.parsers.rst import directives, states
@@ -23,7 +15,20 @@ from docutils.parsers.rst.roles import set_classes
 from sphinx.util.compat import Directive
 from sphinx.util.osutil import ensuredir
 
-from .phix import PhixError, relfn2path, temp_path
+from .cache import alias_key, cache_key, get_cache, setup as setup_cache
+from .html import append_diagram, embed_option, setup as setup_html
+from .latex import append_latex_diagram, setup as setup_latex
+from .phix import (PhixError,
+                   note_render_job,
+                   relfn2path)
+from .scheduler import (plan_jobs,
+                        postprocessed_key,
+                        register_planner,
+                        render_failure,
+                        stream_to_cache)
+from .thumbnail import thumbnail_option
+from .websequencediagram_client import WSDClient
+from . import websequencediagram_local
 
 log = logging.getLogger('phix.websequencediagram')
 logging.basicConfig()
@@ -62,6 +67,8 @@ class WSDDirective(Directive):
                     'rose',
                     'vs2010')
 
+    engine_values = ('server', 'local')
+
     def align(argument):
         '''Convert and validate the :align: option.
 
@@ -87,9 +94,12 @@ class WSDDirective(Directive):
                    'align': align,
                    'border': directives.positive_int,
                    'class': directives.class_option,
+                   'embed': embed_option,
+                   'thumbnail': thumbnail_option,
                    'style': directives.unchanged,
                    'api-version':directives.unchanged,
-                   'server-url':directives.unchanged}
+                   'server-url':directives.unchanged,
+                   'engine': directives.unchanged}
 
     def run(self):
         '''Process the wsd directive.
@@ -105,7 +115,10 @@ class WSDDirective(Directive):
         # name of the WSD source file.
         reference = directives.uri(self.arguments[0])
         env = self.state.document.settings.env
-        _, filename = relfn2path(env, reference)
+        rel_filename, filename = relfn2path(env, reference)
+
+        # Rebuild this document, and only this document, when the source changes.
+        env.note_dependency(rel_filename)
 
         log.info('filename = {0}'.format(filename))
 
@@ -140,6 +153,16 @@ class WSDDirective(Directive):
                         self.options['style'],
                         '", "'.join(self.style_values)))
 
+        # validate :engine: option
+        engine = self.options.get('engine', env.config.phix_wsd_engine)
+        if engine not in self.engine_values:
+            raise self.error(
+                'Error in "{0}" directive: "{1}" is not a valid value '
+                'for the "engine" option.  Valid values for "engine" are: "{2}".'.format(
+                    self.name,
+                    engine,
+                    '", "'.join(self.engine_values)))
+
         set_classes(self.options)
 
         log.info("self.block_text = {0}".format(self.block_text))
@@ -155,10 +178,21 @@ class WSDDirective(Directive):
         wsd_node['style'] = self.options.get('style', 'vs2010')
         wsd_node['api_version'] = self.options.get('api-version', '1')
         wsd_node['server_url'] = self.options.get('server-url', None)
+        wsd_node['engine'] = engine
 
         log.info("wsd_node['new_window_flag'] = {0}".format(
                 wsd_node['new_window_flag']))
 
+        # Defer rendering so that the diagrams can be retrieved from the
+        # server concurrently once reading is complete.
+        note_render_job(env, 'wsd', {'uri': wsd_node['uri'],
+                                     'style': wsd_node['style'],
+                                     'api_version': wsd_node['api_version'],
+                                     'server_url': wsd_node['server_url'],
+                                     'engine': engine,
+                                     'postprocess': self.options.get('postprocess'),
+                                     'thumbnail': self.options.get('thumbnail')})
+
         return messages + [wsd_node]
 
 def get_image_filename(self, uri):
@@ -193,89 +227,159 @@ def get_image_filename(self, uri):
         refer_path = fname
         render_path = os.path.join(self.builder.outdir, fname)
 
-    if os.path.isfile(render_path):
-        return refer_path, render_path
-
     ensuredir(os.path.dirname(render_path))
 
     return refer_path, render_path
 
+def effective_server_url(server_url):
+    '''Determine the URL of the WSD server to be used.
+
+    Args:
+      server_url: The URL specified by the :server-url: option, or None.
+
+    Returns:
+      The URL in the PHIX_WEBSEQUENCEDIAGRAM_SERVER environment variable if it
+      is set, otherwise server_url.
+    '''
+    # See if the user overrode the server-url in the calling environment.
+    return os.environ.get('PHIX_WEBSEQUENCEDIAGRAM_SERVER', server_url)
+
 def retrieve_diagram(text,
                      output_file,
                      style,
                      api_version,
-                     server_url):
+                     server_url,
+                     client=None):
     '''Contact wsd server to create diagram from source text.
 
     Args:
       text: The source text.
-      output_file: The name of the file into which to put the output.
+      output_file: The name of the file into which to put the output, or a
+        file-like object to which it is written.
       style: The style of the drawing. Options={style}.
       api_version: Version of WSD api to use.
       server_url: The URL of the WSD server.
+      client: An optional WSDClient for the server, whose connections will be
+        reused. Otherwise a client is created for this diagram alone.
+
+    Returns:
+      The response of the server to the submission of the source text.
     '''.format(style=WSDDirective.style_values)
 
-    # See if the user overrode the server-url in the calling environment.
-    try:
-        server_url = os.environ['PHIX_WEBSEQUENCEDIAGRAM_SERVER']
-    except KeyError:
-        pass
+    server_url = effective_server_url(server_url)
 
     # Check that server URL is set.
     if not server_url:
         raise PhixError('Websequencediagram server not specified. Use either a ":server-url:" option or set PHIX_WEBSEQUENCEDIAGRAM_SERVER in your environment')
 
-    request = {}
-    request["message"] = text
-    request["style"] = style
-    request["apiVersion"] = api_version
-    request['format'] = 'svg'
+    if client is not None:
+        return client.retrieve(text, output_file, style, api_version)
 
-    url = urlencode(request)
+    client = WSDClient(server_url)
+    try:
+        return client.retrieve(text, output_file, style, api_version)
+    finally:
+        client.close()
+
+def get_client(app, server_url):
+    '''Get the WSDClient shared by the render tasks of a build for a server.
+
+    Args:
+        app: The Sphinx application.
 
-    f = urlopen(server_url, url.encode())
-    line = f.readline()
-    f.close()
+        server_url: The effective URL of the WSD server.
+
+    Returns:
+        A WSDClient, or None if server_url is not set.
+
+    Raises:
+        PhixError: If server_url is not an http or https URL.
+    '''
+    if not server_url:
+        return None
+    clients = getattr(app.builder, 'phix_wsd_clients', None)
+    if clients is None:
+        clients = app.builder.phix_wsd_clients = {}
+    if server_url not in clients:
+        clients[server_url] = WSDClient(server_url,
+                                        max_in_flight=app.config.phix_wsd_max_in_flight,
+                                        rate_limit=app.config.phix_wsd_rate_limit,
+                                        connect_timeout=app.config.phix_wsd_connect_timeout,
+                                        read_timeout=app.config.phix_wsd_read_timeout,
+                                        failure_limit=app.config.phix_wsd_failure_limit)
+    return clients[server_url]
+
+def close_clients(app, exception):
+    '''Close the connections of the WSD clients once the build has finished.'''
+    clients = getattr(app.builder, 'phix_wsd_clients', {})
+    for client in clients.values():
+        client.close()
+    clients.clear()
+
+def write_diagram(source_text, output_file, style, api_version, server_url, client, engine):
+    '''Render diagram source with the selected engine.
 
-    log.info('Server response: {0}'.format(
-            line))
+    Args:
+        source_text: The wsd source.
 
-    expr = re.compile("(\?(png|pdf|svg)=[a-zA-Z0-9]+)")
-    m = expr.search(line.decode())
+        output_file: A file-like object to which the SVG is written.
 
-    if m == None:
-        raise PhixError("Invalid response from server: {0}".format(line))
+        The remaining arguments are as for create_graphics().
 
-    urlretrieve(
-        server_url + m.group(0),
-        output_file)
+    Returns:
+        A dictionary of metadata describing the rendering.
+    '''
+    if engine == 'local':
+        output_file.write(websequencediagram_local.render(source_text).encode('utf-8'))
+        return {'fetched': time.time(),
+                'engine': 'local',
+                'renderer_version': websequencediagram_local.RENDERER_VERSION}
 
-def create_graphics(self,
-                    wsd_uri,
+    response = retrieve_diagram(
+        text=source_text,
+        output_file=output_file,
+        style=style,
+        api_version=api_version,
+        server_url=server_url,
+        client=client)
+    return {'fetched': time.time(),
+            'server_url': effective_server_url(server_url),
+            'style': style,
+            'api_version': api_version,
+            'response': response}
+
+def create_graphics(wsd_uri,
                     render_path,
                     style,
                     api_version,
                     server_url,
-                    postprocess_command):
+                    client=None,
+                    engine='server'):
     '''
-    Use a websequencediagrams server to render a from a wsd text
-    description file into graphics of the specified format.
+    Use a websequencediagrams server, or the local renderer, to render a from
+    a wsd text description file into graphics of the specified format.
 
     Args:
         wsd_uri:  The path to the wsd source file.
 
         render_path: The path to which the graphics output is to be rendered.
 
-        postprocess_command: An optional command into which the WSD SVG
-           output will be piped before it is placed in the output document.
-           The command should accept SVG on stdin and produce SVG on stdout.
-
         style: The style of the rendering. Options = {styles}
 
         api_version: Version of WSD API to use (string).
 
         server_url: The URL of the WSD server to use.
 
+        client: An optional WSDClient for the server.
+
+        engine: 'server' to retrieve the rendering from the server, or 'local'
+           to render it with the local renderer, which ignores style,
+           api_version and server_url.
+
+    Returns:
+        A dictionary of metadata describing the rendering, to be stored with
+        it in the render cache.
+
     Raises:
         PhixError: If the graphics could not be rendered.
     '''.format(styles=WSDDirective.style_values)
@@ -284,63 +388,202 @@ def create_graphics(self,
     log.info("wsd_uri = {0}".format(wsd_uri))
     log.info("render_path = {0}".format(render_path))
 
-    output_path = render_path if postprocess_command is None else temp_path('.svg')
-    log.info("output_path = {0}".format(output_path))
+    with open(render_path, 'wb') as output_file:
+        return write_graphics(wsd_uri, output_file, style, api_version,
+                              server_url, client, engine)
+
+def write_graphics(wsd_uri,
+                   output_file,
+                   style,
+                   api_version,
+                   server_url,
+                   client=None,
+                   engine='server'):
+    '''Render a wsd text description file, writing the SVG to a file-like
+    object as it is retrieved.
+
+    Args:
+        wsd_uri: The path to the wsd source file.
 
+        output_file: A file-like object to which the SVG is written.
+
+        The remaining arguments are as for create_graphics().
+
+    Returns:
+        A dictionary of metadata describing the rendering.
+
+    Raises:
+        PhixError: If the graphics could not be rendered.
+    '''
     # Contact a wsd server and instruct it to export the diagram as SVG
     with open(wsd_uri, 'r') as f:
         source_text = f.read()
 
-    retrieve_diagram(
-        text=source_text,
-        output_file=output_path,
-        style=style,
-        api_version=api_version,
-        server_url=server_url)
-
-    # If a postprocess command has been specified
-    # TODO: The logic for doing post-process commands is common
-    # between many tools. It should be refactored.
-    if postprocess_command is not None:
-        log.info("postprocess_command = {0}".format(postprocess_command))
-
-        # We use our own variable interpolation with the $VAR syntax rather than
-        # relying on the underlying shell, so that we can support the same
-        # variable syntax on both Windows and Linux.
-        postprocess_command_template = string.Template(str(postprocess_command))
-        interpolated_postprocess_command = postprocess_command_template.substitute(os.environ)
-        log.info("interpolated_postprocess_command = {0}".format(
-                interpolated_postprocess_command))
-
-        postprocess_command_fragments = shlex.split(interpolated_postprocess_command, posix=False)
-        log.info("postprocess_command_fragments = {0}".format(
-                postprocess_command_fragments))
-
-        with open(output_path, 'rb') as intermediate_file:
-            with open(render_path, 'wb') as render_file:
-                returncode = subprocess.call(postprocess_command_fragments, stdin=intermediate_file, stdout=render_file)
-                log.info("returncode = {0}".format(returncode))
-                if returncode != 0:
-                    raise PhixError("Could not launch postprocess with command {0}".format(' '.join(postprocess_command)))
-        if os.path.exists(output_path):
-            log.info("Removing {0}".format(output_path))
-            os.remove(output_path)
+    return write_diagram(source_text, output_file, style, api_version,
+                         server_url, client, engine)
 
-def render_html(self, node):
-    '''Render the supplied node as HTML.
+def render_key(node):
+    '''Compute the render cache key for a wsd node.
 
-    Note: This method *always* raises docutils.nodes.SkipNode to ensure that the
-        child nodes are not visited.
+    The server takes the place of the tool version, so the key includes the
+    server URL and the API version. The local renderer ignores them, and is
+    identified by its version instead.
+    '''
+    if node.get('engine') == 'local':
+        return cache_key(node['uri'],
+                         'wsd',
+                         'local',
+                         websequencediagram_local.RENDERER_VERSION)
+    return cache_key(node['uri'],
+                     'wsd',
+                     node['style'],
+                     node['api_version'],
+                     effective_server_url(node['server_url']))
+
+def last_good_key(node):
+    '''Compute the render cache key under which the most recent successful
+    rendering of a wsd node is kept, whatever its source text.
+
+    The server is deliberately not part of the key, so that a rendering from
+    any server can stand in when the server is unavailable.
+    '''
+    return alias_key(os.path.abspath(node['uri']),
+                     'wsd-last-good',
+                     node['style'],
+                     node['api_version'],
+                     node.get('postprocess'))
+
+def render_diagram(app, key, jobs, client):
+    '''Retrieve a diagram into the render cache, postprocessing it for each of
+    the render jobs which need it as it is downloaded, and keep each result as
+    the last good rendering of its source file.'''
+    job = jobs[0]
+    render = functools.partial(write_graphics,
+                               job['uri'],
+                               style=job['style'],
+                               api_version=job['api_version'],
+                               server_url=job['server_url'],
+                               client=client,
+                               engine=job.get('engine', 'server'))
+    if not stream_to_cache(app.builder, key, jobs, render):
+        return
+    if job.get('engine') == 'local':
+        return
+    cache = get_cache(app.builder)
+    for job in jobs:
+        try:
+            final_key = postprocessed_key(app.builder, key, job['postprocess'])
+            if final_key in cache:
+                cache.store(last_good_key(job), cache.path(final_key), metadata=cache.metadata(final_key))
+        except PhixError:
+            log.info('Could not keep last good rendering of {0}'.format(job['uri']),
+                     exc_info=sys.exc_info())
+
+def fetch_fallback(builder, node, key, render_path):
+    '''Fetch the best available rendering of a diagram which could not be
+    retrieved: the out of date cached rendering of the same source, or else
+    the last good rendering of the source file.
+
+    Returns:
+        True if a rendering was copied to render_path, otherwise False.
+    '''
+    if not builder.config.phix_wsd_fallback:
+        return False
+    cache = get_cache(builder)
+    return (cache.fetch(key, render_path)
+            or cache.fetch(last_good_key(node), render_path))
+
+def refresh_requested(config):
+    '''Determine whether cached diagrams should be retrieved again regardless.
+
+    Returns:
+        True if the PHIX_WSD_REFRESH environment variable is set to a non-empty
+        value other than 0, or otherwise the phix_wsd_refresh configuration
+        value.
+    '''
+    if 'PHIX_WSD_REFRESH' in os.environ:
+        return os.environ['PHIX_WSD_REFRESH'] not in ('', '0')
+    return bool(config.phix_wsd_refresh)
+
+def is_fresh(config, cache, key):
+    '''Determine whether a cached diagram may be used without contacting the
+    server.
+
+    Args:
+        config: The Sphinx configuration.
+
+        cache: The render cache.
+
+        key: The render cache key of the diagram.
+
+    Returns:
+        True if the diagram is cached, a refresh has not been requested, and it
+        was retrieved no more than phix_wsd_cache_ttl seconds ago.
+    '''
+    if key not in cache or refresh_requested(config):
+        return False
+    ttl = config.phix_wsd_cache_ttl
+    if ttl is None:
+        return True
+    metadata = cache.metadata(key) or {}
+    fetched = metadata.get('fetched')
+    return fetched is not None and time.time() - fetched <= ttl
+
+def plan_render(app, jobs):
+    '''Plan the rendering of websequencediagrams.
+
+    Each task retrieves one diagram which is not cached, or whose cached
+    rendering is out of date, from the server. The tasks for
+    each server share a WSDClient, so that they reuse its connections.
+    Diagrams rendered by the local renderer never go out of date. Diagrams
+    which are cached and up to date, but not with the postprocess they need,
+    are postprocessed without contacting the server.
+
+    Args:
+        app: The Sphinx application.
+
+        jobs: The wsd render jobs recorded by the documents.
+
+    Returns:
+        A list of render tasks.
+    '''
+    cache = get_cache(app.builder)
+    local_jobs = [job for job in jobs if job.get('engine') == 'local']
+    server_jobs = [job for job in jobs if job.get('engine') != 'local']
+    unrendered, tasks = plan_jobs(app.builder, local_jobs, render_key)
+    for key, key_jobs in unrendered.items():
+        tasks.append(functools.partial(render_diagram, app, key, key_jobs, None))
+
+    unrendered, postprocess_tasks = plan_jobs(app.builder,
+                                              server_jobs,
+                                              render_key,
+                                              functools.partial(is_fresh, app.config, cache))
+    tasks.extend(postprocess_tasks)
+    for key, key_jobs in unrendered.items():
+        server_url = effective_server_url(key_jobs[0]['server_url'])
+        try:
+            client = get_client(app, server_url)
+        except PhixError:
+            # Leave the error to be reported by retrieve_diagram.
+            client = None
+        tasks.append(functools.partial(render_diagram, app, key, key_jobs, client))
+    return tasks
+
+def fetch_diagram(self, node):
+    '''
+    Fetch the rendering of the supplied node into the output directory.
 
     Args:
         node: An wsd docutils node.
 
+    Returns:
+        A 2-tuple of the path by which the output refers to the rendering and
+        the path to which it was fetched, from get_image_filename().
+
     Raises:
-        SkipNode: Do not visit the current node's children, and do not call the
-        current node's ``depart_...`` method.
+        SkipNode: If the rendering could not be fetched, which has been
+        reported.
     '''
-    has_thumbnail = False
-
     try:
         refer_path, render_path = get_image_filename(self, node['uri'])
         log.info("refer_path = {0}".format(refer_path))
@@ -348,13 +591,19 @@ def render_html(self, node):
         log.info("node['uri'] = {0}".format(node['uri']))
         log.info('node["style"] = {0}'.format(node['style']))
 
-        create_graphics(self,
-                        wsd_uri=node['uri'],
-                        render_path=render_path,
-                        postprocess_command=node.get('postprocess'),
-                        style=node['style'],
-                        api_version=node['api_version'],
-                        server_url=node['server_url'])
+        tool_key = render_key(node)
+        key = postprocessed_key(self.builder, tool_key, node.get('postprocess'))
+        # A failed refresh must not be hidden by the out of date rendering.
+        failures = getattr(self.builder, 'phix_render_failures', {})
+        if (tool_key in failures
+            or key in failures
+            or not get_cache(self.builder).fetch(key, render_path)):
+            failure = render_failure(self.builder, tool_key, key)
+            if not fetch_fallback(self.builder, node, key, render_path):
+                raise PhixError(failure)
+            self.builder.warn('Using the last good rendering of {0} because of {1}'.format(
+                    node['uri'],
+                    failure))
     except PhixError:
         exc = sys.exc_info()
         log.info('Could not render {0}'.format(node['uri']),
@@ -363,22 +612,41 @@ def render_html(self, node):
                 node['uri'],
                 exc[1]))
         raise nodes.SkipNode
+    return refer_path, render_path
 
-    self.body.append(self.starttag(node, 'p', CLASS='dia'))
+def render_html(self, node):
+    '''Render the supplied node as HTML.
 
-    objtag_format = '<object data="%s" width="%s" height="%s" border="%s" type="image/svg+xml" class="img">\n'
-    self.body.append(objtag_format % (refer_path, node['width'], node['height'], node['border']))
-    self.body.append('</object>')
+    Note: This method *always* raises docutils.nodes.SkipNode to ensure that the
+        child nodes are not visited.
 
-    if node['new_window_flag']:
-        self.body.append('<p align="right">\n')
-        new_window_tag_format = '<a href="{0}" target="_blank">Open in new window</a>'
-        self.body.append(new_window_tag_format.format(refer_path))
-        self.body.append('</p>\n')
+    Args:
+        node: An wsd docutils node.
 
-    self.body.append('</p>\n')
+    Raises:
+        SkipNode: Do not visit the current node's children, and do not call the
+        current node's ``depart_...`` method.
+    '''
+    refer_path, render_path = fetch_diagram(self, node)
+    append_diagram(self, node, 'dia', refer_path, render_path)
     raise nodes.SkipNode
 
+def render_latex(self, node):
+    '''Render the supplied node as LaTeX, including the diagram as PDF.
+
+    Note: This method *always* raises docutils.nodes.SkipNode to ensure that the
+        child nodes are not visited.
+
+    Args:
+        node: An wsd docutils node.
+
+    Raises:
+        SkipNode: Do not visit the current node's children, and do not call the
+        current node's ``depart_...`` method.
+    '''
+    refer_path, render_path = fetch_diagram(self, node)
+    append_latex_diagram(self, node, render_path)
+    raise nodes.SkipNode
 
 def html_visit_wsd(self, node):
     '''Visit a wsd node during HTML rendering.'''
@@ -387,13 +655,28 @@ def html_visit_wsd(self, node):
 
 def latex_visit_wsd(self, node):
     '''Visit a wsd node during latex rendering.'''
-    render_latex(self, node, node['code'], node['options'])
+    render_latex(self, node)
 
 def setup(app):
     '''Register the services of this plug-in with Sphinx.'''
+    setup_cache(app)
+    setup_html(app)
+    setup_latex(app)
+    register_planner(app, 'wsd', plan_render)
+    app.add_config_value('phix_wsd_max_in_flight', 8, '')
+    app.add_config_value('phix_wsd_rate_limit', None, '')
+    app.add_config_value('phix_wsd_cache_ttl', None, '')
+    app.add_config_value('phix_wsd_refresh', False, '')
+    app.add_config_value('phix_wsd_connect_timeout', 10, '')
+    app.add_config_value('phix_wsd_read_timeout', 60, '')
+    app.add_config_value('phix_wsd_failure_limit', 3, '')
+    app.add_config_value('phix_wsd_fallback', True, '')
+    app.add_config_value('phix_wsd_engine', 'server', 'env')
+    app.connect('build-finished', close_clients)
     app.add_node(
         wsd,
-        html=(html_visit_wsd, None))
+        html=(html_visit_wsd, None),
+        latex=(latex_visit_wsd, None))
     app.add_directive(
         'websequencediagram',
         WSDDirective)
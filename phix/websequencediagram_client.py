@@ -0,0 +1,295 @@
+'''A client for websequencediagrams servers which reuses its connections.
+
+Retrieving a diagram takes two requests - one to submit the source text, and
+another to download the rendering - so with a distant server most of the time
+is spent establishing connections and waiting for round trips. A WSDClient
+keeps a pool of keep-alive connections to its server, which is shared by all of
+the render tasks running at once, and limits both the number of requests in
+flight and the rate at which they are made, so as not to overload the server.
+
+So that an unreachable or failing server cannot stall a build, every request
+is subject to connect and read timeouts, and a client stops contacting its
+server altogether after a number of consecutive failures.
+'''
+
+import logging
+import re
+import socket
+import sys
+import threading
+import time
+
+if sys.version_info.major == 2:
+    import httplib
+    from urllib import urlencode
+    from urlparse import urlsplit
+else:
+    import http.client as httplib
+    from urllib.parse import urlencode, urlsplit
+
+from .phix import PhixError
+
+log = logging.getLogger('phix.websequencediagram_client')
+logging.basicConfig()
+
+# The size of the blocks in which downloads are written to the output file.
+CHUNK_SIZE = 64 * 1024
+
+# The errors which indicate that a pooled connection was closed by the server
+# while it was idle, and that the request may be retried on a new one.
+STALE_CONNECTION_ERRORS = (httplib.BadStatusLine,
+                           httplib.CannotSendRequest,
+                           httplib.ResponseNotReady,
+                           socket.error)
+
+# The methods which may be retried on a new connection once their request has
+# been sent, since repeating them has no further effect.
+IDEMPOTENT_METHODS = ('GET', 'HEAD', 'PUT', 'DELETE', 'OPTIONS')
+
+IMAGE_EXPR = re.compile(r"(\?(png|pdf|svg)=[a-zA-Z0-9]+)")
+
+
+class WSDClient(object):
+    '''A connection-pooling client for one websequencediagrams server.
+
+    A client may be used by many threads at once.
+    '''
+
+    def __init__(self, server_url, max_in_flight=8, rate_limit=None,
+                 connect_timeout=10, read_timeout=60, failure_limit=None):
+        '''
+        Args:
+            server_url: The URL of the WSD server.
+
+            max_in_flight: The largest number of requests to have outstanding
+                at once, which is also the largest number of connections kept.
+
+            rate_limit: The largest number of requests to make each second, or
+                None for no limit.
+
+            connect_timeout: The number of seconds to wait for a connection to
+                the server to be established.
+
+            read_timeout: The number of seconds to wait for each read from the
+                server.
+
+            failure_limit: The number of consecutive failed retrievals after
+                which the server is no longer contacted, or None to keep trying.
+
+        Raises:
+            PhixError: If server_url is not an http or https URL.
+        '''
+        self.server_url = server_url
+        parts = urlsplit(server_url)
+        if parts.scheme == 'https':
+            self.connection_class = httplib.HTTPSConnection
+        elif parts.scheme == 'http':
+            self.connection_class = httplib.HTTPConnection
+        else:
+            raise PhixError('Websequencediagram server URL {0} is not an http or https URL'.format(server_url))
+        self.netloc = parts.netloc
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.failure_limit = failure_limit
+        self.consecutive_failures = 0
+        self.in_flight = threading.BoundedSemaphore(max(1, int(max_in_flight)))
+        self.interval = 1.0 / rate_limit if rate_limit else 0.0
+        self.next_request_time = 0.0
+        self.lock = threading.Lock()
+        self.idle = []
+
+    def acquire_connection(self):
+        with self.lock:
+            if self.idle:
+                return self.idle.pop(), True
+        log.info('Connecting to {0}'.format(self.netloc))
+        connection = self.connection_class(self.netloc, timeout=self.connect_timeout)
+        try:
+            connection.connect()
+        except socket.error:
+            connection.close()
+            raise PhixError('Could not connect to websequencediagram server {0}: {1}'.format(
+                self.server_url, sys.exc_info()[1]))
+        connection.sock.settimeout(self.read_timeout)
+        return connection, False
+
+    def release_connection(self, connection, response):
+        if response.will_close:
+            connection.close()
+            return
+        with self.lock:
+            self.idle.append(connection)
+
+    def wait_for_rate_limit(self):
+        if not self.interval:
+            return
+        with self.lock:
+            now = time.time()
+            start = max(now, self.next_request_time)
+            self.next_request_time = start + self.interval
+        if start > now:
+            time.sleep(start - now)
+
+    def request(self, method, url, body=None, headers=None, output=None, idempotent=None):
+        '''Make a request of the server.
+
+        A request on a pooled connection which the server has closed is made
+        again on a new connection if it could not be sent, or if it is
+        idempotent, since the server may have acted upon it before closing
+        the connection.
+
+        Args:
+            method: The HTTP method.
+
+            url: The URL to request, which must be on the server.
+
+            body: An optional request body, as bytes.
+
+            headers: An optional dictionary of request headers.
+
+            output: An optional file-like object to which the response body is
+                streamed. Nothing is written to it unless the server responds
+                with a success status.
+
+            idempotent: Whether the request may safely be made twice, or None
+                to decide by the method.
+
+        Returns:
+            The response body as bytes, or None if output was given.
+
+        Raises:
+            PhixError: If the request failed, the server did not respond with
+                a success status, or the server has failed failure_limit times
+                in a row.
+        '''
+        parts = urlsplit(url)
+        path = parts.path or '/'
+        if parts.query:
+            path = '{0}?{1}'.format(path, parts.query)
+
+        with self.in_flight:
+            # The server may have failed while this request was waiting.
+            self.check_circuit()
+            self.wait_for_rate_limit()
+            if idempotent is None:
+                idempotent = method in IDEMPOTENT_METHODS
+            while True:
+                connection, reused = self.acquire_connection()
+                sent = False
+                try:
+                    connection.request(method, path, body, headers or {})
+                    sent = True
+                    response = connection.getresponse()
+                except socket.timeout:
+                    connection.close()
+                    raise PhixError('Timed out waiting for websequencediagram server {0}'.format(
+                        self.server_url))
+                except STALE_CONNECTION_ERRORS:
+                    connection.close()
+                    if reused and (idempotent or not sent):
+                        log.info('Reconnecting to {0}'.format(self.netloc))
+                        continue
+                    raise PhixError('Could not contact websequencediagram server {0}: {1}'.format(
+                        self.server_url, sys.exc_info()[1]))
+                break
+
+            succeeded = 200 <= response.status < 300
+            try:
+                if output is None or not succeeded:
+                    # The body of an error response is read, and discarded, so
+                    # that the connection can be used again.
+                    content = response.read()
+                else:
+                    content = None
+                    while True:
+                        chunk = response.read(CHUNK_SIZE)
+                        if not chunk:
+                            break
+                        output.write(chunk)
+            except (httplib.HTTPException, socket.error):
+                connection.close()
+                raise PhixError('Could not read response from websequencediagram server {0}: {1}'.format(
+                    self.server_url, sys.exc_info()[1]))
+            self.release_connection(connection, response)
+
+        if not succeeded:
+            raise PhixError('Websequencediagram server {0} responded with {1} {2}'.format(
+                self.server_url, response.status, response.reason))
+        return content
+
+    def check_circuit(self):
+        '''Raise PhixError if the server has failed too often to be contacted.'''
+        if self.failure_limit is not None and self.consecutive_failures >= self.failure_limit:
+            raise PhixError('Websequencediagram server {0} is not being contacted after {1} consecutive failures'.format(
+                self.server_url, self.consecutive_failures))
+
+    def record_outcome(self, succeeded):
+        with self.lock:
+            if succeeded:
+                self.consecutive_failures = 0
+            elif self.failure_limit is None or self.consecutive_failures < self.failure_limit:
+                self.consecutive_failures += 1
+                if self.consecutive_failures == self.failure_limit:
+                    log.warning('Websequencediagram server {0} has failed {1} times in a row; '
+                                'it will not be contacted again in this build'.format(
+                                    self.server_url, self.consecutive_failures))
+
+    def retrieve(self, text, output_file, style, api_version):
+        '''Render a diagram and download it to a file.
+
+        Args:
+            text: The source text.
+
+            output_file: The path of the file into which to put the output, or a
+                file-like object to which the output is written.
+
+            style: The style of the diagram.
+
+            api_version: Version of WSD api to use.
+
+        Returns:
+            The response of the server to the submission of the source text.
+
+        Raises:
+            PhixError: If the diagram could not be retrieved, or the server has
+                failed failure_limit times in a row.
+        '''
+        try:
+            line = self.submit_and_download(text, output_file, style, api_version)
+        except PhixError:
+            self.record_outcome(False)
+            raise
+        self.record_outcome(True)
+        return line
+
+    def submit_and_download(self, text, output_file, style, api_version):
+        body = urlencode({'message': text,
+                          'style': style,
+                          'apiVersion': api_version,
+                          'format': 'svg'})
+        # Submitting the same source again only renders it again, so the
+        # submission may be retried like a GET.
+        response = self.request('POST', self.server_url, body.encode(),
+                                {'Content-Type': 'application/x-www-form-urlencoded'},
+                                idempotent=True)
+        line = response.splitlines()[0].decode() if response else ''
+
+        log.info('Server response: {0}'.format(line))
+
+        m = IMAGE_EXPR.search(line)
+        if m is None:
+            raise PhixError("Invalid response from server: {0}".format(line))
+
+        if hasattr(output_file, 'write'):
+            self.request('GET', self.server_url + m.group(0), output=output_file)
+        else:
+            with open(output_file, 'wb') as output:
+                self.request('GET', self.server_url + m.group(0), output=output)
+        return line
+
+    def close(self):
+        '''Close all of the idle connections.'''
+        with self.lock:
+            idle, self.idle = self.idle, []
+        for connection in idle:
+            connection.close()
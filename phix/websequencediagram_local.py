@@ -0,0 +1,467 @@
+'''A local renderer for a subset of the websequencediagrams syntax.
+
+The renderer draws sequence diagrams as SVG without contacting a server, so
+builds which use it are fast, deterministic and work offline. It understands
+the commonly used parts of the language:
+
+* ``title Text``
+* ``participant Name``, ``participant "Long Name" as Alias`` and ``actor``
+* messages, ``A->B: text``, with ``-->`` for dashed lines and ``->>`` or
+  ``-->>`` for open arrowheads
+* activations, either with ``activate A`` and ``deactivate A``, or with
+  ``A->+B: text``, which activates B, and ``B->-A: text``, which deactivates B
+* notes, ``note left of A: text``, ``note right of A: text``,
+  ``note over A: text`` and ``note over A,B: text``, or spread over several
+  lines and closed by ``end note``
+* groups, ``alt``, ``opt``, ``loop``, ``par``, ``critical``, ``break`` and
+  ``group``, with ``else`` and closed by ``end``
+* comments, which are lines beginning with ``#``
+
+A literal ``\\n`` in any text starts a new line. Anything else, and in
+particular the styles of the websequencediagrams server, needs the server.
+'''
+
+import re
+
+from xml.sax.saxutils import escape
+
+from .phix import PhixError
+
+# Identifies the output of this renderer, so that cached renderings are
+# discarded when the renderer changes.
+RENDERER_VERSION = 1
+
+FONT_SIZE = 13
+CHAR_WIDTH = 7.5
+LINE_HEIGHT = 16
+MARGIN = 50
+BOX_PADDING = 10
+MIN_GAP = 40
+ACTIVATION_WIDTH = 10
+SELF_MESSAGE_WIDTH = 30
+GROUP_KEYWORDS = ('alt', 'opt', 'loop', 'par', 'critical', 'break', 'group')
+
+PARTICIPANT_EXPR = re.compile(
+    r'^(?:participant|actor)\s+(?:"(?P<quoted>[^"]*)"|(?P<label>.+?))(?:\s+as\s+(?P<alias>\S+))?$')
+MESSAGE_EXPR = re.compile(
+    r'^(?P<source>[^:]+?)\s*(?P<arrow>-->>|->>|-->|->)\s*(?P<modifier>[+-]?)\s*'
+    r'(?P<target>[^:]+?)\s*(?::\s*(?P<text>.*))?$')
+NOTE_EXPR = re.compile(
+    r'^note\s+(?P<position>left of|right of|over)\s+(?P<participants>[^:]+?)\s*(?::\s*(?P<text>.*))?$')
+GROUP_EXPR = re.compile(r'^(?P<keyword>{0})\b\s*(?P<text>.*)$'.format('|'.join(GROUP_KEYWORDS)))
+ELSE_EXPR = re.compile(r'^else\b\s*(?P<text>.*)$')
+END_EXPR = re.compile(r'^end$')
+ACTIVATION_EXPR = re.compile(r'^(?P<keyword>activate|deactivate)\s+(?P<participant>.+)$')
+TITLE_EXPR = re.compile(r'^title\s+(?P<text>.*)$')
+
+
+class Diagram(object):
+    '''A parsed sequence diagram.
+
+    Attributes:
+        title: The title, or None.
+
+        participants: The labels of the participants, in order of appearance.
+
+        events: A list of tuples, beginning with the kind of event, in the
+            order in which they appear in the diagram.
+    '''
+
+    def __init__(self):
+        self.title = None
+        self.participants = []
+        self.aliases = {}
+        self.events = []
+
+    def participant(self, name):
+        '''Find, or add, the participant with a name or alias.
+
+        Returns:
+            The index of the participant.
+        '''
+        name = name.strip()
+        if len(name) > 1 and name[0] == name[-1] == '"':
+            name = name[1:-1]
+        if name not in self.aliases:
+            self.aliases[name] = len(self.participants)
+            self.participants.append(name)
+        return self.aliases[name]
+
+
+def text_lines(text):
+    return (text or '').strip().split('\\n')
+
+def text_width(lines):
+    return max([len(line) for line in lines] or [0]) * CHAR_WIDTH
+
+
+def parse(text):
+    '''Parse websequencediagrams source.
+
+    Args:
+        text: The source of the diagram.
+
+    Returns:
+        A Diagram.
+
+    Raises:
+        PhixError: If the source uses syntax which is not supported.
+    '''
+    diagram = Diagram()
+    open_groups = 0
+    source_lines = text.splitlines()
+    line_number = 0
+    while line_number < len(source_lines):
+        line = source_lines[line_number].strip()
+        line_number += 1
+        if not line or line.startswith('#'):
+            continue
+
+        m = TITLE_EXPR.match(line)
+        if m:
+            diagram.title = text_lines(m.group('text'))
+            continue
+
+        m = PARTICIPANT_EXPR.match(line)
+        if m:
+            label = m.group('quoted') if m.group('quoted') is not None else m.group('label')
+            index = diagram.participant(label)
+            if m.group('alias'):
+                diagram.aliases[m.group('alias')] = index
+            continue
+
+        m = NOTE_EXPR.match(line)
+        if m:
+            participants = [diagram.participant(name)
+                            for name in m.group('participants').split(',')]
+            if m.group('text') is not None:
+                lines = text_lines(m.group('text'))
+            else:
+                lines = []
+                while True:
+                    if line_number >= len(source_lines):
+                        raise PhixError('Note on line {0} has no "end note"'.format(line_number))
+                    note_line = source_lines[line_number].strip()
+                    line_number += 1
+                    if note_line == 'end note':
+                        break
+                    lines.append(note_line)
+            diagram.events.append(('note', m.group('position'), participants, lines))
+            continue
+
+        m = GROUP_EXPR.match(line)
+        if m:
+            open_groups += 1
+            diagram.events.append(('group', m.group('keyword'), text_lines(m.group('text'))))
+            continue
+
+        m = ELSE_EXPR.match(line)
+        if m:
+            if not open_groups:
+                raise PhixError('"else" outside a group on line {0}'.format(line_number))
+            diagram.events.append(('else', text_lines(m.group('text'))))
+            continue
+
+        if END_EXPR.match(line):
+            if not open_groups:
+                raise PhixError('"end" outside a group on line {0}'.format(line_number))
+            open_groups -= 1
+            diagram.events.append(('end',))
+            continue
+
+        m = ACTIVATION_EXPR.match(line)
+        if m:
+            diagram.events.append((m.group('keyword'), diagram.participant(m.group('participant'))))
+            continue
+
+        m = MESSAGE_EXPR.match(line)
+        if m:
+            source = diagram.participant(m.group('source'))
+            target = diagram.participant(m.group('target'))
+            arrow = m.group('arrow')
+            diagram.events.append(('message', source, target, text_lines(m.group('text')),
+                                   arrow.startswith('--'), arrow.endswith('>>')))
+            if m.group('modifier') == '+':
+                diagram.events.append(('activate', target))
+            elif m.group('modifier') == '-':
+                diagram.events.append(('deactivate', source))
+            continue
+
+        raise PhixError('Line {0} is not supported by the local websequencediagram engine: {1}'.format(
+            line_number, line))
+
+    for _ in range(open_groups):
+        diagram.events.append(('end',))
+    return diagram
+
+
+class Layout(object):
+    '''Computes the positions of the parts of a diagram and draws them.'''
+
+    def __init__(self, diagram):
+        self.diagram = diagram
+        self.boxes = [text_lines(label) for label in diagram.participants]
+        self.box_widths = [text_width(lines) + 2 * BOX_PADDING for lines in self.boxes]
+        self.box_height = max([len(lines) for lines in self.boxes] or [1]) * LINE_HEIGHT + BOX_PADDING
+        self.layout_columns()
+
+    def layout_columns(self):
+        '''Space the participants so that all of the text fits between them.'''
+        count = len(self.boxes)
+        gaps = [MIN_GAP + (self.box_widths[index] + self.box_widths[index + 1]) / 2.0
+                for index in range(count - 1)]
+        left = max([MARGIN + width / 2.0 for width in self.box_widths[:1]] or [MARGIN])
+        right = max([MARGIN + width / 2.0 for width in self.box_widths[-1:]] or [MARGIN])
+
+        def need_after(index, width):
+            # Make space to the right of the participant at index, returning
+            # the right margin needed were it the last participant.
+            if index < count - 1:
+                gaps[index] = max(gaps[index], width)
+            return width + MARGIN
+
+        def need_before(index, width):
+            # Make space to the left of the participant at index, returning
+            # the left margin needed were it the first participant.
+            if index > 0:
+                gaps[index - 1] = max(gaps[index - 1], width)
+            return width + MARGIN
+
+        for event in self.diagram.events:
+            if event[0] == 'message':
+                _, source, target, lines, _, _ = event
+                width = text_width(lines) + 2 * BOX_PADDING
+                if source == target:
+                    right = max(right, need_after(source, width + SELF_MESSAGE_WIDTH))
+                else:
+                    low, high = min(source, target), max(source, target)
+                    deficit = width - sum(gaps[low:high])
+                    if deficit > 0:
+                        gaps[high - 1] += deficit
+            elif event[0] == 'note':
+                _, position, participants, lines = event
+                width = text_width(lines) + 3 * BOX_PADDING
+                index = participants[0]
+                if position == 'right of':
+                    right = max(right, need_after(index, width))
+                elif position == 'left of':
+                    left = max(left, need_before(index, width))
+                elif len(participants) == 1:
+                    left = max(left, need_before(index, width / 2.0 + BOX_PADDING))
+                    right = max(right, need_after(index, width / 2.0 + BOX_PADDING))
+
+        self.x = [left]
+        for gap in gaps:
+            self.x.append(self.x[-1] + gap)
+        self.width = (self.x[-1] if self.x else left) + right
+
+    def render(self):
+        '''Draw the diagram.
+
+        Returns:
+            The SVG document as a string.
+        '''
+        diagram = self.diagram
+        elements = []
+        frames = []
+        y = MARGIN / 2.0
+
+        if diagram.title:
+            for line in diagram.title:
+                y += LINE_HEIGHT
+                elements.append(self.text(self.width / 2.0 if self.x else MARGIN, y, line,
+                                          anchor='middle', weight='bold'))
+            y += LINE_HEIGHT
+
+        top = y
+        y += self.box_height + 2 * BOX_PADDING
+
+        activations = [[] for _ in diagram.participants]
+        groups = []
+
+        def include(*xs):
+            # Widen the open groups to enclose the given x coordinates.
+            for group in groups:
+                group['extent'].extend([min(xs), max(xs)])
+                group['extent'][:] = [min(group['extent']), max(group['extent'])]
+
+        def edge(index, towards):
+            # The x at which a message meets the lifeline or activation bar.
+            depth = len(activations[index])
+            offset = ACTIVATION_WIDTH / 2.0 * depth
+            return self.x[index] + (offset if towards > self.x[index] else -offset)
+
+        for event in diagram.events:
+            kind = event[0]
+            if kind == 'message':
+                _, source, target, lines, dashed, open_arrow = event
+                style = ' stroke-dasharray="6,4"' if dashed else ''
+                marker = 'url(#open-arrow)' if open_arrow else 'url(#arrow)'
+                if source == target:
+                    x = edge(source, self.width)
+                    include(self.x[source], x + SELF_MESSAGE_WIDTH + 5 + text_width(lines))
+                    for line in lines:
+                        y += LINE_HEIGHT
+                        elements.append(self.text(x + SELF_MESSAGE_WIDTH + 5, y, line))
+                    y += 5
+                    elements.append(
+                        '<path d="M {0} {1} H {2} V {3} H {0}" fill="none" stroke="black"{4} '
+                        'marker-end="{5}"/>'.format(x, y, x + SELF_MESSAGE_WIDTH, y + LINE_HEIGHT,
+                                                    style, marker))
+                    y += LINE_HEIGHT + BOX_PADDING
+                else:
+                    x1 = edge(source, self.x[target])
+                    x2 = edge(target, self.x[source])
+                    include(self.x[source], self.x[target])
+                    for line in lines:
+                        y += LINE_HEIGHT
+                        elements.append(self.text((x1 + x2) / 2.0, y, line, anchor='middle'))
+                    y += 5
+                    elements.append(
+                        '<line x1="{0}" y1="{1}" x2="{2}" y2="{1}" stroke="black"{3} '
+                        'marker-end="{4}"/>'.format(x1, y, x2, style, marker))
+                    y += BOX_PADDING
+            elif kind == 'note':
+                _, position, participants, lines = event
+                width = text_width(lines) + 2 * BOX_PADDING
+                height = len(lines) * LINE_HEIGHT + BOX_PADDING
+                if position == 'left of':
+                    x = self.x[participants[0]] - width - BOX_PADDING
+                elif position == 'right of':
+                    x = self.x[participants[0]] + BOX_PADDING
+                else:
+                    low = min(self.x[index] for index in participants)
+                    high = max(self.x[index] for index in participants)
+                    width = max(width, high - low + 2 * BOX_PADDING)
+                    x = (low + high - width) / 2.0
+                include(x, x + width)
+                y += BOX_PADDING / 2.0
+                elements.append(
+                    '<rect x="{0}" y="{1}" width="{2}" height="{3}" fill="#ffffcc" '
+                    'stroke="black"/>'.format(x, y, width, height))
+                for number, line in enumerate(lines):
+                    elements.append(self.text(x + BOX_PADDING, y + (number + 1) * LINE_HEIGHT, line))
+                y += height + BOX_PADDING
+            elif kind == 'group':
+                _, keyword, lines = event
+                y += BOX_PADDING / 2.0
+                groups.append({'keyword': keyword, 'lines': [lines], 'top': y,
+                               'dividers': [], 'extent': []})
+                y += LINE_HEIGHT * len(lines) + BOX_PADDING
+            elif kind == 'else':
+                _, lines = event
+                groups[-1]['dividers'].append(y)
+                groups[-1]['lines'].append(lines)
+                y += LINE_HEIGHT * len(lines) + BOX_PADDING
+            elif kind == 'end':
+                group = groups.pop()
+                group['bottom'] = y
+                frames.append(group)
+                include(*self.frame_extent(group))
+                y += BOX_PADDING
+            elif kind == 'activate':
+                _, index = event
+                include(self.x[index] + ACTIVATION_WIDTH)
+                activations[index].append(y)
+            elif kind == 'deactivate':
+                _, index = event
+                if activations[index]:
+                    elements.insert(0, self.activation(index, len(activations[index]),
+                                                       activations[index].pop(), y))
+
+        bottom = y + BOX_PADDING
+        for index, starts in enumerate(activations):
+            while starts:
+                elements.insert(0, self.activation(index, len(starts), starts.pop(), bottom))
+
+        width = self.width
+        for group in frames:
+            elements[0:0] = self.frame(group)
+            width = max(width, self.frame_extent(group)[1] + BOX_PADDING)
+
+        lifelines = []
+        for index, lines in enumerate(self.boxes):
+            lifelines.append('<line x1="{0}" y1="{1}" x2="{0}" y2="{2}" stroke="gray" '
+                             'stroke-dasharray="4,4"/>'.format(self.x[index], top + self.box_height,
+                                                              bottom))
+            lifelines.extend(self.box(index, top))
+            lifelines.extend(self.box(index, bottom))
+
+        height = bottom + self.box_height + MARGIN / 2.0
+        return '\n'.join([
+            '<?xml version="1.0" encoding="UTF-8"?>',
+            '<svg xmlns="http://www.w3.org/2000/svg" width="{0}" height="{1}" '
+            'viewBox="0 0 {0} {1}" font-family="sans-serif" font-size="{2}">'.format(
+                int(width), int(height), FONT_SIZE),
+            '<defs>',
+            '<marker id="arrow" markerWidth="10" markerHeight="8" refX="10" refY="4" orient="auto">'
+            '<path d="M 0 0 L 10 4 L 0 8 z" fill="black"/></marker>',
+            '<marker id="open-arrow" markerWidth="10" markerHeight="8" refX="10" refY="4" orient="auto">'
+            '<path d="M 0 0 L 10 4 L 0 8" fill="none" stroke="black"/></marker>',
+            '</defs>',
+            '<rect width="100%" height="100%" fill="white"/>'] +
+            lifelines + elements + ['</svg>', ''])
+
+    def text(self, x, y, line, anchor='start', weight=None):
+        return '<text x="{0}" y="{1}" text-anchor="{2}"{3}>{4}</text>'.format(
+            x, y - 4, anchor, ' font-weight="bold"' if weight else '', escape(line))
+
+    def box(self, index, y):
+        width = self.box_widths[index]
+        elements = ['<rect x="{0}" y="{1}" width="{2}" height="{3}" fill="#eeeeee" '
+                    'stroke="black"/>'.format(self.x[index] - width / 2.0, y, width, self.box_height)]
+        for number, line in enumerate(self.boxes[index]):
+            elements.append(self.text(self.x[index], y + BOX_PADDING / 2.0 + (number + 1) * LINE_HEIGHT,
+                                      line, anchor='middle'))
+        return elements
+
+    def activation(self, index, depth, top, bottom):
+        x = self.x[index] - ACTIVATION_WIDTH / 2.0 + (depth - 1) * ACTIVATION_WIDTH / 2.0
+        return ('<rect x="{0}" y="{1}" width="{2}" height="{3}" fill="white" '
+                'stroke="black"/>'.format(x, top, ACTIVATION_WIDTH, max(bottom - top, 1)))
+
+    def frame_extent(self, group):
+        '''The left and right x coordinates of the frame around a group.'''
+        extent = group['extent'] or ([self.x[0], self.x[-1]] if self.x else [MARGIN, MARGIN])
+        left = extent[0] - 2 * BOX_PADDING
+        heading_width = (len(group['keyword']) * CHAR_WIDTH + 3 * BOX_PADDING
+                         + text_width(group['lines'][0]) + 2 * CHAR_WIDTH)
+        right = max(extent[1] + 2 * BOX_PADDING, left + heading_width)
+        return left, right
+
+    def frame(self, group):
+        left, right = self.frame_extent(group)
+        keyword_width = len(group['keyword']) * CHAR_WIDTH + BOX_PADDING
+        elements = [
+            '<rect x="{0}" y="{1}" width="{2}" height="{3}" fill="none" stroke="black"/>'.format(
+                left, group['top'], right - left, group['bottom'] - group['top']),
+            '<path d="M {0} {1} H {2} V {3} L {4} {5} H {0} z" fill="#eeeeee" stroke="black"/>'.format(
+                left, group['top'], left + keyword_width + 5, group['top'] + LINE_HEIGHT - 5,
+                left + keyword_width, group['top'] + LINE_HEIGHT),
+            self.text(left + 5, group['top'] + LINE_HEIGHT, group['keyword'], weight='bold')]
+        tops = [group['top']] + group['dividers']
+        for number, (top, lines) in enumerate(zip(tops, group['lines'])):
+            if number:
+                elements.append('<line x1="{0}" y1="{1}" x2="{2}" y2="{1}" stroke="black" '
+                                'stroke-dasharray="6,4"/>'.format(left, top, right))
+            x = left + (keyword_width + 2 * BOX_PADDING if number == 0 else BOX_PADDING)
+            for line_number, line in enumerate(lines):
+                if line:
+                    elements.append(self.text(x, top + (line_number + 1) * LINE_HEIGHT,
+                                              '[{0}]'.format(line)))
+        return elements
+
+
+def render(text):
+    '''Render websequencediagrams source as SVG.
+
+    Args:
+        text: The source of the diagram.
+
+    Returns:
+        The SVG document as a string.
+
+    Raises:
+        PhixError: If the source uses syntax which is not supported.
+    '''
+    return Layout(parse(text)).render()
@@ -0,0 +1,231 @@
+'''A stand-in websequencediagrams server for tests and benchmarks.
+
+The server speaks the protocol which WSDClient expects: a POST of the diagram
+source, answered with a ``?svg=<id>`` token, followed by a GET of the token
+which returns the rendering. It renders nothing - each rendering is a simple
+SVG document listing the lines of the source - but its latency, error rate and
+payload size can be configured, so that the client's throughput, connection
+reuse and failure handling can be exercised without a network.
+
+The server runs in-process on a background thread::
+
+    with StandInServer(latency=0.1) as server:
+        os.environ['PHIX_WEBSEQUENCEDIAGRAM_SERVER'] = server.url
+        ...
+
+or from the command line with::
+
+    python -m phix.websequencediagram_server --port 8080 --latency 0.1
+'''
+
+import argparse
+import json
+import logging
+import random
+import sys
+import threading
+import time
+import uuid
+
+if sys.version_info.major == 2:
+    import BaseHTTPServer
+    import SocketServer as socketserver
+    from cgi import escape
+    from urlparse import parse_qs, urlsplit
+    HTTPServer = BaseHTTPServer.HTTPServer
+    BaseHTTPRequestHandler = BaseHTTPServer.BaseHTTPRequestHandler
+else:
+    import socketserver
+    from html import escape
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from urllib.parse import parse_qs, urlsplit
+
+log = logging.getLogger('phix.websequencediagram_server')
+logging.basicConfig()
+
+
+def render_svg(text, payload_size=0):
+    '''Produce a stand-in rendering of a diagram.
+
+    Args:
+        text: The diagram source.
+
+        payload_size: The smallest size, in bytes, of the rendering, which is
+            padded with a comment to reach it.
+
+    Returns:
+        The SVG document as bytes.
+    '''
+    lines = text.splitlines() or ['']
+    body = ''.join('<text x="10" y="{0}">{1}</text>'.format(20 * (index + 1), escape(line))
+                   for index, line in enumerate(lines))
+    svg = ('<?xml version="1.0" encoding="UTF-8"?>\n'
+           '<svg xmlns="http://www.w3.org/2000/svg" width="400" height="{0}">{1}</svg>\n').format(
+               20 * (len(lines) + 1), body).encode('utf-8')
+    padding = payload_size - len(svg) - len(b'<!--  -->\n')
+    if padding > 0:
+        svg += b'<!-- ' + b'x' * padding + b' -->\n'
+    return svg
+
+
+class RequestHandler(BaseHTTPRequestHandler):
+    '''Handles the requests of one connection to a StandInServer.'''
+
+    # Keep-alive connections require HTTP/1.1.
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        log.info(format % args)
+
+    def setup(self):
+        BaseHTTPRequestHandler.setup(self)
+        self.server.count('connections')
+
+    def send_body(self, status, body, content_type):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def fail_or_delay(self):
+        '''Simulate the latency and unreliability of a real server.
+
+        Returns:
+            True if an error response has been sent.
+        '''
+        if self.server.latency:
+            time.sleep(self.server.latency)
+        if self.server.error_rate and random.random() < self.server.error_rate:
+            self.server.count('errors')
+            self.send_body(500, b'Simulated failure', 'text/plain')
+            return True
+        return False
+
+    def do_POST(self):
+        self.server.count('posts')
+        length = int(self.headers.get('Content-Length', 0))
+        form = parse_qs(self.rfile.read(length).decode('utf-8'))
+        if self.fail_or_delay():
+            return
+        message = form.get('message', [''])[0]
+        token = self.server.add_rendering(render_svg(message, self.server.payload_size))
+        response = json.dumps({'img': '?svg={0}'.format(token), 'errors': []})
+        self.send_body(200, (response + '\n').encode('utf-8'), 'application/json')
+
+    def do_GET(self):
+        self.server.count('gets')
+        if self.fail_or_delay():
+            return
+        query = parse_qs(urlsplit(self.path).query)
+        rendering = self.server.renderings.get(query.get('svg', [''])[0])
+        if rendering is None:
+            self.send_body(404, b'No such diagram', 'text/plain')
+            return
+        self.send_body(200, rendering, 'image/svg+xml')
+
+
+class StandInServer(socketserver.ThreadingMixIn, HTTPServer):
+    '''An in-process stand-in for a websequencediagrams server.
+
+    The counts attribute records the number of 'connections', 'posts', 'gets'
+    and 'errors' the server has seen.
+    '''
+
+    daemon_threads = True
+
+    def __init__(self, host='127.0.0.1', port=0, latency=0.0, error_rate=0.0, payload_size=0):
+        '''
+        Args:
+            host: The address on which to listen.
+
+            port: The port on which to listen, or 0 for any free port.
+
+            latency: The number of seconds to wait before answering each
+                request.
+
+            error_rate: The proportion of requests, between 0 and 1, which are
+                answered with an error.
+
+            payload_size: The smallest size in bytes of each rendering.
+        '''
+        HTTPServer.__init__(self, (host, port), RequestHandler)
+        self.latency = latency
+        self.error_rate = error_rate
+        self.payload_size = payload_size
+        self.renderings = {}
+        self.counts = dict.fromkeys(('connections', 'posts', 'gets', 'errors'), 0)
+        self.lock = threading.Lock()
+        self.thread = None
+
+    @property
+    def url(self):
+        '''The URL at which the server can be reached.'''
+        host, port = self.server_address[:2]
+        return 'http://{0}:{1}/'.format(host, port)
+
+    def handle_error(self, request, client_address):
+        # Clients abandon connections when they fail, which is to be expected.
+        log.info('Error handling request from {0}'.format(client_address), exc_info=sys.exc_info())
+
+    def count(self, name):
+        with self.lock:
+            self.counts[name] += 1
+
+    def add_rendering(self, svg):
+        token = uuid.uuid4().hex
+        with self.lock:
+            self.renderings[token] = svg
+        return token
+
+    def start(self):
+        '''Serve requests on a background thread.'''
+        self.thread = threading.Thread(target=self.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        log.info('Serving at {0}'.format(self.url))
+
+    def stop(self):
+        '''Stop serving requests and release the port.'''
+        if self.thread is not None:
+            self.shutdown()
+            self.thread.join()
+            self.thread = None
+        self.server_close()
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
+
+
+def main(argv=None):
+    '''Run a stand-in websequencediagrams server until interrupted.'''
+    parser = argparse.ArgumentParser(prog='python -m phix.websequencediagram_server',
+                                     description='Run a stand-in websequencediagrams server.')
+    parser.add_argument('--host', default='127.0.0.1',
+                        help='The address on which to listen.')
+    parser.add_argument('--port', type=int, default=8080,
+                        help='The port on which to listen.')
+    parser.add_argument('--latency', type=float, default=0.0,
+                        help='Seconds to wait before answering each request.')
+    parser.add_argument('--error-rate', type=float, default=0.0,
+                        help='The proportion of requests answered with an error.')
+    parser.add_argument('--payload-size', type=int, default=0,
+                        help='The smallest size in bytes of each rendering.')
+    args = parser.parse_args(argv)
+
+    server = StandInServer(args.host, args.port, args.latency, args.error_rate, args.payload_size)
+    print('Serving at {0}'.format(server.url))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -34,4 +34,13 @@ setup(
     #packages=find_packages(),
     include_package_data=True,
     install_requires=requires,
+    extras_require={
+        'brotli': ['brotli'],
+        'raster': ['cairosvg', 'Pillow'],
+    },
+    entry_points={
+        'console_scripts': [
+            'phix-cache = phix.cache:main',
+        ],
+    },
 )
\ No newline at end of file